@@ -17,6 +17,7 @@ import logging
 
 # Local imports
 from distribution import distribution
+from remote import portset
 
 
 # Variables
@@ -63,9 +64,9 @@ def parse_configuration_file(conf_file):
         conf = json.loads(f.read())
 
         # Processing hosts element, searching for set element within IPs
-        for s in ['scanners', 'targets', 'firewalls']:
+        for s in ['scanners', 'targets', 'firewalls', 'relays']:
             s_hosts = []
-            for host in conf['hosts'][s]:
+            for host in conf['hosts'].get(s, []):
                 logger.debug("Trying to expand %s hosts - %s" % (s, host['ip']))
                 pattern = re.compile("(?P<base>\d{1,3}\.\d{1,3}\.\d{1,3}\.)"
                                      "(?P<begin>\d{1,3})-(?P<end>\d{1,3})")
@@ -92,6 +93,9 @@ def parse_configuration_file(conf_file):
                         s_hosts.append(host)
             conf['hosts'][s] = s_hosts
 
+        # Ports can be a list of ports or a range string ("1-1024,8080")
+        conf['experiments']['ports'] = portset.PortSet.parse(conf['experiments']['ports'])
+
         return conf
 
 
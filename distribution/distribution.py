@@ -13,11 +13,17 @@ Description: Skeleton of a distribution method
 # Imports
 import time
 import random
+import socket
 import xmlrpclib
 import logging
-import threading
 
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+# Local imports
+import rpc
+import pools
+import engine
+import scheduler
+from remote import portset
+from remote import bloom
 
 
 
@@ -26,37 +32,60 @@ class DistributionMethod():
         Represents a way to distribute attacks
     """
 
-    def __init__(self, logger, conf, addr):
-        """ Initialize a Distribution Method """
+    def __init__(self, logger, conf, addr, store=None, agents=None, server=None, engine=None):
+        """ Initialize a Distribution Method
+                - store: results store in which the experiment is appended (optional)
+                - agents: pool of proxies to agents, shared by the experiments of a campaign (optional)
+                - server: coordinator RPC endpoint, shared by the experiments of a campaign (optional)
+                - engine: event queue and outbound calls, shared by the experiments of a campaign (optional)
+            If agents, server or engine are not given, they are created by this experiment
+        """
         # Attributes
         self._logger = logger
         self._conf = conf
         self._detected_scanners = []
-        self._events = []
         self._addr = addr
+        self._store = store
+        self._agents = agents
+        self._server = server
+        self._engine = engine
+        self._own_agents = agents is None
+        self._own_server = server is None
 
         ## Attributes related to results 
         # Traffic contains traffic generated by scanners and receveived by targets
         self._traffic = {}
         self._traffic['scanners'] = {}
         self._traffic['targets'] = {}
+        self._digests = {} # Bloom filters of the traffic received by targets (digest mode)
+        self._mismatches = {} # Packets not received, reported by targets (target verification)
 
         # Port state contains real port states of target hosts and port states found by scanners during portscan
         self._portstate = {}
         self._portstate['scanners'] = {}
         self._portstate['targets'] = {}
 
+        # Timestamps of the experiment, alerts raised by firewalls, per-port verdicts and per-scanner statistics
+        self._timestamps = {}
+        self._detections = []
+        self._verdicts = []
+        self._scanners_stats = {}
+
 
 # ########## Main methods 
 
     def pre_experiment(self):
         """ Method called before a experiment is launched """
+        self._timestamps['begin'] = time.time()
+
         # Init RPC proxies and methods
         self.init_rpc()
 
         # Start firewall and target monitoring 
         self.start_monitoring()
 
+        # Wait until every agent is actually ready
+        self.wait_ready()
 
 
     def run_experiment(self):
@@ -72,15 +101,30 @@ class DistributionMethod():
 
         """
 
-        # Stop monitoring, fetch traffic captured by targets and open ports
-        self.stop_monitoring()
+        self._timestamps['end'] = time.time()
+
+        # Fetch traffic captured by targets during this epoch and open ports
+        # Monitors keep running, they are stopped at the end of the campaign (see stop_monitoring)
         self.update_targets_data()
 
+        # Traffic can be verified by targets themselves, concurrently
+        if self._conf.get('target_verification'):
+            self.verify_on_targets()
+
         # Compute results, including ASR
         ASR = self.compute_experiment_result()
 
-        # Back up log files
-        # TODO
+        # Detection-to-kill latency of detected scanners
+        latencies = [alert['kill_latency'] for alert in self._detections if 'kill_latency' in alert]
+        if len(latencies):
+            self._logger.info("Detection-to-kill latency: mean %.3fs - max %.3fs (%d scanner(s))" \
+                    % (sum(latencies) / len(latencies), max(latencies), len(latencies)))
+
+        # Store results
+        if self._store:
+            experiment_id = self._store.add_experiment(self._conf, ASR, self._verdicts, self._detections,
+                                                       self._timestamps, self._scanners_stats)
+            self._logger.info("Results stored (experiment %d)" % experiment_id)
 
         # Stop RPC services
         self.stop_rpc()
@@ -93,37 +137,46 @@ class DistributionMethod():
     def init_rpc(self):
         """ Initialize scanner, firewall and target rpc proxies
             It also register local RPC methods 
+            Proxies and the coordinator endpoint are taken from the campaign if available
         """
-        self._p_scanners = {}
-        self._p_firewalls = {}
-        self._p_targets = {}
-
-        # Scanner RPC proxies
-        for host in self._conf['hosts']['scanners']:
-            self._p_scanners[host['ip']] = xmlrpclib.ServerProxy("http://%s:%d/" % (host['ip'], host['port']))
+        if self._agents is None:
+            self._agents = rpc.ProxyPool(self._conf.get('rpc_timeout', 30))
+
+        # Scanner, firewall and target RPC proxies
+        self._p_scanners = self._agents.proxies(self._conf['hosts']['scanners'])
+        self._p_firewalls = self._agents.proxies(self._conf['hosts']['firewalls'])
+        self._p_targets = self._agents.proxies(self._conf['hosts']['targets'])
+
+        # Events received by the coordinator endpoint are given to this experiment
+        # Events left by a previous experiment are dropped
+        if self._engine is None:
+            self._engine = engine.Engine(self._conf.get('rpc_workers', 16), self._logger)
+        dropped = self._engine.discard()
+        if dropped:
+            self._logger.info("%d event(s) of a previous experiment dropped" % dropped)
+
+        if self._server is None:
+            self._server = rpc.CoordinatorServer(self._addr, self._logger)
+        self._server.attach(self.add_event)
 
+    def stop_rpc(self):
+        """ Stop RPC services at the end of the experiment
+            Services shared by the campaign are only detached
+        """
+        self._server.detach()
+        self.report_connections()
 
-        # Firewall RPC proxies
-        for host in self._conf['hosts']['firewalls']:
-            self._p_firewalls[host['ip']] = xmlrpclib.ServerProxy("http://%s:%d/" % (host['ip'], host['port']))
-
-
-        # Target RPC proxies
-        for host in self._conf['hosts']['targets']:
-            self._p_targets[host['ip']] = xmlrpclib.ServerProxy("http://%s:%d/" % (host['ip'], host['port']))
-
-        # Registering commands
-        self._server =  SimpleXMLRPCServer(self._addr, allow_none=True)
-        self._server.register_function(self.add_event, "add_event")
-
-        # Creating a thread to the rpc server
-        t = threading.Timer(0, self._server.serve_forever)
-        t.start()
+        if self._own_server:
+            self._server.close()
+        if self._own_agents:
+            self._agents.close()
 
-    def stop_rpc(self):
-        """ Stop RPC services at the end of the experiment """
-        self._server.shutdown()
-        self._server.server_close()
+    def report_connections(self):
+        """ Log the number of calls and opened connections of each agent since the beginning of the campaign """
+        hosts = [{'ip': ip} for kind, proxies in self.agent_proxies() for ip in proxies]
+        for ip, stats in sorted(self._agents.stats(hosts).items()):
+            self._logger.info("agent %s - %d call(s) - %d connection(s) - %d reused" \
+                    % (ip, stats['requests'], stats['connections'], stats['reused']))
 
 
     def compute_experiment_result(self):
@@ -153,17 +206,45 @@ class DistributionMethod():
                 scanner = value[1]
 
 
+                real_state = self._portstate['targets'][target][port]
+
                 # 1) Verify that the found state is the real one
-                if self._portstate['targets'][target][port] != state:
+                if real_state != state:
                     self._logger.debug('Found a difference between found port state and real one : target %s - port %s is %s but found %s' \
-                            % (target, port, self._portstate['targets'][target][port], state))
+                            % (target, port, real_state, state))
+                    self._verdicts.append((target, port, scanner, state, real_state, 'wrong_state'))
                     continue
 
                 # 2) Verify that traffic generated by scanner has been well received by target
                 # An exchance of packet is considered valid if all sent packets by scanners are well received
                 valid = True
+                received = self._traffic['targets'].get(target, {}).get(scanner, {}).get(port)
+
+                if target in self._mismatches:
+                    # Verified by the target: only packets that have not been received are known
+                    for pkt in self._mismatches[target].get(scanner, {}).get(port, []):
+                        self._logger.debug('Generated traffic by scanner %s has not been received by %s (port %d) - pkt %s' \
+                                % (scanner, target, port, pkt))
+                        valid = False
+
+                elif target in self._digests:
+                    # Digest mode: sent packets are tested against the Bloom filter of the target
+                    for pkt in self._traffic['scanners'][scanner][target][port]:
+                        seq = None if self._conf['scan_method'] == '-sT' else pkt[1]
+                        if bloom.packet_key(scanner, port, pkt[0], seq) not in self._digests[target]:
+                            self._logger.debug('Generated traffic by scanner %s has not been received by %s (port %d) - pkt %s' \
+                                    % (scanner, target, port, pkt))
+                            valid = False
+
+                elif isinstance(received, int):
+                    # Counters mode: every packet sent by the scanner has to be counted by the target
+                    sent = len(self._traffic['scanners'][scanner][target][port])
+                    if received < sent:
+                        self._logger.debug('Target %s received %d of %d packets sent by scanner %s (port %d)' \
+                                % (target, received, sent, scanner, port))
+                        valid = False
 
-                if self._conf['scan_method'] != '-sT':
+                elif self._conf['scan_method'] != '-sT':
                     for pkt in self._traffic['scanners'][scanner][target][port]:
 
                         # For each packet sent by a scanner, verify it has been received by the target
@@ -171,7 +252,8 @@ class DistributionMethod():
                             if pkt not in self._traffic['targets'][target][scanner][port]:
                                 self._logger.debug('Generated traffic by scanner %s has not been received by %s (port %d) - pkt %s' \
                                         % (scanner, target, port, pkt))
-                                print self._traffic['targets'][target][scanner][port]
+                                self._logger.debug('Traffic received by %s from scanner %s (port %d): %s' \
+                                        % (target, scanner, port, self._traffic['targets'][target][scanner][port]))
                                 valid = False
                         except KeyError:
                             # Target doesn't even know scanner
@@ -205,6 +287,7 @@ class DistributionMethod():
 
 
                 if not valid:
+                    self._verdicts.append((target, port, scanner, state, real_state, 'traffic_lost'))
                     continue
 
                 # 3) Verify scanner has not been detected
@@ -212,18 +295,32 @@ class DistributionMethod():
                 # As a scanner is stopped when a firewall has detected it, unscanned port are not in this structure
 
                 # This port has been successfully scanned
+                self._verdicts.append((target, port, scanner, state, real_state, 'success'))
                 local_counter += 1
                 n += 1
 
             self._logger.info("target %s - %d of %d ports scanned - %d of %d successfully scanned" \
                     % (target, len(ports), port_per_host, local_counter, len(ports))) 
 
+        # Ports that have never been scanned (scanner detected before)
+        for target in self._conf['hosts']['targets']:
+            scanned_ports = self._portstate['scanners'].get(target['ip'], {})
+            for port in self._conf['ports']:
+                if port not in scanned_ports:
+                    real_state = self._portstate['targets'].get(target['ip'], {}).get(port)
+                    self._verdicts.append((target['ip'], port, None, None, real_state, 'not_scanned'))
+
         # Every portscan lead during this experimentation has been verified
         # Variable n contains the number of port successfully scanned
         # So we can compute the ASR
         ASR = float(n) / float(T)
         self._logger.info("Experiment results: %d of %d ports were successfully scanned - ASR - %f" \
                 % (n, T, ASR))
+        if len(self._digests):
+            # Lost packets may be seen as received: ASR is overestimated at most by this rate (per packet)
+            self._logger.info("Traffic verified with digests - false positive rate %g (estimated %g)" \
+                    % (self._conf['digest'].get('error_rate', 0.001),
+                       max([digest.estimated_error_rate() for digest in self._digests.values()])))
 
 
         return ASR
@@ -265,15 +362,87 @@ class DistributionMethod():
         random.shuffle(subparts, random.random)
         return subparts
 
+    def create_pool(self):
+        """ Create the pool of subparts according to the 'subparts' configuration
+                - mode 'static' (default): subparts are generated before the experiment,
+                - mode 'adaptive': subparts are cut on demand according to scanners throughput,
+                - mode 'permutation': subparts are generated lazily from a seeded permutation.
+            Other values are passed to the pool (or to generate_subparts)
+        """
+        args = dict(self._conf.get('subparts', {}))
+        mode = args.pop('mode', 'static')
+
+        if mode == 'static':
+            return pools.StaticPool(self.generate_subparts(**args))
+        elif mode == 'adaptive':
+            return pools.AdaptivePool(self._conf['hosts']['targets'], self._conf['ports'],
+                                      self._conf['nb_scanners'], **args)
+        elif mode == 'permutation':
+            return pools.PermutationPool(self._conf['hosts']['targets'], self._conf['ports'], **args)
+        else:
+            raise ValueError("Unknown subparts mode %s" % mode)
+
+    def create_scheduler(self, pool):
+        """ Create the scheduler assigning subparts of the pool to scanners
+            The policy is given by the 'scheduler' configuration (default is 'default'),
+            the number of subparts queued on each scanner by 'queue_depth' (default is 1)
+            and limits enforced on each target by 'target_limits' (max_scanners, max_rate, burst)
+            Speculative re-execution of late subparts is enabled by 'speculation' (factor, overhead)
+        """
+        policy = self._conf.get('scheduler', 'default')
+        depth = self._conf.get('queue_depth', 1)
+        limits = dict(self._conf.get('target_limits', {}))
+        self._logger.info("Scheduling policy: %s - queue depth %d - target limits %s" % (policy, depth, limits))
+        s = scheduler.create_scheduler(policy, pool, self._p_scanners.keys(), depth, **limits)
+
+        if self._conf.get('speculation'):
+            # Late subparts are speculatively re-executed on idle scanners
+            args = dict(self._conf['speculation'])
+            self._logger.info("Speculative re-execution enabled: %s" % args)
+            s.enable_speculation(self._conf['scan_timing'], **args)
+
+        return s
+
+    def report_scheduling(self, scheduler):
+        """ Log statistics of each scanner and keep them for the results store """
+        self._scanners_stats = scheduler.report()
+        for scanner, stats in sorted(self._scanners_stats.items()):
+            throughput = stats['throughput'] or 0.0
+            self._logger.info("scanner %s - %d subpart(s) - %d port(s) - busy %.2fs - idle %.2fs - queueing %.2fs - %.2f ports/s" \
+                    " - %d speculative - %d cancelled" \
+                    % (scanner, stats['subparts'], stats['ports'], stats['busy'], stats['idle'], stats['queueing'], throughput,
+                       stats['speculated'], stats['cancelled']))
+
+        self._logger.info("Scanners idle time: %.2fs" % sum([stats['idle'] for stats in self._scanners_stats.values()]))
+
+        for target, stats in sorted(scheduler.targets_report().items()):
+            self._logger.info("target %s - %d port(s) - %d concurrent scanner(s) at most - %.2f ports/s" \
+                    % (target, stats['ports'], stats['max_scanners'], stats['rate'] or 0.0))
+
 
     def start_monitoring(self):
-        """ Start monitoring at firewall and target hosts """
+        """ Start monitoring at firewall and target hosts
+            Monitors are persistent: if they are already running, only their epoch is advanced
+        """
+        epoch = self._conf.get('epoch', 0)
+
+        # Kill path: firewalls halt detected scanners themselves (halted scanners are resumed)
+        # Portscans left in the queue of a halted scanner belong to a previous experiment, they are revoked first
+        killed = []
+        if self._conf.get('direct_kill'):
+            for scanner_ip, scanner_rpc in self._p_scanners.items():
+                revoked = scanner_rpc.revoke_scans()
+                if len(revoked):
+                    self._logger.info("%d stale portscan(s) revoked at scanner %s" % (len(revoked), scanner_ip))
+                scanner_rpc.resume()
+            killed = [[host['ip'], host['port']] for host in self._conf['hosts']['scanners']]
 
         # Start monitoring at firewalls 
-       #for firewall_ip, firewall_rpc in self._p_firewalls.items():
-       #    args = self._conf['firewall_args']
-       #    self._logger.info("Starting monitor of the firewall %s" % firewall_ip)
-       #    firewall_rpc.start_snitch(args['patterns'], args['logfile'], args['timing'], self._addr)
+        for firewall_ip, firewall_rpc in self._p_firewalls.items():
+            args = self._conf['firewall_args']
+            self._logger.info("Starting monitor of the firewall %s (epoch %d)" % (firewall_ip, epoch))
+            firewall_rpc.start_snitch(args['patterns'], args['logfile'], args['timing'], self._addr, epoch)
+            firewall_rpc.register_scanners(killed)
 
         # Start monitoring at targets
         scanners_ip = []
@@ -282,24 +451,53 @@ class DistributionMethod():
 
 
         for target_ip, target_rpc in self._p_targets.items():
-            self._logger.info("Starting monitor of the target %s" % target_ip)
-            target_rpc.start_monitor(scanners_ip)
+            self._logger.info("Starting monitor of the target %s (epoch %d)" % (target_ip, epoch))
+            target_rpc.start_monitor(scanners_ip, epoch, str(self._conf['ports']))
+
 
 
+    def agent_proxies(self):
+        """ Return (kind, proxies) of agents taking part in the experiment """
+        return [('scanner', self._p_scanners), ('target', self._p_targets), ('firewall', self._p_firewalls)]
 
-    def stop_monitoring(self):
-        """ Stop monitoring at firewall and target hosts """
+    def wait_ready(self):
+        """ Cluster-wide barrier: wait until every agent reports it is ready
+                - scanners: nmap idle,
+                - targets: monitor socket open,
+                - firewalls: snitch tailing the logfile at its end.
+            Agents are probed every 'ready_poll' seconds (default is 0.05),
+            an exception is raised if they are not ready after 'ready_timeout' seconds (default is 60)
+        """
+        timeout = self._conf.get('ready_timeout', 60)
+        poll = self._conf.get('ready_poll', 0.05)
+        begin = time.time()
 
-        # Stop monitoring at firewalls 
-       #for firewall_ip, firewall_rpc in self._p_firewalls.items():
-       #    self._logger.info("Stopping monitor of the firewall %s" % firewall_ip)
-       #    firewall_rpc.stop_snitch()
+        waiting = {}
+        for kind, proxies in self.agent_proxies():
+            for ip, proxy in proxies.items():
+                waiting[(kind, ip)] = proxy
 
-        # Stop monitoring at targets
-        for target_ip, target_rpc in self._p_targets.items():
-            self._logger.info("Stopping monitor of the target %s" % target_ip)
-            target_rpc.stop_monitor()
+        while len(waiting):
+            for (kind, ip), proxy in waiting.items():
+                try:
+                    state = proxy.ready()
+                except (socket.error, xmlrpclib.Error), err:
+                    state = {'rpc': False}
+
+                if all(state.values()):
+                    self._logger.debug("%s %s is ready" % (kind, ip))
+                    del waiting[(kind, ip)]
+
+            if not len(waiting):
+                break
 
+            if time.time() - begin > timeout:
+                raise RuntimeError("Agents not ready after %ds: %s" \
+                        % (timeout, ', '.join(["%s %s" % key for key in sorted(waiting)])))
+            time.sleep(poll)
+
+        self._timestamps['ready'] = time.time()
+        self._logger.info("Every agent is ready (%.3fs)" % (self._timestamps['ready'] - begin))
 
     def update_targets_data(self):
         """ Fetch data from targets and update local data """
@@ -307,26 +505,38 @@ class DistributionMethod():
 
             # 1) Get open ports
             self._logger.info("Fetching open ports of targets")
-            open_ports = target_rpc.get_open_ports()
+            open_ports = portset.PortSet.parse(target_rpc.get_open_ports())
             
             # Create struct if not existent
             if target_ip not in self._portstate['targets']:
                 self._portstate['targets'][target_ip] = {}
 
-            for open_port in open_ports:
-                if open_port in [str(x) for x in self._conf['ports']]:
-                    self._portstate['targets'][target_ip][int(open_port)] = 'open'
-                    self._logger.debug("%s:%s is open" % (target_ip, open_port))
-
-            # Looking for closed ports
-            for port in [str(x) for x in self._conf['ports']]:
-                if port not in open_ports:
-                    self._portstate['targets'][target_ip][int(port)] = 'closed'
+            for port in self._conf['ports']:
+                if port in open_ports:
+                    self._portstate['targets'][target_ip][port] = 'open'
+                    self._logger.debug("%s:%s is open" % (target_ip, port))
+                else:
+                    self._portstate['targets'][target_ip][port] = 'closed'
                     self._logger.debug("%s:%s is closed" % (target_ip, port))
 
-            # 2) Get captured traffic
-            self._logger.info("Fetching captured traffic by targets")
-            captured_traffic = target_rpc.get_traffic()
+            # 2) Get traffic captured during this epoch
+            # In digest mode, only a Bloom filter sized for the traffic sent to this target is fetched
+            if self._conf.get('digest'):
+                capacity = sum([len(pkts) for targets in self._traffic['scanners'].values()
+                                for pkts in targets.get(target_ip, {}).values()])
+                digest = target_rpc.get_digest(self._conf.get('epoch', 0), capacity,
+                                               self._conf['digest'].get('error_rate', 0.001),
+                                               self._conf['scan_method'] == '-sT')
+                self._digests[target_ip] = bloom.BloomFilter.load(digest)
+                self._logger.info("Fetching digest of target %s - %d packet(s) - %d bytes" \
+                        % (target_ip, len(self._digests[target_ip]), self._digests[target_ip].nbytes()))
+                captured_traffic = {}
+            elif self._conf.get('target_verification'):
+                # Traffic is verified by the target (see verify_on_targets)
+                captured_traffic = {}
+            else:
+                self._logger.info("Fetching captured traffic by targets")
+                captured_traffic = target_rpc.get_traffic(self._conf.get('epoch', 0))
 
             if target_ip not in self._traffic['targets']:
                 self._traffic['targets'][target_ip] = {}
@@ -334,6 +544,12 @@ class DistributionMethod():
             for scanner in captured_traffic:
                 for local_port in captured_traffic[scanner]:
 
+                    if isinstance(captured_traffic[scanner][local_port], int):
+                        # Counters mode: only the number of received packets is known
+                        self._traffic['targets'][target_ip].setdefault(scanner, {})[int(local_port)] = \
+                                captured_traffic[scanner][local_port]
+                        continue
+
                     for pkt in captured_traffic[scanner][local_port]:
                         
                         # Creating struct if not existent
@@ -347,13 +563,71 @@ class DistributionMethod():
                         self._logger.debug('traffic captured by target %s -- from %s on port %s -- pkt %s' % (target_ip, scanner, local_port, pkt))
                         self._traffic['targets'][target_ip][scanner][int(local_port)].append((pkt[0], pkt[1]))
 
+            # 3) Capture statistics (packets dropped by the kernel cause false verdicts)
+            stats = target_rpc.capture_stats()
+            if len(stats):
+                self._logger.info("target %s - %d worker(s) - %d packet(s) kept - %d dropped by the kernel" \
+                        % (target_ip, stats['workers'], stats['kept'], stats['kernel_drops']))
+
+            latency = target_rpc.monitor_latency()
+            if latency['start'] is not None:
+                self._logger.info("target %s - monitor started in %.3fs" % (target_ip, latency['start']))
 
 
+    def verify_on_targets(self):
+        """ Send each target the packets sent to it by scanners
+            Targets verify them against their own capture concurrently, and only return mismatches
+        """
+        epoch = self._conf.get('epoch', 0)
+        connect = self._conf['scan_method'] == '-sT'
+
+        for target_ip, target_rpc in self._p_targets.items():
+            expected = {}
+            for scanner, targets in self._traffic['scanners'].items():
+                for port, pkts in targets.get(target_ip, {}).items():
+                    expected.setdefault(scanner, {})[str(port)] = pkts
+
+            self._logger.info("Sending expected traffic to target %s - %d port(s)" \
+                    % (target_ip, sum([len(ports) for ports in expected.values()])))
+            self._engine.call(target_ip, target_rpc.verify_traffic, (epoch, expected, connect),
+                              lambda result, target_ip=target_ip: self.target_verified(target_ip, result),
+                              lambda err, target_ip=target_ip: self._logger.warning(
+                                  "Target %s cannot verify its traffic (%s)" % (target_ip, err)))
+
+        # Events sent by agents meanwhile belong to the finished experiment, they are dropped
+        if not self._engine.flush(lambda event: None, self._conf.get('rpc_timeout', 30)):
+            self._logger.warning("Some targets have not verified their traffic in time")
+
+    def target_verified(self, target_ip, result):
+        """ Keep packets that have not been received by a target (see verify_on_targets) """
+        self._mismatches[target_ip] = {}
+        for scanner, ports in result['failed'].items():
+            self._mismatches[target_ip][scanner] = dict([(int(port), [tuple(pkt) for pkt in pkts])
+                                                         for port, pkts in ports.items()])
+
+        self._logger.info("target %s - traffic verified - %d port(s) passed - %d failed" \
+                % (target_ip, result['passed'], sum([len(ports) for ports in result['failed'].values()])))
+
+
+    def update_detection(self, kill):
+        """ Update the detection of a scanner with the result of its kill by a firewall ('firewall_kill' event)
+            Return the updated alert, None if the detection is unknown (or of a previous experiment)
+        """
+        for alert in self._detections:
+            if alert['ip_src'] == kill['ip_src'] and alert['detected_by'] == kill['detected_by'] \
+                    and alert.get('epoch', 0) == kill.get('epoch', 0) and alert.get('kill_path') == 'firewall' \
+                    and 'kill_latency' not in alert:
+                alert['kill_path'] = kill['kill_path']
+                if 'kill_latency' in kill:
+                    alert['kill_latency'] = kill['kill_latency']
+                return alert
+        return None
+
 
 # ########## RPC methods
     def add_event(self, event):
         """ Add an event to the queue """
-        self._events.append(event)
+        self._engine.post(event)
 
 
    
@@ -363,6 +637,30 @@ class DistributionMethod():
 # Local imports
 import naive
 import parallel
+import hierarchical
+import results
+
+
+def stop_monitoring(logger, conf, agents):
+    """ Stop monitoring at every firewall and target host, at the end of the campaign """
+
+    # Stop monitoring at firewalls 
+    for host in conf['hosts']['firewalls']:
+        logger.info("Stopping monitor of the firewall %s" % host['ip'])
+        try:
+            agents.proxy(host).stop_snitch()
+        except (socket.error, xmlrpclib.Error), err:
+            logger.warning("Firewall %s cannot be reached (%s)" % (host['ip'], err))
+
+    # Stop monitoring at targets
+    for host in conf['hosts']['targets']:
+        logger.info("Stopping monitor of the target %s" % host['ip'])
+        try:
+            latency = agents.proxy(host).stop_monitor()
+            if latency is not None:
+                logger.info("Monitor of the target %s stopped in %.3fs" % (host['ip'], latency))
+        except (socket.error, xmlrpclib.Error), err:
+            logger.warning("Target %s cannot be reached (%s)" % (host['ip'], err))
 
 
 def run(logger, conf, addr):
@@ -386,9 +684,39 @@ def run(logger, conf, addr):
     #       * 'count'
     #       * 'ports'
 
+    #       * 'results': filename of the results store (default is log/results.db)
+    #       * 'subparts': how subparts are generated (see create_pool, default is static subparts)
+    #       * 'scheduler': scheduling policy (see create_scheduler, default is 'default')
+    #       * 'queue_depth': number of subparts queued on each scanner (default is 1)
+    #       * 'target_limits': concurrency and probe-rate limits of each target (optional, no limit by default)
+    #       * 'speculation': speculative re-execution of late subparts (optional, disabled by default)
+    #     Defaults of these options are the baseline policy, results of experiments using others are not comparable
+    #       * 'rpc_timeout': timeout of RPC calls to scanners, firewalls and targets
+    #       * 'rpc_workers': number of threads sending calls to agents during an experiment (see engine.py)
+    #       * 'ready_timeout', 'ready_poll': readiness barrier before each experiment (see wait_ready)
+    #       * 'direct_kill': detected scanners are halted by firewalls, before the coordinator is alerted
+    #       * 'allotment_ports', 'allotment_depth': work given to relays (hierarchical method, see hierarchical.py)
+    #       * 'digest': targets send a Bloom filter of their traffic, {"error_rate": ...} (optional, see remote/bloom.py)
+    #       * 'target_verification': targets verify the traffic sent by scanners and only return mismatches
+
     # Experiment logger
     experiment_logger = logging.getLogger('coordinator.experiment')
 
+    # Results store, shared by every experiment of the campaign
+    campaign = time.strftime('%d_%m_%y_%H-%M-%S', time.gmtime())
+    store = results.ResultsStore(conf['experiments'].get('results', 'log/results.db'))
+    logger.info("Campaign %s -- results stored in %s" % (campaign, conf['experiments'].get('results', 'log/results.db')))
+
+    # RPC services shared by every experiment of the campaign:
+    # keep-alive proxies to agents and the coordinator endpoint
+    agents = rpc.ProxyPool(conf['experiments'].get('rpc_timeout', 30))
+    server = rpc.CoordinatorServer(addr, logger)
+    core = engine.Engine(conf['experiments'].get('rpc_workers', 16), logger)
+
+    # Monitors of targets and firewalls run across the whole campaign
+    # Each experiment is an epoch, captured traffic and alerts are tagged with it
+    epoch = 0
+
     for n in range(conf['experiments']['count']):
         # We want to do each experiment 'count' times
 
@@ -398,6 +726,7 @@ def run(logger, conf, addr):
             # Verify it is an existing distribution method
             if method == 'naive': method_class = naive.Naive
             elif method == 'parallel': method_class = parallel.Parallel
+            elif method == 'hierarchical': method_class = hierarchical.Hierarchical
             else:
                 continue
 
@@ -423,14 +752,33 @@ def run(logger, conf, addr):
                             experiment_conf['hosts']['scanners'] = random.sample(conf['hosts']['scanners'], nb_scanners)
                             experiment_conf['hosts']['firewalls'] = list(conf['hosts']['firewalls'])
                             experiment_conf['hosts']['targets'] = random.sample(conf['hosts']['targets'], nb_targets)
+                            experiment_conf['hosts']['relays'] = list(conf['hosts'].get('relays', []))
 
                             # experiment_conf config
+                            epoch += 1
+                            experiment_conf['campaign'] = campaign
+                            experiment_conf['epoch'] = epoch
+                            experiment_conf['method'] = method
                             experiment_conf['scan_method'] = scan_method
                             experiment_conf['scan_timing'] = scan_timing
                             experiment_conf['nb_scanners'] = nb_scanners
                             experiment_conf['nb_targets'] = nb_targets
-                            experiment_conf['ports'] = list(ports)
+                            experiment_conf['ports'] = portset.PortSet.parse(ports).copy()
                             experiment_conf['firewall_args'] = conf['experiments']['firewall_args']
+                            experiment_conf['subparts'] = dict(conf['experiments'].get('subparts', {}))
+                            experiment_conf['scheduler'] = conf['experiments'].get('scheduler', 'default')
+                            experiment_conf['queue_depth'] = conf['experiments'].get('queue_depth', 1)
+                            experiment_conf['target_limits'] = dict(conf['experiments'].get('target_limits', {}))
+                            experiment_conf['speculation'] = conf['experiments'].get('speculation')
+                            experiment_conf['rpc_timeout'] = conf['experiments'].get('rpc_timeout', 30)
+                            experiment_conf['rpc_workers'] = conf['experiments'].get('rpc_workers', 16)
+                            experiment_conf['ready_timeout'] = conf['experiments'].get('ready_timeout', 60)
+                            experiment_conf['ready_poll'] = conf['experiments'].get('ready_poll', 0.05)
+                            experiment_conf['direct_kill'] = conf['experiments'].get('direct_kill', False)
+                            experiment_conf['allotment_ports'] = conf['experiments'].get('allotment_ports', 64)
+                            experiment_conf['allotment_depth'] = conf['experiments'].get('allotment_depth', 2)
+                            experiment_conf['digest'] = conf['experiments'].get('digest')
+                            experiment_conf['target_verification'] = conf['experiments'].get('target_verification', False)
 
                             
                             ## Distribution method
@@ -450,7 +798,7 @@ def run(logger, conf, addr):
 
 
                             ## Create distribution instance 
-                            experiment = method_class(experiment_logger, experiment_conf, addr)
+                            experiment = method_class(experiment_logger, experiment_conf, addr, store, agents, server, core)
 
                             # 1) Pre_experiment
                             logger.info("pre_experiment -- Method %s - Scan technique %s - Scan timing %s - Nb scanner(s) %d - Nb target(s) %s - Port %s" \
@@ -469,6 +817,16 @@ def run(logger, conf, addr):
 
                             experiment_logger.removeHandler(file_logger)
 
-                            # Sleep TODO remove this
-                            time.sleep(0.2)
+    stop_monitoring(logger, conf, agents)
+
+    # Connection reuse over the campaign
+    stats = agents.stats().values()
+    logger.info("Campaign RPC calls: %d - connections opened: %d - reused: %d" \
+            % (sum([s['requests'] for s in stats]), sum([s['connections'] for s in stats]), sum([s['reused'] for s in stats])))
+    logger.info("Campaign events: %(events)d - asynchronous calls: %(calls)d - failed: %(errors)d - at most %(max_pending)d pending" \
+            % core.stats())
+
+    server.close()
+    agents.close()
+    store.close()
 
@@ -0,0 +1,168 @@
+'''
+File: engine.py
+Author: Damien Riquet
+Description: Event-driven core of the coordinator
+
+             Every event handled by an experiment goes through a single queue:
+                * events sent by agents (add_event RPC method), posted by the coordinator endpoint,
+                * replies of outbound RPC calls, that are sent by a pool of worker threads.
+             The experiment processes them one at a time in its own thread (see run_once), so that
+             its state is never shared, and it is woken up as soon as an event is received
+             instead of polling.
+
+             Outbound calls (see call) do not block the experiment: calls to the same agent
+             are sent one after another, in order, and calls to different agents are sent
+             concurrently. Their result is given to a callback run by the experiment.
+'''
+
+# Imports
+import time
+import Queue
+import logging
+import threading
+import collections
+
+
+class Engine():
+    """ Event queue and outbound calls of the coordinator """
+
+    def __init__(self, workers=16, logger=None):
+        """ Initialize the engine
+                - workers: number of threads sending outbound calls,
+                - logger: errors of calls without errback are logged.
+        """
+        self._logger = logger or logging.getLogger('coordinator')
+        self._queue = Queue.Queue() # ('event', event) or ('reply', (callback, errback, result, error))
+        self._lock = threading.Lock()
+        self._calls = {} # agent -> calls waiting to be sent to the agent, the first one is being sent
+        self._ready = Queue.Queue() # agents having calls to be sent, and no worker sending them
+        self._pending = 0 # outbound calls whose reply has not been processed yet
+
+        self._stats = {'events': 0, 'calls': 0, 'errors': 0, 'max_pending': 0}
+
+        self._workers = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self.run_worker)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def post(self, event):
+        """ Post an event sent by an agent (thread-safe) """
+        self._queue.put(('event', event))
+
+    def pending(self):
+        """ Number of outbound calls whose reply has not been processed yet """
+        return self._pending
+
+
+# ########## Outbound calls
+
+    def call(self, agent, method, args=(), callback=None, errback=None):
+        """ Call method(*args) asynchronously, method is a method of the proxy of agent
+            callback(result) or errback(error) is run by the experiment (see run_once)
+            Calls to the same agent are sent in order
+        """
+        with self._lock:
+            self._pending += 1
+            self._stats['calls'] += 1
+            self._stats['max_pending'] = max(self._stats['max_pending'], self._pending)
+
+            calls = self._calls.setdefault(agent, collections.deque())
+            calls.append((method, args, callback, errback))
+            if len(calls) == 1:
+                # No worker is sending calls to this agent
+                self._ready.put(agent)
+
+    def run_worker(self):
+        """ Send calls of ready agents """
+        while True:
+            agent = self._ready.get()
+            with self._lock:
+                method, args, callback, errback = self._calls[agent][0]
+
+            result = None
+            error = None
+            try:
+                result = method(*args)
+            except Exception, err:
+                # Any failure (socket, XML-RPC, HTTP errors of kept-alive connections, ...) is replied as an error,
+                # otherwise the worker would die and calls to this agent would never be sent
+                error = err
+            finally:
+                self._queue.put(('reply', (callback, errback, result, error)))
+
+                with self._lock:
+                    calls = self._calls[agent]
+                    calls.popleft()
+                    if len(calls):
+                        self._ready.put(agent)
+                    else:
+                        del self._calls[agent]
+
+
+# ########## Event loop
+
+    def run_once(self, handler, timeout=None):
+        """ Wait for the next event (at most timeout seconds) and process it
+            Events sent by agents are given to handler, replies to their callback
+            Return False if no event has been received before the timeout
+        """
+        try:
+            kind, item = self._queue.get(True, timeout)
+        except Queue.Empty:
+            return False
+
+        if kind == 'event':
+            self._stats['events'] += 1
+            handler(item)
+            return True
+
+        callback, errback, result, error = item
+        with self._lock:
+            self._pending -= 1
+        if error is not None:
+            self._stats['errors'] += 1
+            if errback:
+                errback(error)
+            else:
+                self._logger.warning("Outbound call failed: %s" % error)
+        elif callback:
+            callback(result)
+        return True
+
+    def flush(self, handler, timeout=None):
+        """ Process events until every outbound call has been replied (or timeout seconds have elapsed)
+            Return True if every call has been replied
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while self._pending:
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+            self.run_once(handler, remaining)
+        return True
+
+    def discard(self):
+        """ Drop events that have not been processed (sent during a previous experiment)
+            Return the number of dropped events
+        """
+        dropped = 0
+        kept = []
+        while True:
+            try:
+                kind, item = self._queue.get(False)
+            except Queue.Empty:
+                break
+            if kind == 'event':
+                dropped += 1
+            else:
+                kept.append((kind, item))
+
+        for entry in kept:
+            self._queue.put(entry)
+        return dropped
+
+    def stats(self):
+        """ Return the number of processed events, sent calls, failed calls and the maximum number of pending calls """
+        return dict(self._stats)
@@ -0,0 +1,243 @@
+'''
+File: hierarchical.py
+Author: Damien Riquet
+Description: Hierarchical way to distribute portscan
+
+             Scanners are sharded between relay sub-coordinators (see relay.py), so that the
+             coordinator (root) does not talk to every scanner:
+                * the root cuts the whole set into subparts (as the parallel method does),
+                * subparts are grouped into allotments of about 'allotment_ports' ports,
+                  each relay has up to 'allotment_depth' allotments,
+                * each relay runs the parallel distribution loop on its own scanners,
+                  and notifies the root when an allotment has been scanned,
+                * firewall alerts are received by the root and routed to the relay of the detected scanner,
+                  subparts of a relay whose scanners have all been detected are given back to the root,
+                * at the end of the experiment, aggregated results are fetched from each relay.
+
+             Relays are described in the 'relays' hosts of the configuration:
+                {"ip": ..., "port": ..., "scanners": [ips of the scanners of its shard]}
+'''
+
+# imports
+import time
+
+import distribution
+import relay
+
+
+class Hierarchical(distribution.DistributionMethod):
+
+    def init_rpc(self):
+        """ Proxies to relays are also created
+            Each relay is given the scanners of its shard taking part in the experiment
+        """
+        distribution.DistributionMethod.init_rpc(self)
+
+        scanners = dict([(host['ip'], host) for host in self._conf['hosts']['scanners']])
+        self._shards = {} # relay ip -> scanner hosts
+        self._relay_of = {} # scanner ip -> relay ip
+        relays = []
+        for relay in self._conf['hosts'].get('relays', []):
+            shard = [scanners[ip] for ip in relay['scanners'] if ip in scanners]
+            if not len(shard):
+                continue
+            relays.append(relay)
+            self._shards[relay['ip']] = shard
+            for host in shard:
+                self._relay_of[host['ip']] = relay['ip']
+
+        for ip in scanners:
+            if ip not in self._relay_of:
+                self._logger.warning("Scanner %s does not belong to any relay, it is not used" % ip)
+
+        self._p_relays = self._agents.proxies(relays)
+
+    def agent_proxies(self):
+        """ Scanners are reached through their relay """
+        return [('relay', self._p_relays), ('target', self._p_targets), ('firewall', self._p_firewalls)]
+
+    def start_monitoring(self):
+        """ Start monitoring at firewall and target hosts, and start the experiment on each relay """
+        distribution.DistributionMethod.start_monitoring(self)
+
+        for relay_ip, relay_rpc in self._p_relays.items():
+            self._logger.info("Starting relay %s - %d scanner(s)" % (relay_ip, len(self._shards[relay_ip])))
+            relay_rpc.start(self.relay_conf(relay_ip))
+
+    def relay_conf(self, relay_ip):
+        """ Configuration of the experiment run by a relay """
+        conf = {}
+        for key in ['method', 'scan_method', 'scan_timing', 'epoch', 'scheduler', 'queue_depth', 'target_limits',
+                    'speculation', 'rpc_timeout', 'rpc_workers', 'tick', 'campaign']:
+            if key in self._conf:
+                conf[key] = self._conf[key]
+
+        conf['hosts'] = {'scanners': self._shards[relay_ip], 'targets': self._conf['hosts']['targets'], 'firewalls': []}
+        conf['nb_scanners'] = len(self._shards[relay_ip])
+        conf['nb_targets'] = self._conf['nb_targets']
+        conf['ports'] = str(self._conf['ports'])
+        conf['coordinator'] = list(self._addr)
+        return conf
+
+    def run_experiment(self):
+        """ Give allotments to relays until every subpart has been scanned """
+        ## 0) Experiment variables
+        self._allotment_ports = self._conf.get('allotment_ports', 64)
+        self._allotment_depth = self._conf.get('allotment_depth', 2)
+        self._next_allotment = 0
+        self._outstanding = dict([(relay_ip, {}) for relay_ip in self._p_relays]) # relay -> allotment id -> subparts
+        self._exhausted = [] # Relays whose scanners have all been detected (or that cannot be reached)
+        self._finished = [] # Relays whose experiment is finished
+
+
+        ## 1) Generate subparts of the whole set
+        self._logger.info("Generating subparts ...")
+        self._pool = self.create_pool()
+        self._logger.info("%d ports to be distributed between %d relay(s)" % (len(self._pool), len(self._p_relays)))
+
+
+        ## 2) Give allotments to relays (First time)
+        self.allot()
+
+
+        ## 3) Wait for events until every allotment has been scanned
+        tick = self._conf.get('tick', 0.1)
+        while self.available() or sum([len(a) for a in self._outstanding.values()]) or self._engine.pending():
+            self._engine.run_once(self.process_event, tick)
+
+
+        ## 4) Finish relays and fetch their aggregated results
+        for relay_ip, relay_rpc in self._p_relays.items():
+            self._engine.call(relay_ip, relay_rpc.finish, (), None, lambda err: None)
+
+        deadline = time.time() + self._conf.get('rpc_timeout', 30)
+        while len(self._finished) < len(self._p_relays) and time.time() < deadline:
+            self._engine.run_once(self.process_event, tick)
+        self._engine.flush(self.process_event, self._conf.get('rpc_timeout', 30))
+
+        for relay_ip in self._finished:
+            self.merge_results(relay_ip, self._p_relays[relay_ip].results())
+
+        self.report_relays()
+
+    def available(self):
+        """ Are there subparts left and relays that can scan them ? """
+        return len(self._pool) > 0 and len(self._exhausted) < len(self._p_relays)
+
+    def allot(self):
+        """ Give allotments to relays having less than allotment_depth allotments """
+        for relay_ip, relay_rpc in self._p_relays.items():
+            while len(self._pool) and relay_ip not in self._exhausted \
+                    and len(self._outstanding[relay_ip]) < self._allotment_depth:
+                subparts = []
+                nb_ports = 0
+                while len(self._pool) and nb_ports < self._allotment_ports:
+                    subpart = self._pool.pop(relay_ip)
+                    subparts.append(subpart)
+                    nb_ports += len(subpart[1])
+
+                allotment_id = self._next_allotment
+                self._next_allotment += 1
+                self._outstanding[relay_ip][allotment_id] = subparts
+                self._logger.info("Allotment %d given to relay %s - %d port(s)" % (allotment_id, relay_ip, nb_ports))
+
+                self._engine.call(relay_ip, relay_rpc.allot, (allotment_id, relay.encode_subparts(subparts)), None,
+                                  lambda err, relay_ip=relay_ip: self.relay_lost(relay_ip, err))
+
+    def process_event(self, event):
+        """ Process an event sent by a relay or a firewall
+              * a relay event, event = ('relay', relay_ip, kind, value) (see relay.py)
+              * a firewall that has detected a scanner, event = ('firewall', alert)
+              * a firewall that has tried to halt a detected scanner, event = ('firewall_kill', alert)
+        """
+        if event[0] == 'relay':
+            relay_ip, kind, value = event[1], event[2], event[3]
+            if relay_ip not in self._outstanding:
+                return
+
+            if kind == 'allotment':
+                self._outstanding[relay_ip].pop(value, None)
+                self.allot()
+            elif kind == 'leftovers':
+                # Every scanner of the relay has been detected, its subparts are given to other relays
+                self._logger.info("Relay %s is exhausted - %d subpart(s) given back" % (relay_ip, len(value)))
+                if relay_ip not in self._exhausted:
+                    self._exhausted.append(relay_ip)
+                for subpart in relay.decode_subparts(value):
+                    self._pool.push(subpart)
+                self.allot()
+            elif kind == 'detected':
+                self._logger.info("Relay %s - scanner %s detected" % (relay_ip, value))
+            elif kind == 'finished':
+                if relay_ip not in self._finished:
+                    self._finished.append(relay_ip)
+
+        elif event[0] == 'firewall':
+            self.route_alert(event[1])
+
+        elif event[0] == 'firewall_kill':
+            # The relay stops the scanner if the firewall could not halt it
+            if self.update_detection(event[1]) is not None:
+                self.route_alert(event[1], 'firewall_kill')
+
+    def route_alert(self, alert, kind='firewall'):
+        """ Give a firewall alert (or the result of a kill) to the relay of the detected scanner """
+        if alert.get('epoch', 0) != self._conf.get('epoch', 0):
+            # Late alert raised during a previous experiment
+            return
+
+        if kind == 'firewall':
+            self._detections.append(alert)
+        relay_ip = self._relay_of.get(alert['ip_src'])
+        if relay_ip is None:
+            # Unknown scanner
+            return
+
+        self._engine.call(relay_ip, self._p_relays[relay_ip].add_event, ((kind, alert),), None,
+                          lambda err: self.relay_lost(relay_ip, err))
+
+    def relay_lost(self, relay_ip, err):
+        """ A relay cannot be reached, its allotments are given to other relays """
+        if relay_ip in self._exhausted and not len(self._outstanding[relay_ip]):
+            return
+        self._logger.warning("Relay %s cannot be reached (%s), it does not receive work anymore" % (relay_ip, err))
+
+        if relay_ip not in self._exhausted:
+            self._exhausted.append(relay_ip)
+        for subparts in self._outstanding[relay_ip].values():
+            for subpart in subparts:
+                self._pool.push(subpart)
+        self._outstanding[relay_ip] = {}
+        self.allot()
+
+    def merge_results(self, relay_ip, results):
+        """ Merge aggregated results of a relay into local data """
+        if not results:
+            self._logger.warning("No results from relay %s" % relay_ip)
+            return
+
+        for target, scanners in results['portstate'].items():
+            ports = self._portstate['scanners'].setdefault(target, {})
+            for scanner, states in scanners.items():
+                for state, ranges in states.items():
+                    for port in distribution.portset.PortSet.parse(ranges):
+                        ports[port] = (state, scanner)
+
+        for scanner, targets in results['traffic'].items():
+            for target, ports in targets.items():
+                traffic = self._traffic['scanners'].setdefault(scanner, {}).setdefault(target, {})
+                for port, pkts in ports.items():
+                    traffic.setdefault(int(port), []).extend([tuple(pkt) for pkt in pkts])
+
+        self._scanners_stats.update(results['scanners'])
+        for scanner in results['detected']:
+            if scanner not in self._detected_scanners:
+                self._detected_scanners.append(scanner)
+
+    def report_relays(self):
+        """ Log statistics of each scanner, reported by relays """
+        for scanner, stats in sorted(self._scanners_stats.items()):
+            self._logger.info("scanner %s (relay %s) - %d subpart(s) - %d port(s) - busy %.2fs - idle %.2fs" \
+                    % (scanner, self._relay_of.get(scanner), stats['subparts'], stats['ports'], stats['busy'], stats['idle']))
+        self._logger.info("%d allotment(s) given to %d relay(s) - %d exhausted" \
+                % (self._next_allotment, len(self._p_relays), len(self._exhausted)))
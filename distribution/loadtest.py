@@ -0,0 +1,260 @@
+'''
+File: loadtest.py
+Author: Damien Riquet
+Description: Load test of the coordinator core (engine.py) with local stand-in scanners
+             Stand-in scanners run in a separate process, behind one threaded XML-RPC server.
+             Each stand-in scanner has its own loopback address (127.0.x.y), hence its own
+             proxy and connection on the coordinator side. A portscan lasts a fixed duration,
+             then the completion event is sent to the coordinator with its results, as
+             remote/scanner.py does (every port is found closed).
+
+             The parallel distribution method is run (without targets nor firewalls) and
+             the sustained event rate is printed.
+             Whole experiments with stand-in targets and firewalls are run by simulation/benchmark.py
+             With -r, the hierarchical method is run instead: stand-in scanners are sharded
+             between relays (see relay.py), each one running in its own process.
+
+             It has to be launched from the root of the project:
+                python -m distribution.loadtest -a 1000
+                python -m distribution.loadtest -a 1000 -r 4
+'''
+
+# Imports
+import sys
+import time
+import heapq
+import Queue
+import getopt
+import logging
+import threading
+import xmlrpclib
+import multiprocessing
+
+# Local imports
+import relay
+import parallel
+import hierarchical
+from remote import portset
+from remote import rpcserver
+
+
+class StandInScanners():
+    """ Stand-in scanners sharing one XML-RPC server
+        Portscans of a scanner are executed one after another, each one lasts duration seconds
+    """
+
+    def __init__(self, port, duration, senders=8):
+        self._duration = duration
+        self._lock = threading.Lock()
+        self._queues = {} # agent -> queued portscans (coordinator, target, ports, scan_id)
+        self._timers = [] # heap of (end of the running portscan, agent)
+        self._timers_cond = threading.Condition(self._lock)
+        self._events = Queue.Queue() # (coordinator, event) to be sent
+
+        self._server = rpcserver.ThreadedXMLRPCServer(('0.0.0.0', port), logRequests=False)
+        self._server.RequestHandlerClass = rpcserver.LocalAddressHandler
+        self._server.local = threading.local()
+        self._server.register_function(self.exec_scan, "exec_scan")
+        self._server.register_function(self.scan_state, "scan_state")
+        self._server.register_function(self.revoke_scans, "revoke_scans")
+        self._server.register_function(self.stop_scan, "stop_scan")
+        self._server.register_function(lambda: {'nmap_idle': True}, "ready")
+
+        for t in [threading.Thread(target=self.run_timers)] + \
+                 [threading.Thread(target=self.run_sender) for i in range(senders)]:
+            t.daemon = True
+            t.start()
+
+    def exec_scan(self, scantype, timing, coordinator, target, ports, scan_id=None):
+        """ Queue a portscan, it is started right away if the scanner is idle """
+        agent = self._server.local.agent
+        with self._lock:
+            queue = self._queues.setdefault(agent, [])
+            queue.append((tuple(coordinator), target, ports, scan_id))
+            if len(queue) == 1:
+                heapq.heappush(self._timers, (time.time() + self._duration, agent))
+                self._timers_cond.notify()
+
+    def run_timers(self):
+        """ Finish portscans whose duration has elapsed, and start the next queued ones """
+        while True:
+            with self._lock:
+                while not len(self._timers) or self._timers[0][0] > time.time():
+                    self._timers_cond.wait(self._timers[0][0] - time.time() if len(self._timers) else None)
+
+                end, agent = heapq.heappop(self._timers)
+                coordinator, target, ports, scan_id = self._queues[agent].pop(0)
+                if len(self._queues[agent]):
+                    heapq.heappush(self._timers, (end + self._duration, agent))
+
+            self._events.put((coordinator, ('scanner', agent, target, scan_id, ({'closed': ports}, {'sent': {}}))))
+
+    def run_sender(self):
+        """ Send completion events to the coordinator, through a kept-alive connection """
+        proxies = {}
+        while True:
+            coordinator, event = self._events.get()
+            if coordinator not in proxies:
+                proxies[coordinator] = xmlrpclib.ServerProxy("http://%s:%d/" % coordinator, allow_none=True)
+            proxies[coordinator].add_event(event)
+
+    def scan_state(self, scan_id=None):
+        """ Results are sent with completion events, nothing is kept """
+        return {}, {'sent': {}}
+
+    def revoke_scans(self, scan_ids=None):
+        """ Remove queued portscans (except the running one) """
+        agent = self._server.local.agent
+        with self._lock:
+            queue = self._queues.get(agent, [])
+            revoked = [s[3] for s in queue[1:] if scan_ids is None or s[3] in scan_ids]
+            queue[1:] = [s for s in queue[1:] if s[3] not in revoked]
+        return revoked
+
+    def stop_scan(self, scan_id=None):
+        return False
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+
+def serve_stand_ins(port, duration):
+    """ Entry point of the stand-in scanners process """
+    StandInScanners(port, duration).serve_forever()
+
+
+def serve_relay(addr, timeout, workers):
+    """ Entry point of a relay process """
+    relay.Relay(addr, timeout, workers).serve_forever()
+
+
+def stand_in_hosts(nb_agents, port):
+    """ Return hosts of nb_agents stand-in scanners, each one has its own loopback address """
+    return [{'ip': "127.0.%d.%d" % (1 + i / 250, 1 + i % 250), 'port': port} for i in range(nb_agents)]
+
+
+def relay_hosts(nb_relays, scanners, port):
+    """ Return hosts of nb_relays local relays (127.1.0.x), scanners are sharded between them """
+    return [{'ip': "127.1.0.%d" % (1 + i), 'port': port, 'scanners': [host['ip'] for host in scanners[i::nb_relays]]}
+            for i in range(nb_relays)]
+
+
+def run(nb_agents, nb_ports, duration, depth, workers, port, addr, nb_relays=0):
+    """ Run the parallel method (or the hierarchical one if nb_relays is set) with stand-in scanners
+        and return engine statistics of the coordinator
+    """
+    logger = logging.getLogger('coordinator.loadtest')
+
+    conf = {}
+    conf['hosts'] = {'scanners': stand_in_hosts(nb_agents, port), 'firewalls': [],
+                     'targets': [{'ip': '10.0.0.1', 'port': port}]}
+    conf['hosts']['relays'] = relay_hosts(nb_relays, conf['hosts']['scanners'], port + 2)
+    conf['method'] = 'hierarchical' if nb_relays else 'parallel'
+    conf['scan_method'] = '-sS'
+    conf['scan_timing'] = 'insane'
+    conf['nb_scanners'] = nb_agents
+    conf['nb_targets'] = 1
+    conf['ports'] = portset.PortSet.parse("1-%d" % nb_ports)
+    conf['subparts'] = {'mode': 'permutation', 'ports_per_subpart': 1}
+    conf['queue_depth'] = depth
+    conf['rpc_workers'] = workers
+    conf['allotment_ports'] = max(1, 4 * depth * nb_agents / max(1, nb_relays))
+
+    if nb_relays:
+        experiment = hierarchical.Hierarchical(logger, conf, addr)
+        experiment.init_rpc()
+        for relay_ip, relay_rpc in experiment._p_relays.items():
+            relay_rpc.start(experiment.relay_conf(relay_ip))
+    else:
+        experiment = parallel.Parallel(logger, conf, addr)
+        experiment.init_rpc()
+
+    begin = time.time()
+    experiment.run_experiment()
+    duration = time.time() - begin
+
+    stats = experiment._engine.stats()
+    stats['duration'] = duration
+    stats['agents'] = nb_agents
+    stats['ports'] = nb_ports
+    stats['connections'] = sum([s['connections'] for s in experiment._agents.stats().values()])
+    experiment.stop_rpc()
+    return stats
+
+
+def usage(name):
+    """ Print usage"""
+    print "Usage: python -m distribution.loadtest <args>"
+    print "     -h               : print this help"
+    print "     -a <agents>      : Number of stand-in scanners (default is 200)"
+    print "     -n <ports>       : Number of ports to be scanned, one port per subpart (default is 20000)"
+    print "     -t <seconds>     : Duration of a portscan (default is 0.01)"
+    print "     -q <depth>       : Queue depth of each scanner (default is 2)"
+    print "     -w <workers>     : Number of threads sending calls (default is 16)"
+    print "     -p <port>        : Port of stand-in scanners (default is 9000), the coordinator uses port+1"
+    print "     -r <relays>      : Number of relays (hierarchical method), relays use port+2"
+    print "  The number of open files (ulimit -n) has to be greater than twice the number of agents"
+
+
+if __name__ == '__main__':
+    # Variables
+    nb_agents = 200
+    nb_ports = 20000
+    duration = 0.01
+    depth = 2
+    workers = 16
+    port = 9000
+    nb_relays = 0
+
+    # Parsing arguments
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'a:n:t:q:w:p:r:h')
+    except getopt.GetoptError, err:
+        print "Bad arguments"
+        print str(err)
+        usage(sys.argv[0])
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-a":
+            nb_agents = int(a)
+        elif o == "-n":
+            nb_ports = int(a)
+        elif o == "-t":
+            duration = float(a)
+        elif o == "-q":
+            depth = int(a)
+        elif o == "-w":
+            workers = int(a)
+        elif o == "-p":
+            port = int(a)
+        elif o == "-r":
+            nb_relays = int(a)
+        elif o == "-h":
+            usage(sys.argv[0])
+            sys.exit(2)
+        else:
+            print "Unknown option"
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s\t: %(message)s")
+
+    # Stand-in scanners
+    processes = [multiprocessing.Process(target=serve_stand_ins, args=(port, duration))]
+
+    # Relays
+    for host in relay_hosts(nb_relays, [], port + 2):
+        processes.append(multiprocessing.Process(target=serve_relay, args=((host['ip'], host['port']), 30, workers)))
+
+    for process in processes:
+        process.daemon = True
+        process.start()
+    time.sleep(0.5)
+
+    stats = run(nb_agents, nb_ports, duration, depth, workers, port, ('127.0.0.1', port + 1), nb_relays)
+    for process in processes:
+        process.terminate()
+
+    print "%(agents)d agents - %(connections)d connections - %(events)d events - %(calls)d calls (%(errors)d failed, " \
+          "at most %(max_pending)d pending) in %(duration).2fs" % stats
+    print "Sustained rate: %.0f events/s - %.0f calls/s - %.0f ports/s" \
+            % (stats['events'] / stats['duration'], stats['calls'] / stats['duration'], stats['ports'] / stats['duration'])
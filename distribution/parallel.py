@@ -6,12 +6,18 @@ Description: Parallel way to distribute portscan
              Parallel distribution consists in:
                 * divide the whole set containing (targets, ports) into subparts,
                 * start firewalls monitor
-                * distribute these subparts between scanners,
-                * wait for events and process them
+                * distribute these subparts between scanners (according to the scheduling policy),
+                  each scanner has up to 'queue_depth' subparts queued, so it never waits for the coordinator,
+                * wait for events and process them as soon as they are received (see engine.py),
+                  calls to scanners are asynchronous
 
              Events can be:
                 * the scanner has finished its work, we give it work it there is left,
-                * or one of the firewall has detected a scanner, and we have to stop it.
+                * or one of the firewall has detected a scanner, and we have to stop it
+                  (its queued subparts are revoked and given to other scanners).
+
+             Late subparts are speculatively re-executed by idle scanners (if enabled),
+             the first result wins and the other portscan is stopped.
 
 '''
 
@@ -19,6 +25,7 @@ Description: Parallel way to distribute portscan
 import time
 
 import distribution 
+from remote import portset
 
 class Parallel(distribution.DistributionMethod):
 
@@ -31,103 +38,209 @@ class Parallel(distribution.DistributionMethod):
         scan_timing = self._conf['scan_timing']
         ports = self._conf['ports']
 
-        detected_scanners = []
         self._current_jobs = 0
 
 
         ## 1) Generate subparts of the whole set
         self._logger.info("Generating subparts ...")
-        subparts = self.generate_subparts()
-        self._logger.info("%d subparts generated" % len(subparts))
+        subparts = self.create_pool()
+        self._logger.info("%d ports to be distributed" % len(subparts))
+
+        scheduler = self.create_scheduler(subparts)
 
 
         ## 2) Start firewalls monitor
         # TODO CLEAN 
 
         ## 3) Distribute subparts between scanners (First time)
-        for scanner_ip, scanner_rpc in self._p_scanners.items():
-
-            # Verifying there are subparts
-            if len(subparts):
-                self.distribute_subpart(subparts, scanner_ip)
+        self._scheduler = scheduler
+        self._lost_scanners = []
+        self.distribute_subparts(scheduler)
             
              
         ## 4) Wait for events and the end of the experiment
-        while len(subparts) or len(detected_scanners) == self._conf['nb_scanners'] or self._current_jobs:
-            # While there are subparts to process OR scanners undetected OR current jobs, waiting for signals
-
-            if len(self._events):
-                # There are events, process them all
-                
-                while len(self._events):
-                    # Pop the first event
-                    event = self._events.pop(0)
-
-                    # An event could be :
-                    #   * a scanner that has finished his subpart,  event = ('scanner', scanner_ip, target_ip)
-                    #   * a firewall that has detected a scanner, event = ('firewall', alert)
-                    #     with alert a dict containing 'patterns', 'detected_by', 'ip_src', 'ip_dst' and 'date' values
-
-                    if event[0] == 'scanner':
-                        # A scanner has finished his work
-                        # We need to 1) update traffic and ports database and 2) give a job back to the scanner, if possible
-
-                        self._current_jobs -= 1
-
-                        scanner_ip = event[1]
-                        target_ip = event[2]
-                        self._logger.info("Scanner %s has finished its portscan" % (scanner_ip))
-
-
-                        if scanner_ip not in self._p_scanners:
-                            # Unknown scanner
-                            continue
-
-                        scanner_rpc = self._p_scanners[scanner_ip]
-
-                        # 1) Fetch data about the portscan and update local data
-                        ports_state, generated_traffic = scanner_rpc.scan_state() 
+        # Events are processed as soon as they are received (see engine.py),
+        # the loop wakes up every 'tick' seconds to release target limits and detect stragglers
+        tick = self._conf.get('tick', 0.1)
+        next_tick = time.time() + tick
+        while self.running(scheduler):
+            # While there are subparts to process by undetected scanners OR current jobs, waiting for signals
+            self._engine.run_once(self.process_event, max(0, next_tick - time.time()))
+
+            if time.time() < next_tick:
+                continue
+            next_tick = time.time() + tick
+
+            # Targets limits may have been released (probe-rate budget), distribute left subparts
+            self.distribute_subparts(scheduler)
+
+            # Straggler mitigation: late subparts are re-executed by idle scanners
+            for scanner_ip, scan_id, subpart in scheduler.stragglers():
+                copy = scheduler.speculate(scanner_ip, scan_id)
+                if copy is None:
+                    # No idle scanner
+                    break
+
+                self._logger.info("Scan %d of scanner %s is late - speculatively re-executed by %s (scan %d)" \
+                        % (scan_id, scanner_ip, copy[0], copy[1]))
+                self.distribute_subpart(subpart, copy[0], copy[1])
+
+        ## 5) Scheduling report
+        scheduler.stop()
+        self.report_scheduling(scheduler)
+
+
+    def running(self, scheduler):
+        """ Is the experiment running ? (subparts left for undetected scanners, current jobs or pending calls) """
+        return scheduler.pending() or self._current_jobs or self._engine.pending()
+
+    def subpart_done(self, subpart):
+        """ A subpart has been scanned (called before its results are fetched) """
+        pass
+
+    def process_event(self, event):
+        """ Process an event sent by an agent
+            An event could be :
+              * a scanner that has finished his subpart,  event = ('scanner', scanner_ip, target_ip, scan_id, results)
+                with results the (ports state, generated traffic) of the portscan (fetched with scan_state if not sent)
+              * a firewall that has detected a scanner, event = ('firewall', alert)
+                with alert a dict containing 'patterns', 'detected_by', 'ip_src', 'ip_dst', 'date' and 'epoch' values
+              * a firewall that has tried to halt a detected scanner (kill path), event = ('firewall_kill', alert)
+        """
+        if event[0] == 'scanner':
+            self.scanner_finished(event[1], event[2], event[3] if len(event) > 3 else None, event[4] if len(event) > 4 else None)
+        elif event[0] == 'firewall':
+            self.scanner_detected(event[1])
+        elif event[0] == 'firewall_kill':
+            self.scanner_killed(event[1])
+
+    def scanner_finished(self, scanner_ip, target_ip, scan_id, results=None):
+        """ A scanner has finished his work
+            We need to 1) update traffic and ports database and 2) give a job back to the scanner, if possible
+            Results are fetched from the scanner if they have not been sent with the event
+        """
+        scheduler = self._scheduler
+        self._logger.info("Scanner %s has finished its portscan" % (scanner_ip))
+
+        if scanner_ip not in self._p_scanners:
+            # Unknown scanner
+            return
+
+        if scan_id is not None and scheduler.is_cancelled(scan_id):
+            # Its speculative copy has already won, results are ignored
+            self._logger.info("Scan %d of scanner %s has been cancelled, results ignored" % (scan_id, scanner_ip))
+            if results is None:
+                self.discard_scan_state(scanner_ip, scan_id)
+            return
+
+        # Update the scheduler (throughput of the scanner, idle scanners)
+        # If there is a speculative copy of this subpart, it is stopped
+        twin = scheduler.twin(scan_id) if scan_id is not None else None
+        subpart = scheduler.completed(scanner_ip, scan_id)
+        if subpart is None:
+            # Unknown portscan (revoked from an unreachable scanner)
+            if results is None:
+                self.discard_scan_state(scanner_ip, scan_id)
+            return
+
+        self._current_jobs -= 1
+        if twin:
+            self.stop_twin(scheduler, twin[0], twin[1])
+        self.subpart_done(subpart)
+
+        # 1) Update local data with results of the portscan (fetched if they have not been sent)
+        if results is not None:
+            self.scan_fetched(scanner_ip, target_ip, results)
+        else:
+            scanner_rpc = self._p_scanners[scanner_ip]
+            args = (scan_id,) if scan_id is not None else ()
+            self._engine.call(scanner_ip, scanner_rpc.scan_state, args,
+                              lambda state: self.scan_fetched(scanner_ip, target_ip, state),
+                              lambda err: self._logger.warning("Cannot fetch results of scanner %s (%s)" % (scanner_ip, err)))
+
+        # 2) Giving job back to idle scanners
+        self.distribute_subparts(scheduler)
+
+    def scan_fetched(self, scanner_ip, target_ip, state):
+        """ Results of a portscan have been fetched """
+        ports_state, generated_traffic = state
+
+        # Updating self._portstate['scanners'] data
+        self.update_port_state(ports_state, scanner_ip, target_ip)
+
+        # Updating self._traffic['scanners'] data
+        self.update_traffic(generated_traffic['sent'], scanner_ip)
+
+    def scanner_detected(self, alert):
+        """ A firewall has detected a scanner
+            We need to stop the scanner, put it in the detected scanners list, update the traffic and ports database
+        """
+        scheduler = self._scheduler
+        detected_scanner_ip  = alert['ip_src']
 
-                        # Updating self._portstate['scanners'] data
-                        self.update_port_state(ports_state, scanner_ip, target_ip)
+        if alert.get('epoch', 0) != self._conf.get('epoch', 0):
+            # Late alert raised during a previous experiment
+            self._logger.info("Ignoring alert of epoch %s on scanner %s" % (alert['epoch'], detected_scanner_ip))
+            return
 
-                        # Updating self._traffic['scanners'] data
-                        self.update_traffic(generated_traffic['sent'], scanner_ip)
+        self._detections.append(alert)
+        alert['received'] = time.time()
 
+        if detected_scanner_ip not in self._p_scanners or detected_scanner_ip in self._detected_scanners:
+            # Unknown or already detected scanner
+            return
 
-                        # 2) Giving job back to the scanner
-                        if len(subparts) and scanner_ip not in detected_scanners:
-                            self.distribute_subpart(subparts, scanner_ip)
+        detected_scanner_rpc = self._p_scanners[detected_scanner_ip]
+        self._current_jobs -= len(scheduler.remove(detected_scanner_ip))
 
+        # 1) Add the scanner to the detected list
+        self._detected_scanners.append(detected_scanner_ip)
 
-                    elif event[0] == 'firewall':
-                        # A firewall has detected a scanner
-                        # We need to stop the scanner, put it in the detected scanners list, update the traffic and ports database
+        # 2) Revoke queued subparts and give them back to the pool, they are given to other scanners
+        def revoked(scan_ids):
+            scheduler.revoke(detected_scanner_ip, scan_ids)
+            self._current_jobs -= len(scan_ids)
+            self._logger.info("Scanner %s detected - %d queued subpart(s) revoked" % (detected_scanner_ip, len(scan_ids)))
+            self.distribute_subparts(scheduler)
 
-                        detected_scanner_ip  = event[1]['ip_src']
-                        target = event[1]['ip_dst']
-                        detected_scanner_rpc = self._p_scanners[detected_scanner_ip]
+        self._engine.call(detected_scanner_ip, detected_scanner_rpc.revoke_scans, (), revoked,
+                          lambda err: self.scanner_lost(scheduler, detected_scanner_ip, err))
 
-                        # 1) Stop the scanner and fetch its results
-                        detected_scanner_rpc.stop_scan()
-                        ports_state, generated_traffic = detected_scanner_rpc.scan_state() 
-        
-                        # Updating self._portstate['scanners'] data
-                        self.update_port_state(ports_state, detected_scanner_ip, target)
+        # 3) Stop the scanner (after its queue has been revoked), unless the firewall halts it (see scanner_killed)
+        # Results of the stopped portscan are fetched when its completion event is received
+        if alert.get('kill_path') == 'firewall':
+            self._logger.info("Scanner %s is halted by firewall %s" % (detected_scanner_ip, alert['detected_by']))
+            return
 
-                        # Updating self._traffic['scanners'] data
-                        self.update_traffic(generated_traffic['sent'], detected_scanner_ip)
+        self.stop_detected(alert)
 
-                        # 2) Add the scanner to the detected list
-                        detected_scanners.append(detected_scanner_ip)
+    def stop_detected(self, alert):
+        """ Stop the running portscan of a detected scanner (coordinator kill path) """
+        detected_scanner_ip = alert['ip_src']
 
+        def stopped(result):
+            # Latency from the detection (firewall side) to the reply of the scanner (coordinator side)
+            alert['kill_path'] = 'coordinator'
+            alert['kill_latency'] = alert.get('notify_delay', 0.0) + time.time() - alert['received']
+            self._logger.info("Scanner %s stopped %.3fs after its detection" % (detected_scanner_ip, alert['kill_latency']))
 
-                    else:
-                        continue
+        self._engine.call(detected_scanner_ip, self._p_scanners[detected_scanner_ip].stop_scan, (), stopped)
 
-            # Sleep between each loop
-            print '.'
-            time.sleep(0.1)
+    def scanner_killed(self, kill):
+        """ A firewall has tried to halt a detected scanner (kill path)
+            If it could not, the scanner is stopped by the coordinator
+        """
+        alert = self.update_detection(kill)
+        if alert is None or alert['ip_src'] not in self._p_scanners:
+            return
+
+        if alert['kill_path'] == 'firewall':
+            self._logger.info("Scanner %s halted by firewall %s %.3fs after its detection" \
+                    % (alert['ip_src'], alert['detected_by'], alert['kill_latency']))
+        else:
+            self._logger.warning("Scanner %s could not be halted by firewall %s, it is stopped by the coordinator" \
+                    % (alert['ip_src'], alert['detected_by']))
+            self.stop_detected(alert)
 
                 
 
@@ -152,7 +265,7 @@ class Parallel(distribution.DistributionMethod):
                     if target not in self._traffic['scanners'][scanner]:
                         self._traffic['scanners'][scanner][target] = {}
 
-                    if port not in self._traffic['scanners'][scanner][target]:
+                    if int(port) not in self._traffic['scanners'][scanner][target]:
                         self._traffic['scanners'][scanner][target][int(port)] = []
 
                     # Updating data
@@ -160,26 +273,68 @@ class Parallel(distribution.DistributionMethod):
 
 
     def update_port_state(self, ports_state, scanner, target):
-        """ Update local data, add port state found by the scanner """
-        for port, port_state in ports_state.items():
-
-            # Creating the structure if non-existent
-            if target not in self._portstate['scanners']:
-                self._portstate['scanners'][target] = {}
+        """ Update local data, add port state found by the scanner
+            ports_state is a dict containing the set of ports (range string) found in each state
+        """
+        # Creating the structure if non-existent
+        if target not in self._portstate['scanners']:
+            self._portstate['scanners'][target] = {}
+
+        for state, ports in ports_state.items():
+            self._logger.debug('Scanner %s found that %s:%s is %s' % (scanner, target, ports, state))
+            for port in portset.PortSet.parse(ports):
+                self._portstate['scanners'][target][port] = (state, scanner)
+        
 
+    def stop_twin(self, scheduler, scanner, scan_id):
+        """ Stop a portscan whose speculative copy has won
+            The scanner is no longer used if it cannot be reached
+        """
+        self._current_jobs -= 1
+        self._logger.info("Stopping scan %d of scanner %s (speculative copy has won)" % (scan_id, scanner))
 
-            self._logger.debug('Scanner %s found that %s:%s is %s' % (scanner, target, port, port_state[0]))
-            self._portstate['scanners'][target][int(port)] = (port_state[0], scanner)
-        
+        scanner_rpc = self._p_scanners[scanner]
+        lost = lambda err: self.scanner_lost(scheduler, scanner, err)
+        self._engine.call(scanner, scanner_rpc.revoke_scans, ([scan_id],), None, lost)
+        self._engine.call(scanner, scanner_rpc.stop_scan, (scan_id,), None, lost)
 
-    def distribute_subpart(self, subparts, scanner):
-        """ Send a subpart to a scanner """
-        subpart = subparts.pop()
+    def scanner_lost(self, scheduler, scanner, err):
+        """ A scanner cannot be reached, it does not receive work anymore
+            Its queued subparts are given back to the pool
+        """
+        if scanner in self._lost_scanners:
+            return
+        self._lost_scanners.append(scanner)
+        self._logger.warning("Scanner %s cannot be reached (%s), it does not receive work anymore" % (scanner, err))
+
+        cancelled = scheduler.remove(scanner)
+        queued = [scan_id for scan_id in scheduler.queued(scanner) if scan_id not in cancelled]
+        scheduler.revoke(scanner, queued)
+        self._current_jobs -= len(cancelled) + len(queued)
+        self.distribute_subparts(scheduler)
+
+    def discard_scan_state(self, scanner, scan_id):
+        """ Fetch and ignore results of a cancelled portscan, so that the scanner frees them """
+        args = (scan_id,) if scan_id is not None else ()
+        self._engine.call(scanner, self._p_scanners[scanner].scan_state, args, None, lambda err: None)
+
+    def distribute_subparts(self, scheduler):
+        """ Send subparts to idle scanners, according to the scheduler """
+        for scanner, scan_id, subpart in scheduler.dispatch():
+            self.distribute_subpart(subpart, scanner, scan_id)
+
+    def distribute_subpart(self, subpart, scanner, scan_id):
+        """ Send a subpart to a scanner, it is queued if the scanner is busy
+            The call is asynchronous, the subpart is given back to the pool if the scanner cannot be reached
+        """
         self._current_jobs += 1
 
         # Send RPC request to the scanner
-        self._logger.info("Call to %s.exec_scan method - %d ports to scan" % (scanner, len(subpart[1])))
+        self._logger.info("Call to %s.exec_scan method - scan %d - %d ports to scan" % (scanner, scan_id, len(subpart[1])))
         scanner_rpc = self._p_scanners[scanner]
 
-        scanner_rpc.exec_scan(self._conf['scan_method'], self._conf['scan_timing'], self._addr, subpart[0]['ip'], subpart[1])
+        self._engine.call(scanner, scanner_rpc.exec_scan,
+                          (self._conf['scan_method'], self._conf['scan_timing'], self._addr, subpart[0]['ip'],
+                           str(portset.PortSet(subpart[1])), scan_id),
+                          None, lambda err: self.scanner_lost(self._scheduler, scanner, err))
         
@@ -0,0 +1,349 @@
+'''
+File: pools.py
+Author: Damien Riquet
+Description: Pools of subparts handed out to scanners by distribution methods
+
+             Three pools are available:
+                * StaticPool: subparts are generated before the experiment (generate_subparts),
+                * AdaptivePool: subparts are cut on demand from a per-target port pool,
+                  their size depends on the measured throughput of the scanner and
+                  shrinks near the end of the experiment (guided self-scheduling),
+                * PermutationPool: subparts are generated lazily from a seeded pseudo-random
+                  permutation of the (target, ports) space, using constant memory (as masscan does).
+
+             A pool features the following methods:
+                * len(pool): number of ports left to be distributed,
+                * pop(scanner, target, allowed): return a (target, ports) subpart for the given scanner,
+                  preferably on the given target, and only on allowed targets if specified
+                  (None if no subpart is on an allowed target),
+                * targets(): ips of targets having ports left,
+                * push(subpart): give back a subpart that has not been scanned,
+                * record(scanner, nb_ports, duration): update the throughput of a scanner.
+'''
+
+# Imports
+import math
+import random
+
+
+class StaticPool():
+    """ Pool of subparts generated before the experiment """
+
+    def __init__(self, subparts):
+        """ Initialize the pool with a list of (target, ports) subparts """
+        self._subparts = subparts
+        self._nb_ports = sum([len(ports) for target, ports in subparts])
+
+    def __len__(self):
+        """ Number of ports left """
+        return self._nb_ports
+
+    def pop(self, scanner, target=None, allowed=None):
+        """ Return the next subpart
+            It is the last one on target if specified and available,
+            otherwise the last one on an allowed target (if allowed is specified, None if there is none)
+        """
+        index = -1
+        if target is not None:
+            index = self.find(target)
+
+        if allowed is not None and (index == -1 or self._subparts[index][0]['ip'] not in allowed):
+            index = self.find(allowed)
+            if index == -1:
+                return None
+
+        subpart = self._subparts.pop(index)
+        self._nb_ports -= len(subpart[1])
+        return subpart
+
+    def find(self, targets):
+        """ Return the index of the last subpart on the given target (or list of targets), -1 if not found """
+        if not isinstance(targets, (list, set)):
+            targets = [targets]
+
+        for i in range(len(self._subparts) - 1, -1, -1):
+            if self._subparts[i][0]['ip'] in targets:
+                return i
+        return -1
+
+    def targets(self):
+        """ Return ips of targets having ports left """
+        return list(set([target['ip'] for target, ports in self._subparts]))
+
+    def push(self, subpart):
+        """ Give back a subpart """
+        self._subparts.append(subpart)
+        self._nb_ports += len(subpart[1])
+
+    def record(self, scanner, nb_ports, duration):
+        """ Subparts are static, throughput is not used """
+        pass
+
+
+class AdaptivePool():
+    """ Pool of ports from which subparts are cut on demand
+
+        The size of a subpart given to a scanner is:
+            * R / (factor * nb_scanners), with R the number of ports left (guided self-scheduling),
+            * weighted by the throughput of the scanner compared to the mean throughput,
+            * bounded by the number of ports the scanner can scan in target_duration seconds,
+            * bounded by [min_ports, max_ports].
+        While the throughput of a scanner is unknown, its subparts contain at most initial_ports ports.
+    """
+
+    def __init__(self, targets, ports, nb_scanners, min_ports=1, max_ports=0, initial_ports=3,
+                 target_duration=10.0, factor=2.0, smoothing=0.5):
+        """ Initialize per-target port pools
+                - targets: list of target hosts,
+                - ports: list of ports to be scanned on each target,
+                - nb_scanners: number of scanners sharing the pool.
+        """
+        self._nb_scanners = max(1, nb_scanners)
+        self._min_ports = max(1, min_ports)
+        self._max_ports = max_ports
+        self._initial_ports = max(self._min_ports, initial_ports)
+        self._target_duration = float(target_duration)
+        self._factor = float(factor)
+        self._smoothing = float(smoothing)
+
+        # Per-target port pools, ports are shuffled for each target
+        self._targets = {}
+        self._ports = {}
+        for target in targets:
+            target_ports = list(ports)
+            random.shuffle(target_ports, random.random)
+            self._targets[target['ip']] = target
+            self._ports[target['ip']] = target_ports
+
+        self._nb_ports = len(ports) * len(targets)
+
+        # Measured throughput of each scanner (ports per second)
+        self._rates = {}
+
+    def __len__(self):
+        """ Number of ports left """
+        return self._nb_ports
+
+    def subpart_size(self, scanner):
+        """ Compute the number of ports of the next subpart given to a scanner """
+        size = math.ceil(self._nb_ports / (self._factor * self._nb_scanners))
+
+        if scanner in self._rates:
+            # Weight according to the throughput of the scanner
+            rate = self._rates[scanner]
+            mean_rate = sum(self._rates.values()) / len(self._rates)
+            if mean_rate > 0:
+                size = math.ceil(size * rate / mean_rate)
+
+            # A subpart should not last more than target_duration seconds
+            size = min(size, math.ceil(rate * self._target_duration))
+        else:
+            # Unknown scanner, a small subpart is used to measure its throughput
+            size = min(size, self._initial_ports)
+
+        size = max(size, self._min_ports)
+        if self._max_ports:
+            size = min(size, self._max_ports)
+
+        return int(size)
+
+    def pop(self, scanner, target=None, allowed=None):
+        """ Cut a subpart for the given scanner
+            Ports are taken from the given target if it has ports left,
+            otherwise from the (allowed) target having the most ports left (None if there is none)
+        """
+        size = self.subpart_size(scanner)
+
+        if target is not None and len(self._ports.get(target, [])) and (allowed is None or target in allowed):
+            target_ip = target
+        else:
+            targets = [ip for ip in self._ports if len(self._ports[ip]) and (allowed is None or ip in allowed)]
+            if not len(targets):
+                return None
+            remaining = max([len(self._ports[ip]) for ip in targets])
+            candidates = [ip for ip in targets if len(self._ports[ip]) == remaining]
+            target_ip = random.choice(candidates)
+
+        target_ports = self._ports[target_ip]
+        subpart_ports = target_ports[:size]
+        self._ports[target_ip] = target_ports[size:]
+        self._nb_ports -= len(subpart_ports)
+
+        return (self._targets[target_ip], subpart_ports)
+
+    def targets(self):
+        """ Return ips of targets having ports left """
+        return [ip for ip, ports in self._ports.items() if len(ports)]
+
+    def push(self, subpart):
+        """ Give back a subpart, its ports are put back in the target pool """
+        target, ports = subpart
+        self._ports[target['ip']].extend(ports)
+        self._nb_ports += len(ports)
+
+    def record(self, scanner, nb_ports, duration):
+        """ Update the throughput of a scanner after it has scanned nb_ports ports in duration seconds """
+        if duration <= 0 or nb_ports <= 0:
+            return
+
+        rate = nb_ports / float(duration)
+        if scanner in self._rates:
+            rate = self._smoothing * rate + (1 - self._smoothing) * self._rates[scanner]
+        self._rates[scanner] = rate
+
+    def rates(self):
+        """ Return the measured throughput of each scanner """
+        return dict(self._rates)
+
+
+class Permutation():
+    """ Seeded pseudo-random permutation of [0, n)
+        A Feistel network over [0, a*b), with a*b >= n, is applied until the value falls
+        within [0, n) (cycle walking), as done by masscan (blackrock)
+    """
+
+    def __init__(self, n, seed, rounds=4):
+        """ Initialize the permutation of [0, n) """
+        self._n = n
+        self._seed = seed & 0xffffffff
+        self._rounds = rounds
+        self._a = max(1, int(math.ceil(math.sqrt(n))))
+        self._b = max(1, int(math.ceil(n / float(self._a))))
+
+    def __len__(self):
+        return self._n
+
+    def round_function(self, j, r):
+        """ Pseudo-random round function """
+        x = (r * 0x9e3779b1 + j * 0x85ebca6b + self._seed) & 0xffffffff
+        x ^= x >> 16
+        x = (x * 0x7feb352d) & 0xffffffff
+        x ^= x >> 15
+        x = (x * 0x846ca68b) & 0xffffffff
+        x ^= x >> 16
+        return int(x)
+
+    def encrypt(self, m):
+        """ Feistel network over [0, a*b) """
+        a = self._a
+        b = self._b
+        left = m % a
+        right = m // a
+
+        for j in range(1, self._rounds + 1):
+            if j & 1:
+                tmp = (left + self.round_function(j, right)) % a
+            else:
+                tmp = (left + self.round_function(j, right)) % b
+            left = right
+            right = tmp
+
+        if self._rounds & 1:
+            return a * left + right
+        return a * right + left
+
+    def __getitem__(self, m):
+        """ Return the image of m """
+        if m < 0 or m >= self._n:
+            raise IndexError(m)
+
+        c = self.encrypt(m)
+        while c >= self._n:
+            c = self.encrypt(c)
+        return c
+
+
+class PermutationPool():
+    """ Pool generating subparts lazily from a pseudo-random permutation of (target, chunk) couples
+
+        Ports of each target are shuffled by their own permutation and split into chunks
+        of ports_per_subpart ports. The i-th subpart is the chunk given by the permutation
+        of the whole (target, chunk) space, so that nothing is allocated but a small
+        lookahead window, from which preferred or allowed targets are picked.
+    """
+
+    def __init__(self, targets, ports, ports_per_subpart=3, seed=None, window=0):
+        """ Initialize the pool
+                - targets: list of target hosts,
+                - ports: ports to be scanned on each target,
+                - ports_per_subpart: number of ports of a subpart,
+                - seed: seed of the permutation (random if not specified),
+                - window: number of subparts generated in advance (default is 4 per target).
+        """
+        if seed is None:
+            seed = random.getrandbits(32)
+
+        self._targets = targets
+        self._ports = ports
+        self._ports_per_subpart = max(1, ports_per_subpart)
+        self._seed = seed
+
+        self._nb_chunks = int(math.ceil(len(ports) / float(self._ports_per_subpart)))
+        self._order = Permutation(len(targets) * self._nb_chunks, seed)
+        self._port_orders = {} # Per-target permutation of ports, created when needed
+        self._cursor = 0
+
+        self._window_size = window or 4 * len(targets)
+        self._window = []
+        self._nb_ports = len(ports) * len(targets)
+
+    def __len__(self):
+        """ Number of ports left """
+        return self._nb_ports
+
+    def subpart(self, index):
+        """ Return the subpart at the given index of the (target, chunk) space """
+        target_index, chunk = divmod(index, self._nb_chunks)
+
+        if target_index not in self._port_orders:
+            self._port_orders[target_index] = Permutation(len(self._ports), self._seed ^ (target_index * 0x9e3779b1))
+        port_order = self._port_orders[target_index]
+
+        begin = chunk * self._ports_per_subpart
+        end = min(begin + self._ports_per_subpart, len(self._ports))
+        return (self._targets[target_index], [self._ports[port_order[i]] for i in range(begin, end)])
+
+    def fill(self):
+        """ Generate subparts until the lookahead window is full """
+        while len(self._window) < self._window_size and self._cursor < len(self._order):
+            self._window.append(self.subpart(self._order[self._cursor]))
+            self._cursor += 1
+
+    def pop(self, scanner, target=None, allowed=None):
+        """ Return the next subpart of the permutation
+            Only subparts on allowed targets (if specified) are taken from the lookahead window,
+            one on target is preferred if specified. None is returned if no subpart of the window is allowed
+        """
+        self.fill()
+        candidates = range(len(self._window))
+
+        if allowed is not None:
+            if not isinstance(allowed, (list, set)):
+                allowed = [allowed]
+            candidates = [i for i in candidates if self._window[i][0]['ip'] in allowed]
+            if not len(candidates):
+                return None
+
+        index = candidates[0]
+        if target is not None:
+            preferred = [i for i in candidates if self._window[i][0]['ip'] == target]
+            if len(preferred):
+                index = preferred[0]
+
+        subpart = self._window.pop(index)
+        self._nb_ports -= len(subpart[1])
+        return subpart
+
+    def targets(self):
+        """ Return ips of targets having ports left within the lookahead window """
+        self.fill()
+        return list(set([target['ip'] for target, ports in self._window]))
+
+    def push(self, subpart):
+        """ Give back a subpart, it is put at the head of the window """
+        self._window.insert(0, subpart)
+        self._nb_ports += len(subpart[1])
+
+    def record(self, scanner, nb_ports, duration):
+        """ Subparts have a fixed size, throughput is not used """
+        pass
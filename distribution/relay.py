@@ -0,0 +1,309 @@
+'''
+File: relay.py
+Author: Damien Riquet
+Description: Relay sub-coordinator managing a shard of scanners (hierarchical distribution)
+             A relay runs the parallel distribution loop on its own scanners:
+                * work allotments (lists of subparts) are given by the root coordinator,
+                * completion events of its scanners are handled locally,
+                * only allotment completions, detections and aggregated results are sent upward.
+             Firewall alerts are routed by the root coordinator to the relay of the detected scanner.
+
+             RPC methods are (on the endpoint receiving events of scanners):
+                * start(conf): start an experiment on the shard,
+                * allot(allotment_id, subparts): give work to the relay,
+                * finish(): no more allotment will be given, the experiment ends when its work is done,
+                * results(): aggregated results of the last experiment,
+                * ready(): readiness of every scanner of the shard.
+
+             Events sent to the root coordinator are ('relay', relay_ip, kind, value), kind being:
+                * 'allotment': the allotment whose id is value has been scanned,
+                * 'leftovers': every scanner of the shard has been detected, value contains
+                  subparts that could not be scanned,
+                * 'detected': the scanner value has been detected,
+                * 'finished': the experiment is finished, results can be fetched.
+
+             It is launched from the root of the project:
+                python -m distribution.relay -i <ip> -p <port>
+'''
+
+# Imports
+import sys
+import getopt
+import logging
+import threading
+
+# Local imports
+import rpc
+import pools
+import engine
+import distribution # Imports distribution methods (and this module) before parallel, when launched with -m
+import parallel
+from remote import portset
+
+
+# Variables
+logger = logging.getLogger('relay')
+
+
+def encode_subparts(subparts):
+    """ Convert (target, ports) subparts into RPC payloads (ports as a range string) """
+    return [[target, str(portset.PortSet(ports))] for target, ports in subparts]
+
+
+def decode_subparts(items):
+    """ Convert RPC payloads into (target, ports) subparts """
+    return [(target, list(portset.PortSet.parse(ports))) for target, ports in items]
+
+
+class RelayParallel(parallel.Parallel):
+    """ Parallel distribution on a shard of scanners, fed by allotments of the root coordinator """
+
+    def create_pool(self):
+        """ The pool is empty, it is filled by allotments """
+        self._pool = pools.StaticPool([])
+        self._allotments = {} # allotment id -> number of subparts left
+        self._subparts = {} # subpart key -> allotment id
+        self._finished = False
+        self._exhausted = False
+        self._p_root = self._agents.proxy({'ip': self._conf['coordinator'][0], 'port': self._conf['coordinator'][1]})
+        return self._pool
+
+    def running(self, scheduler):
+        """ The experiment runs until the root coordinator has finished it and the work is done """
+        if not self._exhausted and not len(scheduler.active()) and not self._engine.pending():
+            # Every scanner of the shard has been detected, work is given back
+            self._exhausted = True
+            self.give_back()
+
+        return not self._finished or parallel.Parallel.running(self, scheduler)
+
+    def process_event(self, event):
+        """ Process an event sent by an agent or by the root coordinator
+              * work given by the root coordinator, event = ('allotment', allotment_id, subparts)
+              * end of the experiment, event = ('finish',)
+        """
+        if event[0] == 'allotment':
+            self.allotment_received(event[1], decode_subparts(event[2]))
+        elif event[0] == 'finish':
+            self._logger.info("No more allotment")
+            self._finished = True
+        else:
+            parallel.Parallel.process_event(self, event)
+
+    def allotment_received(self, allotment_id, subparts):
+        """ Subparts of an allotment are put in the pool """
+        self._logger.info("Allotment %d received - %d subpart(s)" % (allotment_id, len(subparts)))
+        self._allotments[allotment_id] = len(subparts)
+        for subpart in subparts:
+            self._subparts[self._scheduler.subpart_key(subpart)] = allotment_id
+            self._scheduler.push(subpart)
+
+        if not len(subparts):
+            self.notify('allotment', allotment_id)
+
+        if self._exhausted:
+            self.give_back()
+        else:
+            self.distribute_subparts(self._scheduler)
+
+    def subpart_done(self, subpart):
+        """ The root coordinator is notified when every subpart of an allotment has been scanned """
+        allotment_id = self._subparts.pop(self._scheduler.subpart_key(subpart), None)
+        if allotment_id is None:
+            return
+
+        self._allotments[allotment_id] -= 1
+        if not self._allotments[allotment_id]:
+            del self._allotments[allotment_id]
+            self.notify('allotment', allotment_id)
+
+    def give_back(self):
+        """ Give subparts left in the pool back to the root coordinator """
+        leftovers = []
+        while len(self._pool):
+            leftovers.append(self._pool.pop(None))
+
+        if not len(leftovers):
+            return
+
+        self._logger.info("Every scanner has been detected - %d subpart(s) given back" % len(leftovers))
+        self.notify('leftovers', encode_subparts(leftovers))
+        for subpart in leftovers:
+            self.subpart_done(subpart)
+
+    def scanner_detected(self, alert):
+        """ Detections are also sent upward """
+        detected = len(self._detected_scanners)
+        parallel.Parallel.scanner_detected(self, alert)
+        if len(self._detected_scanners) > detected:
+            self.notify('detected', self._detected_scanners[-1])
+
+    def notify(self, kind, value=None):
+        """ Send an event to the root coordinator (in order) """
+        event = ('relay', self._addr[0], kind, value)
+        self._engine.call('root', self._p_root.add_event, (event,), None,
+                          lambda err: self._logger.warning("Root coordinator cannot be reached (%s)" % err))
+
+    def aggregate(self):
+        """ Return aggregated results of the experiment
+                - portstate: target -> scanner -> state -> ports (range string),
+                - traffic: scanner -> target -> port -> packets sent (flags, seq),
+                - scanners: scheduling statistics of each scanner,
+                - detected: detected scanners.
+        """
+        states = {}
+        for target, ports in self._portstate['scanners'].items():
+            for port, (state, scanner) in ports.items():
+                states.setdefault(target, {}).setdefault(scanner, {}).setdefault(state, portset.PortSet()).add(port)
+
+        portstate = {}
+        for target, scanners in states.items():
+            portstate[target] = {}
+            for scanner, ports_states in scanners.items():
+                portstate[target][scanner] = dict([(state, str(ports)) for state, ports in ports_states.items()])
+
+        traffic = {}
+        for scanner, targets in self._traffic['scanners'].items():
+            traffic[scanner] = {}
+            for target, ports in targets.items():
+                traffic[scanner][target] = dict([(str(port), pkts) for port, pkts in ports.items()])
+
+        return {'portstate': portstate, 'traffic': traffic, 'scanners': self._scanners_stats,
+                'detected': self._detected_scanners}
+
+
+class Relay():
+    """ Relay sub-coordinator, it runs one experiment at a time """
+
+    def __init__(self, addr, timeout=30, workers=16):
+        """ Bind the relay endpoint
+                - addr: (ip, port) of the relay, reachable by scanners and by the root coordinator,
+                - timeout: timeout of RPC calls to scanners and to the root coordinator,
+                - workers: number of threads sending calls.
+        """
+        self._addr = addr
+        self._agents = rpc.ProxyPool(timeout)
+        self._probes = rpc.ProxyPool(timeout) # Readiness probes, sent outside of the experiment thread
+        self._engine = engine.Engine(workers, logger)
+        self._server = rpc.CoordinatorServer(addr, logger)
+        self._experiment = None
+        self._results = None
+        self._scanners = []
+
+        self._server.register(self.start, "start")
+        self._server.register(self.allot, "allot")
+        self._server.register(self.finish, "finish")
+        self._server.register(self.results, "results")
+        self._server.register(self.ready, "ready")
+
+    def start(self, conf):
+        """ RPC method: start an experiment on the shard described by conf (see hierarchical.py) """
+        conf['ports'] = portset.PortSet.parse(conf['ports'])
+        logger.info("Starting experiment (epoch %s) - %d scanner(s)" % (conf.get('epoch'), len(conf['hosts']['scanners'])))
+
+        self._results = None
+        self._scanners = conf['hosts']['scanners']
+        self._experiment = RelayParallel(logger, conf, self._addr, None, self._agents, self._server, self._engine)
+        self._experiment.init_rpc()
+
+        t = threading.Thread(target=self.run_experiment, args=(self._experiment,))
+        t.daemon = True
+        t.start()
+        return True
+
+    def run_experiment(self, experiment):
+        """ Run the experiment, then keep its aggregated results for the root coordinator """
+        try:
+            experiment.run_experiment()
+        finally:
+            experiment.stop_rpc()
+            self._results = experiment.aggregate()
+            experiment.notify('finished')
+            self._engine.flush(experiment.process_event, experiment._conf.get('rpc_timeout', 30))
+            logger.info("Experiment finished")
+
+    def allot(self, allotment_id, subparts):
+        """ RPC method: give an allotment to the running experiment """
+        self._engine.post(('allotment', allotment_id, subparts))
+        return True
+
+    def finish(self):
+        """ RPC method: no more allotment will be given """
+        self._engine.post(('finish',))
+        return True
+
+    def results(self):
+        """ RPC method: aggregated results of the last experiment (None if it is running) """
+        return self._results
+
+    def ready(self):
+        """ RPC method: is every scanner of the shard ready ? """
+        if self._experiment is None:
+            return {'experiment': False}
+
+        state = {}
+        for host in self._scanners:
+            try:
+                state[host['ip']] = all(self._probes.proxy(host).ready().values())
+            except Exception, err:
+                state[host['ip']] = False
+        return state
+
+    def serve_forever(self):
+        """ The endpoint is served by its own thread, wait until the relay is interrupted """
+        self._server._thread.join(3600 * 24 * 365)
+
+
+def usage(name):
+    """ Print usage"""
+    print "Usage: python -m distribution.relay <args>"
+    print "     -h        : print this help"
+    print "     -i <ip>   : IP Address reacheable by scanners and by the root coordinator (default is localhost)"
+    print "     -p <port> : Port used for RPC methods (default is 8000)"
+    print "     -t <secs> : Timeout of RPC calls (default is 30)"
+
+
+if __name__ == '__main__':
+    # Variables
+    addr = ('localhost', 8000)
+    timeout = 30
+
+    # Parsing arguments
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:p:t:h')
+    except getopt.GetoptError, err:
+        print "Bad arguments"
+        print str(err)
+        usage(sys.argv[0])
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-i":
+            addr = (a, addr[1])
+        elif o == "-p":
+            addr = (addr[0], int(a))
+        elif o == "-t":
+            timeout = int(a)
+        elif o == "-h":
+            usage(sys.argv[0])
+            sys.exit(2)
+        else:
+            print "Unknown option"
+
+    # Logging
+    stream_logger = logging.StreamHandler()
+    file_logger = logging.FileHandler("relay.log")
+    logger.addHandler(stream_logger)
+    logger.addHandler(file_logger)
+    stream_logger.setFormatter(logging.Formatter("%(levelname)s\t: %(message)s"))
+    file_logger.setFormatter(logging.Formatter("%(asctime)s %(process)d (%(levelname)s)\t: %(message)s"))
+    logger.setLevel(logging.INFO)
+
+    relay = Relay(addr, timeout)
+
+    # Serving forever
+    try:
+        print "You can stop me at anytime by pressing ^C"
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,298 @@
+'''
+File: results.py
+Author: Damien Riquet
+Description: Durable results store for experiments
+             Each experiment is appended to an embedded SQLite database,
+             so that a whole campaign can be aggregated without parsing log files.
+
+             Stored data are:
+                * experiments: configuration, ASR and timestamps of an experiment,
+                * verdicts: per-port verdict computed by compute_experiment_result,
+                * detections: alerts raised by firewalls during the experiment, and how long
+                  the detected scanner kept running (kill path and detection-to-kill latency),
+                * scanners: per-scanner scheduling statistics (work, busy, idle and queueing time).
+
+             Main methods are:
+                * add_experiment: append an experiment and its results,
+                * experiments: query experiments matching some criteria,
+                * summary: aggregate ASR over experiments sharing the same configuration,
+                * export_csv: export a table into a CSV file.
+'''
+
+# Imports
+import os
+import sys
+import csv
+import json
+import time
+import getopt
+import sqlite3
+
+
+# Variables
+schema = [
+    "CREATE TABLE IF NOT EXISTS experiments ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "campaign TEXT, "
+        "method TEXT, "
+        "scan_method TEXT, "
+        "scan_timing TEXT, "
+        "nb_scanners INTEGER, "
+        "nb_targets INTEGER, "
+        "nb_ports INTEGER, "
+        "conf TEXT, "
+        "asr REAL, "
+        "begin REAL, "
+        "end REAL, "
+        "digest_error_rate REAL)",
+    "CREATE TABLE IF NOT EXISTS verdicts ("
+        "experiment INTEGER REFERENCES experiments(id), "
+        "target TEXT, "
+        "port INTEGER, "
+        "scanner TEXT, "
+        "found_state TEXT, "
+        "real_state TEXT, "
+        "verdict TEXT)",
+    "CREATE TABLE IF NOT EXISTS detections ("
+        "experiment INTEGER REFERENCES experiments(id), "
+        "detected_by TEXT, "
+        "ip_src TEXT, "
+        "ip_dst TEXT, "
+        "date REAL, "
+        "patterns TEXT, "
+        "kill_path TEXT, "
+        "kill_latency REAL)",
+    "CREATE TABLE IF NOT EXISTS scanners ("
+        "experiment INTEGER REFERENCES experiments(id), "
+        "scanner TEXT, "
+        "subparts INTEGER, "
+        "ports INTEGER, "
+        "busy REAL, "
+        "idle REAL, "
+        "queueing REAL, "
+        "throughput REAL)",
+    "CREATE INDEX IF NOT EXISTS verdicts_experiment ON verdicts(experiment)",
+    "CREATE INDEX IF NOT EXISTS detections_experiment ON detections(experiment)",
+    "CREATE INDEX IF NOT EXISTS scanners_experiment ON scanners(experiment)",
+]
+
+# Columns added to existing databases: (table, column, type)
+migrations = [
+    ('detections', 'kill_path', 'TEXT'),
+    ('detections', 'kill_latency', 'REAL'),
+    ('experiments', 'digest_error_rate', 'REAL'),
+]
+
+# Columns that can be used to select or group experiments
+experiment_columns = ['campaign', 'method', 'scan_method', 'scan_timing', 'nb_scanners', 'nb_targets', 'nb_ports']
+
+
+class ResultsStore():
+    """ Append-only store containing results of every experiment """
+
+    def __init__(self, filename):
+        """ Open (and create if needed) the database """
+        self._filename = filename
+
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+
+        with self._db:
+            for statement in schema:
+                self._db.execute(statement)
+
+            for table, column, kind in migrations:
+                columns = [row['name'] for row in self._db.execute("PRAGMA table_info(%s)" % table)]
+                if column not in columns:
+                    self._db.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, kind))
+
+    def close(self):
+        """ Close the database """
+        self._db.close()
+
+
+# ########## Writing
+
+    def add_experiment(self, conf, asr, verdicts, detections, timestamps, scanners=None):
+        """ Append an experiment and its results
+                - conf: experiment configuration (as built by distribution.run),
+                - asr: attacker success rate,
+                - verdicts: list of (target, port, scanner, found_state, real_state, verdict),
+                - detections: list of alerts sent by firewalls,
+                - timestamps: dict containing 'begin' and 'end' of the experiment,
+                - scanners: dict containing scheduling statistics of each scanner (optional).
+            Return the id of the experiment
+        """
+        with self._db:
+            cursor = self._db.execute(
+                    "INSERT INTO experiments (campaign, method, scan_method, scan_timing, "
+                    "nb_scanners, nb_targets, nb_ports, conf, asr, begin, end, digest_error_rate) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (conf.get('campaign'), conf.get('method'), conf['scan_method'], conf['scan_timing'],
+                     conf['nb_scanners'], conf['nb_targets'], len(conf['ports']), json.dumps(conf, default=str),
+                     asr, timestamps.get('begin'), timestamps.get('end'),
+                     conf['digest'].get('error_rate', 0.001) if conf.get('digest') else None))
+            experiment_id = cursor.lastrowid
+
+            self._db.executemany(
+                    "INSERT INTO verdicts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(experiment_id,) + tuple(verdict) for verdict in verdicts])
+
+            self._db.executemany(
+                    "INSERT INTO detections (experiment, detected_by, ip_src, ip_dst, date, patterns, kill_path, kill_latency) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(experiment_id, alert.get('detected_by'), alert.get('ip_src'), alert.get('ip_dst'),
+                      alert.get('date'), ','.join(alert.get('patterns', [])), alert.get('kill_path'),
+                      alert.get('kill_latency')) for alert in detections])
+
+            self._db.executemany(
+                    "INSERT INTO scanners VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(experiment_id, scanner, stats['subparts'], stats['ports'], stats['busy'],
+                      stats['idle'], stats['queueing'], stats['throughput'])
+                     for scanner, stats in sorted((scanners or {}).items())])
+
+        return experiment_id
+
+
+# ########## Querying
+
+    def experiments(self, **criteria):
+        """ Return experiments matching the given criteria
+            For example: store.experiments(method='parallel', scan_timing='insane')
+        """
+        where, values = self.build_where(criteria)
+        rows = self._db.execute("SELECT * FROM experiments%s ORDER BY id" % where, values)
+        return [dict(row) for row in rows]
+
+    def verdicts(self, experiment_id):
+        """ Return per-port verdicts of an experiment """
+        rows = self._db.execute("SELECT * FROM verdicts WHERE experiment = ?", (experiment_id,))
+        return [dict(row) for row in rows]
+
+    def detections(self, experiment_id):
+        """ Return firewall alerts raised during an experiment """
+        rows = self._db.execute("SELECT * FROM detections WHERE experiment = ?", (experiment_id,))
+        return [dict(row) for row in rows]
+
+    def scanners(self, experiment_id):
+        """ Return scheduling statistics of each scanner of an experiment """
+        rows = self._db.execute("SELECT * FROM scanners WHERE experiment = ?", (experiment_id,))
+        return [dict(row) for row in rows]
+
+    def summary(self, group_by=None, **criteria):
+        """ Aggregate ASR of experiments sharing the same configuration
+                - group_by: list of experiment columns (default is every configuration column but campaign),
+                - criteria: restrict the aggregation to some experiments.
+            Return a list of dicts containing group_by values, count, mean, min and max ASR, mean duration
+            and the highest false positive rate of digests (None when traffic has been fully verified)
+        """
+        if group_by is None:
+            group_by = [c for c in experiment_columns if c != 'campaign']
+
+        for column in group_by:
+            if column not in experiment_columns:
+                raise ValueError("Unknown column %s" % column)
+
+        where, values = self.build_where(criteria)
+        columns = ', '.join(group_by)
+        query = "SELECT %s%sCOUNT(*) AS count, AVG(asr) AS asr_mean, MIN(asr) AS asr_min, MAX(asr) AS asr_max, " \
+                "AVG(end - begin) AS duration_mean, MAX(digest_error_rate) AS digest_error_rate FROM experiments%s" \
+                % (columns, ', ' if columns else '', where)
+        if columns:
+            query += " GROUP BY %s ORDER BY %s" % (columns, columns)
+
+        return [dict(row) for row in self._db.execute(query, values)]
+
+    def build_where(self, criteria):
+        """ Build a WHERE clause from criteria on experiment columns """
+        clauses = []
+        values = []
+        for column, value in sorted(criteria.items()):
+            if column not in experiment_columns:
+                raise ValueError("Unknown column %s" % column)
+            clauses.append("%s = ?" % column)
+            values.append(value)
+
+        if not clauses:
+            return "", values
+        return " WHERE %s" % ' AND '.join(clauses), values
+
+
+# ########## Exporting
+
+    def export_csv(self, table, filename):
+        """ Export a whole table into a CSV file """
+        if table not in ['experiments', 'verdicts', 'detections', 'scanners']:
+            raise ValueError("Unknown table %s" % table)
+
+        cursor = self._db.execute("SELECT * FROM %s" % table)
+        with open(filename, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow([d[0] for d in cursor.description])
+            for row in cursor:
+                writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else v for v in row])
+
+
+
+def usage(name):
+    """ Print usage"""
+    print "Usage: python %s <args>" % name
+    print "     -h               : print this help"
+    print "     -d <db>          : Results database (default is log/results.db)"
+    print "     -c <campaign>    : Restrict to a campaign"
+    print "     -s               : Print the ASR summary"
+    print "     -e <table:file>  : Export a table (experiments, verdicts, detections, scanners) into a CSV file"
+
+
+if __name__ == '__main__':
+    # Variables
+    db = "log/results.db"
+    criteria = {}
+    summary = False
+    exports = []
+
+    # Parsing arguments
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:c:se:h')
+    except getopt.GetoptError, err:
+        print "Bad arguments"
+        print str(err)
+        usage(sys.argv[0])
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-d":
+            db = a
+        elif o == "-c":
+            criteria['campaign'] = a
+        elif o == "-s":
+            summary = True
+        elif o == "-e":
+            exports.append(a.split(':', 1))
+        elif o == "-h":
+            usage(sys.argv[0])
+            sys.exit(2)
+        else:
+            print "Unknown option"
+
+    store = ResultsStore(db)
+
+    if summary:
+        begin = time.time()
+        for row in store.summary(**criteria):
+            print "%(method)s %(scan_method)s %(scan_timing)s - %(nb_scanners)d scanner(s) - %(nb_targets)d target(s) " \
+                  "- %(count)d experiment(s) - ASR %(asr_mean).3f [%(asr_min).3f, %(asr_max).3f]" % row,
+            if row['digest_error_rate'] is not None:
+                print "- digest false positive rate %g" % row['digest_error_rate'],
+            print
+        print "Summary computed in %.3fs" % (time.time() - begin)
+
+    for table, filename in exports:
+        store.export_csv(table, filename)
+        print "Table %s exported into %s" % (table, filename)
+
+    store.close()
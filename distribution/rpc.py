@@ -0,0 +1,104 @@
+'''
+File: rpc.py
+Author: Damien Riquet
+Description: RPC services of the coordinator, shared by every experiment of a campaign
+
+             Two services are available:
+                * ProxyPool: one XML-RPC proxy per agent (scanner, firewall or target),
+                  its HTTP connection is kept alive and reused by every call of the campaign,
+                * CoordinatorServer: the coordinator endpoint receiving events from agents,
+                  bound once and attached to the running experiment.
+'''
+
+# Imports
+import threading
+import xmlrpclib
+
+# Local imports
+from remote import rpcserver
+
+
+class ProxyPool():
+    """ Pool of XML-RPC proxies, one per agent """
+
+    def __init__(self, timeout=30):
+        """ Initialize the pool, calls fail after timeout seconds """
+        self._timeout = timeout
+        self._proxies = {} # (ip, port) -> (proxy, transport)
+
+    def proxy(self, host):
+        """ Return the proxy of a host (dict containing 'ip' and 'port'), it is created if needed """
+        key = (host['ip'], host['port'])
+        if key not in self._proxies:
+            transport = rpcserver.TimeoutTransport(self._timeout)
+            proxy = xmlrpclib.ServerProxy("http://%s:%d/" % key, transport=transport, allow_none=True)
+            self._proxies[key] = (proxy, transport)
+        return self._proxies[key][0]
+
+    def proxies(self, hosts):
+        """ Return a dict ip -> proxy of the given hosts """
+        return dict([(host['ip'], self.proxy(host)) for host in hosts])
+
+    def stats(self, hosts=None):
+        """ Return the number of calls and opened connections of each agent (or of the given hosts)
+            'reused' is the number of calls sent through an already opened connection
+        """
+        stats = {}
+        for (ip, port), (proxy, transport) in self._proxies.items():
+            if hosts is not None and ip not in [host['ip'] for host in hosts]:
+                continue
+            stats[ip] = {'requests': transport.requests, 'connections': transport.connections,
+                         'reused': transport.requests - transport.connections}
+        return stats
+
+    def close(self):
+        """ Close every connection """
+        for proxy, transport in self._proxies.values():
+            transport.close()
+        self._proxies = {}
+
+
+class CoordinatorServer():
+    """ Coordinator RPC endpoint, bound for the whole campaign
+        Events sent by agents are given to the attached experiment
+    """
+
+    def __init__(self, addr, logger=None):
+        """ Bind the endpoint and serve it in a thread """
+        self._logger = logger
+        self._handler = None
+        self._dropped = 0
+
+        self._server = rpcserver.ThreadedXMLRPCServer(addr, logRequests=False)
+        self._server.register_function(self.add_event, "add_event")
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register(self, function, name):
+        """ Register another RPC method on the endpoint """
+        self._server.register_function(function, name)
+
+    def attach(self, handler):
+        """ Give received events to handler (add_event method of the running experiment) """
+        self._handler = handler
+
+    def detach(self):
+        """ Received events are dropped until another experiment is attached """
+        self._handler = None
+
+    def add_event(self, event):
+        """ RPC method: give an event to the attached experiment """
+        handler = self._handler
+        if handler is None:
+            self._dropped += 1
+            if self._logger:
+                self._logger.debug("No running experiment, event dropped: %s" % (event,))
+            return
+        handler(event)
+
+    def close(self):
+        """ Stop the endpoint """
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,529 @@
+'''
+File: scheduler.py
+Author: Damien Riquet
+Description: Scheduling policies used to assign subparts to scanners
+
+             A scheduler takes subparts from a pool (see pools.py) and decides
+             which scanner receives which subpart. Up to 'depth' subparts are queued
+             on each scanner, so that a scanner starts its next subpart as soon as
+             the current one is finished. Available policies are:
+                * default: idle scanners receive the next subpart of the pool,
+                * least-loaded: the scanner having the fewest queued ports is served first,
+                * throughput-weighted: the fastest scanner is served first,
+                * locality-aware: a scanner keeps working on the same target to reuse nmap timing state.
+
+             Whatever the policy, limits can be enforced on each target:
+                * max_scanners: maximum number of scanners having work queued on a target,
+                * max_rate: probe-rate budget of a target (ports per second, token bucket of
+                  max_rate * burst ports). Subparts are only cut from targets within their limits,
+                  so that scanners work on other targets instead of waiting.
+
+             Stragglers can be mitigated by speculative re-execution (see enable_speculation):
+             a subpart still running after its deadline is re-dispatched to an idle scanner,
+             the first result wins and the other copy is cancelled.
+
+             Each scheduler reports, for each scanner:
+                * subparts/ports: amount of work assigned to the scanner,
+                * busy: time spent scanning subparts,
+                * idle: time spent without work while the experiment was running,
+                * queueing: time the subparts assigned to the scanner have waited in the pool
+                  and in the scanner queue before being started.
+'''
+
+# Imports
+import time
+
+
+# Variables
+# Expected duration of a portscan for each nmap timing template: (seconds per port, fixed overhead)
+timing_durations = {
+    'paranoid':   (300.0, 300.0),
+    'sneaky':     (15.0, 15.0),
+    'polite':     (0.4, 5.0),
+    'normal':     (0.1, 5.0),
+    'aggressive': (0.05, 2.0),
+    'insane':     (0.02, 2.0),
+}
+timing_names = ['paranoid', 'sneaky', 'polite', 'normal', 'aggressive', 'insane']
+
+
+class Scheduler():
+    """ Default scheduling policy
+        Scanners are served in the order they became idle, with the next subpart of the pool
+    """
+
+    def __init__(self, pool, scanners, depth=1, max_scanners=0, max_rate=0, burst=1.0):
+        """ Initialize the scheduler
+                - pool: pool of subparts,
+                - scanners: ips of scanners taking part in the experiment,
+                - depth: number of subparts queued on each scanner (prefetching),
+                - max_scanners: maximum number of concurrent scanners per target (0 is unlimited),
+                - max_rate: maximum number of ports per second per target (0 is unlimited),
+                - burst: number of seconds of max_rate a target can receive at once.
+        """
+        self._pool = pool
+        self._depth = max(1, depth)
+        self._max_scanners = max_scanners
+        self._max_rate = float(max_rate)
+        self._burst = float(burst)
+        self._begin = time.time()
+        self._end = None
+        self._next_id = 0
+
+        self._active = list(scanners) # Scanners that can receive work
+        self._queues = {} # Subparts queued on each scanner, [scan_id, subpart, dispatch timestamp], the first one is running
+        self._started = {} # When the running subpart of each scanner has been started
+        self._idle = {} # Idle scanners, and since when they are idle
+        self._last_target = {} # Last target scanned by each scanner
+        self._pushed = {} # Subparts given back to the pool, and when
+        self._budgets = {} # Probe-rate budget of each target, [ports, last update timestamp]
+        self._speculation = None # Deadline parameters, None if speculative re-execution is disabled
+        self._twins = {} # scan_id -> scan_id of its speculative copy (both ways)
+        self._cancelled = set() # Scan ids whose results have to be ignored
+        self._targets_stats = {} # Ports dispatched and maximum number of concurrent scanners of each target
+
+        self._stats = {}
+        for scanner in scanners:
+            self._queues[scanner] = []
+            self._idle[scanner] = self._begin
+            self._stats[scanner] = {'subparts': 0, 'ports': 0, 'busy': 0.0, 'idle': 0.0, 'queueing': 0.0,
+                                    'speculated': 0, 'cancelled': 0}
+
+    def __len__(self):
+        """ Number of ports left in the pool """
+        return len(self._pool)
+
+    def pending(self):
+        """ Is there work left that can be assigned to a scanner ? """
+        return len(self._pool) > 0 and len(self._active) > 0
+
+    def active(self):
+        """ Return scanners that can receive work (neither detected nor unreachable) """
+        return list(self._active)
+
+    def running(self, scanner):
+        """ Return the subpart currently scanned by a scanner (None if idle) """
+        if len(self._queues.get(scanner, [])):
+            return self._queues[scanner][0][1]
+        return None
+
+    def queued(self, scanner):
+        """ Return the ids of subparts queued on a scanner (including the running one) """
+        return [scan_id for scan_id, subpart, dispatched in self._queues.get(scanner, [])]
+
+    def outstanding(self, scanner):
+        """ Return the number of ports queued on a scanner (including the running subpart) """
+        return sum([len(subpart[1]) for scan_id, subpart, dispatched in self._queues.get(scanner, [])])
+
+
+# ########## Events
+
+    def dispatch(self):
+        """ Assign subparts to scanners until each active scanner has depth subparts queued
+            Return a list of (scanner, scan_id, subpart)
+        """
+        assignments = []
+        starved = set() # Scanners for which the pool has no subpart on their eligible targets
+
+        while len(self._pool):
+            now = time.time()
+
+            # Scanners that can receive work (on at least one target), the emptiest and longest idle first
+            free = [s for s in self._active if len(self._queues[s]) < self._depth and s not in starved]
+            eligible = dict([(s, self.eligible_targets(s, now)) for s in free])
+            free = [s for s in free if len(eligible[s])]
+            if not len(free):
+                break
+            free.sort(key=lambda s: (len(self._queues[s]), self._idle.get(s, now)))
+
+            scanner = self.select_scanner(free)
+            subpart = self.select_subpart(scanner, eligible[scanner])
+            if subpart is None:
+                starved.add(scanner)
+                continue
+            self.consume_budget(subpart, now)
+            scan_id = self._next_id
+            self._next_id += 1
+
+            # Update statistics
+            stats = self._stats[scanner]
+            stats['queueing'] += now - self._pushed.pop(self.subpart_key(subpart), self._begin)
+            stats['subparts'] += 1
+            stats['ports'] += len(subpart[1])
+
+            if scanner in self._idle:
+                # The scanner starts this subpart right away
+                stats['idle'] += now - self._idle.pop(scanner)
+                self._started[scanner] = now
+
+            self._queues[scanner].append([scan_id, subpart, now])
+            self._last_target[scanner] = subpart[0]['ip']
+            assignments.append((scanner, scan_id, subpart))
+
+            # Update target statistics
+            target_stats = self._targets_stats.setdefault(subpart[0]['ip'], {'ports': 0, 'max_scanners': 0})
+            target_stats['ports'] += len(subpart[1])
+            target_stats['max_scanners'] = max(target_stats['max_scanners'], len(self.target_scanners(subpart[0]['ip'])))
+
+        return assignments
+
+    def completed(self, scanner, scan_id=None):
+        """ A scanner has finished a subpart (the running one if scan_id is not specified)
+            The next queued subpart is started right away by the scanner
+            If the subpart has a speculative copy, the copy is cancelled (first result wins)
+            Return the finished subpart (None if unknown or cancelled)
+        """
+        queue = self._queues.get(scanner, [])
+        index = 0
+        if scan_id is not None:
+            if scan_id in self._cancelled:
+                return None
+            ids = [entry[0] for entry in queue]
+            if scan_id not in ids:
+                return None
+            index = ids.index(scan_id)
+        if not len(queue):
+            return None
+
+        scan_id, subpart = self.finish(scanner, index, True)
+
+        if scan_id in self._twins:
+            self.cancel(self._twins[scan_id])
+
+        return subpart
+
+    def finish(self, scanner, index, record):
+        """ Remove the index-th subpart queued on a scanner and update statistics
+            The throughput of the scanner is updated if record is True
+            Return (scan_id, subpart)
+        """
+        queue = self._queues[scanner]
+        now = time.time()
+        scan_id, subpart, dispatched = queue.pop(index)
+
+        if index == 0:
+            duration = now - self._started.get(scanner, dispatched)
+            self._stats[scanner]['busy'] += duration
+            if record:
+                self._pool.record(scanner, len(subpart[1]), duration)
+
+            if len(queue):
+                # Next subpart has been waiting in the scanner queue
+                self._started[scanner] = now
+                self._stats[scanner]['queueing'] += now - queue[0][2]
+            elif scanner in self._active:
+                self._idle[scanner] = now
+
+        return scan_id, subpart
+
+    def revoke(self, scanner, scan_ids):
+        """ Queued subparts have been revoked from a scanner, they are given back to the pool
+            Return revoked subparts
+        """
+        revoked = []
+        for entry in list(self._queues.get(scanner, [])):
+            if entry[0] in scan_ids:
+                self._queues[scanner].remove(entry)
+                self._stats[scanner]['subparts'] -= 1
+                self._stats[scanner]['ports'] -= len(entry[1][1])
+                self.push(entry[1])
+                revoked.append(entry[1])
+
+        return revoked
+
+    def remove(self, scanner):
+        """ A scanner has been detected (or is unreachable), it does not receive work anymore
+            If its running subpart has a speculative copy, the subpart is cancelled and left to the copy
+            Return the ids of cancelled subparts
+        """
+        if scanner in self._active:
+            self._active.remove(scanner)
+
+        if scanner in self._idle:
+            self._stats[scanner]['idle'] += time.time() - self._idle.pop(scanner)
+
+        running = self._queues.get(scanner, [])
+        if len(running) and running[0][0] in self._twins:
+            scan_id = running[0][0]
+            self.cancel(scan_id)
+            return [scan_id]
+        return []
+
+    def push(self, subpart):
+        """ Give back a subpart that has not been scanned """
+        self._pushed[self.subpart_key(subpart)] = time.time()
+        self._pool.push(subpart)
+
+    def stop(self):
+        """ End of the experiment, account for the time idle scanners are still waiting """
+        self._end = time.time()
+        for scanner, since in self._idle.items():
+            self._stats[scanner]['idle'] += self._end - since
+            self._idle[scanner] = self._end
+
+
+# ########## Speculative re-execution
+
+    def enable_speculation(self, timing, factor=3.0, overhead=None):
+        """ Enable speculative re-execution of late subparts
+                - timing: nmap timing template, used to estimate durations while throughputs are unknown,
+                - factor: a subpart is late after factor times its expected duration,
+                - overhead: fixed time added to deadlines (default depends on the timing template).
+        """
+        if str(timing) in [str(i) for i in range(len(timing_names))]:
+            timing = timing_names[int(timing)]
+        per_port, default_overhead = timing_durations.get(timing, timing_durations['normal'])
+
+        if overhead is None:
+            overhead = default_overhead
+        self._speculation = (per_port, float(factor), float(overhead))
+
+    def deadline(self, scanner, subpart, started):
+        """ Return the deadline of a subpart started by a scanner
+            Expected duration is computed from the throughput of the scanner (or the mean one),
+            or from the timing template if no throughput has been measured yet
+        """
+        per_port, factor, overhead = self._speculation
+        rate = self.throughput(scanner)
+        if rate is None:
+            rates = [r for r in [self.throughput(s) for s in self._stats] if r]
+            if len(rates):
+                rate = sum(rates) / len(rates)
+
+        if rate:
+            expected = len(subpart[1]) / rate
+        else:
+            expected = len(subpart[1]) * per_port
+
+        return started + factor * expected + overhead
+
+    def stragglers(self):
+        """ Return running subparts that are late and have no speculative copy, as (scanner, scan_id, subpart) """
+        if self._speculation is None:
+            return []
+
+        now = time.time()
+        late = []
+        for scanner, queue in self._queues.items():
+            if not len(queue):
+                continue
+            scan_id, subpart, dispatched = queue[0]
+            if scan_id in self._twins:
+                continue
+            if now > self.deadline(scanner, subpart, self._started.get(scanner, dispatched)):
+                late.append((scanner, scan_id, subpart))
+        return late
+
+    def speculate(self, scanner, scan_id):
+        """ Re-dispatch a late subpart to an idle scanner (the fastest one)
+            Return (scanner, scan_id, subpart) of the speculative copy, None if no scanner is idle
+        """
+        idle = [s for s in self._active if s != scanner and not len(self._queues[s])]
+        if not len(idle):
+            return None
+
+        subpart = [entry[1] for entry in self._queues[scanner] if entry[0] == scan_id][0]
+        copy_scanner = max(idle, key=lambda s: self.throughput(s) or 0.0)
+        copy_id = self._next_id
+        self._next_id += 1
+
+        now = time.time()
+        stats = self._stats[copy_scanner]
+        stats['idle'] += now - self._idle.pop(copy_scanner)
+        stats['subparts'] += 1
+        stats['ports'] += len(subpart[1])
+        stats['speculated'] += 1
+        self._started[copy_scanner] = now
+
+        self._queues[copy_scanner].append([copy_id, subpart, now])
+        self._twins[scan_id] = copy_id
+        self._twins[copy_id] = scan_id
+
+        return (copy_scanner, copy_id, subpart)
+
+    def owner(self, scan_id):
+        """ Return the scanner having the given subpart queued (None if unknown) """
+        for scanner, queue in self._queues.items():
+            if scan_id in [entry[0] for entry in queue]:
+                return scanner
+        return None
+
+    def twin(self, scan_id):
+        """ Return (scanner, scan_id) of the speculative copy of a subpart, None if there is none """
+        if scan_id not in self._twins:
+            return None
+        twin_id = self._twins[scan_id]
+        scanner = self.owner(twin_id)
+        if scanner is None:
+            return None
+        return (scanner, twin_id)
+
+    def cancel(self, scan_id):
+        """ Cancel a subpart whose speculative copy has won, its results will be ignored """
+        scanner = self.owner(scan_id)
+        twin_id = self._twins.pop(scan_id, None)
+        self._twins.pop(twin_id, None)
+        self._cancelled.add(scan_id)
+
+        if scanner is None:
+            return
+
+        index = [entry[0] for entry in self._queues[scanner]].index(scan_id)
+        scan_id, subpart = self.finish(scanner, index, False)
+        self._stats[scanner]['subparts'] -= 1
+        self._stats[scanner]['ports'] -= len(subpart[1])
+        self._stats[scanner]['cancelled'] += 1
+
+    def is_cancelled(self, scan_id):
+        """ Has this subpart been cancelled ? """
+        return scan_id in self._cancelled
+
+
+# ########## Target limits
+
+    def target_scanners(self, target):
+        """ Return scanners having work queued on a target """
+        scanners = set()
+        for scanner, queue in self._queues.items():
+            for scan_id, subpart, dispatched in queue:
+                if subpart[0]['ip'] == target:
+                    scanners.add(scanner)
+                    break
+        return scanners
+
+    def budget(self, target, now):
+        """ Return the probe-rate budget (in ports) currently available for a target """
+        capacity = self._max_rate * self._burst
+        ports, last = self._budgets.setdefault(target, [capacity, now])
+        ports = min(capacity, ports + (now - last) * self._max_rate)
+        self._budgets[target] = [ports, now]
+        return ports
+
+    def consume_budget(self, subpart, now):
+        """ A subpart has been cut from a target, consume its probe-rate budget """
+        if self._max_rate:
+            target = subpart[0]['ip']
+            self._budgets[target][0] = self.budget(target, now) - len(subpart[1])
+
+    def eligible_targets(self, scanner, now):
+        """ Return targets having ports left on which the scanner can be given work without exceeding limits """
+        targets = self._pool.targets()
+        if not self._max_scanners and not self._max_rate:
+            return targets
+
+        eligible = []
+        for target in targets:
+            if self._max_scanners:
+                scanners = self.target_scanners(target)
+                if scanner not in scanners and len(scanners) >= self._max_scanners:
+                    continue
+            if self._max_rate and self.budget(target, now) <= 0:
+                continue
+            eligible.append(target)
+
+        return eligible
+
+
+# ########## Policy
+
+    def select_scanner(self, free):
+        """ Select the scanner to be served among scanners that can receive work
+            (sorted by number of queued subparts, then by idle time)
+        """
+        return free[0]
+
+    def select_subpart(self, scanner, targets):
+        """ Select the subpart given to a scanner among eligible targets (None if the pool has none) """
+        if not self._max_scanners and not self._max_rate:
+            return self._pool.pop(scanner)
+        return self._pool.pop(scanner, allowed=targets)
+
+
+# ########## Report
+
+    def throughput(self, scanner):
+        """ Measured throughput of a scanner (ports per second), None if unknown """
+        stats = self._stats[scanner]
+        if stats['busy'] <= 0:
+            return None
+        return stats['ports'] / stats['busy']
+
+    def report(self):
+        """ Return statistics of each scanner """
+        report = {}
+        for scanner, stats in self._stats.items():
+            report[scanner] = dict(stats)
+            report[scanner]['throughput'] = self.throughput(scanner)
+        return report
+
+    def targets_report(self):
+        """ Return statistics of each target: ports dispatched, maximum number of concurrent scanners
+            and mean rate (ports per second) over the experiment
+        """
+        duration = (self._end or time.time()) - self._begin
+        report = {}
+        for target, stats in self._targets_stats.items():
+            report[target] = dict(stats)
+            report[target]['rate'] = stats['ports'] / duration if duration > 0 else None
+        return report
+
+    def subpart_key(self, subpart):
+        """ Hashable key identifying a subpart """
+        return (subpart[0]['ip'], tuple(subpart[1]))
+
+
+class LeastLoaded(Scheduler):
+    """ The scanner having the fewest queued ports is served first, then the one that has received the fewest ports """
+
+    def select_scanner(self, free):
+        return min(free, key=lambda s: (self.outstanding(s), self._stats[s]['ports']))
+
+
+class ThroughputWeighted(Scheduler):
+    """ The fastest scanner is served first
+        Scanners whose throughput is unknown are served before to be measured
+    """
+
+    def select_scanner(self, free):
+        unknown = [s for s in free if self.throughput(s) is None]
+        if len(unknown):
+            return unknown[0]
+        return max(free, key=self.throughput)
+
+
+class LocalityAware(Scheduler):
+    """ A scanner keeps working on the same target, so that nmap can reuse its timing state
+        When its target has no ports left, it moves to the target having the fewest running scanners
+    """
+
+    def select_subpart(self, scanner, targets):
+        target = self._last_target.get(scanner)
+
+        if target not in targets:
+            # Count subparts queued on scanners per target
+            load = dict([(t, 0) for t in targets])
+            for queue in self._queues.values():
+                for scan_id, subpart, dispatched in queue:
+                    if subpart[0]['ip'] in load:
+                        load[subpart[0]['ip']] += 1
+            target = min(targets, key=lambda t: load[t])
+
+        return self._pool.pop(scanner, target, targets)
+
+
+# Available policies
+policies = {
+    'default': Scheduler,
+    'least-loaded': LeastLoaded,
+    'throughput-weighted': ThroughputWeighted,
+    'locality-aware': LocalityAware,
+}
+
+
+def create_scheduler(policy, pool, scanners, depth=1, **limits):
+    """ Create a scheduler using the given policy
+            - limits: target limits (max_scanners, max_rate, burst)
+    """
+    if policy not in policies:
+        raise ValueError("Unknown scheduling policy %s" % policy)
+    return policies[policy](pool, scanners, depth, **limits)
@@ -0,0 +1,164 @@
+'''
+File: test_pools.py
+Author: Damien Riquet
+Description: Unit tests of pools.py
+
+             It has to be launched from the root of the project:
+                python -m unittest distribution.test_pools
+'''
+
+# Imports
+import random
+import unittest
+
+# Local imports
+import pools
+
+
+# Variables
+targets = [{'ip': '10.0.1.%d' % i, 'port': 9000} for i in range(1, 4)]
+
+
+def drain(pool, scanner='10.0.0.1'):
+    """ Pop every subpart of a pool, return (target ip, port) couples """
+    scanned = []
+    while len(pool):
+        target, ports = pool.pop(scanner)
+        scanned.extend([(target['ip'], port) for port in ports])
+    return scanned
+
+
+class PermutationTest(unittest.TestCase):
+
+    def test_bijection(self):
+        # Perfect squares, primes, a*b > n and tiny domains
+        for n in [1, 2, 3, 7, 16, 17, 100, 101, 1000, 4093, 65535]:
+            for seed in [0, 1, 0xdeadbeef]:
+                permutation = pools.Permutation(n, seed)
+                self.assertEqual(sorted([permutation[m] for m in range(n)]), range(n))
+
+    def test_odd_rounds(self):
+        permutation = pools.Permutation(1000, 42, rounds=3)
+        self.assertEqual(sorted([permutation[m] for m in range(1000)]), range(1000))
+
+    def test_seed(self):
+        a = [pools.Permutation(1000, 1)[m] for m in range(1000)]
+        b = [pools.Permutation(1000, 1)[m] for m in range(1000)]
+        c = [pools.Permutation(1000, 2)[m] for m in range(1000)]
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+        self.assertNotEqual(a, range(1000))
+
+    def test_bounds(self):
+        permutation = pools.Permutation(10, 0)
+        self.assertEqual(len(permutation), 10)
+        self.assertRaises(IndexError, permutation.__getitem__, 10)
+        self.assertRaises(IndexError, permutation.__getitem__, -1)
+
+
+class PermutationPoolTest(unittest.TestCase):
+
+    def test_coverage(self):
+        ports = range(1, 101)
+        for ports_per_subpart in [1, 3, 7, 100, 200]:
+            pool = pools.PermutationPool(targets, ports, ports_per_subpart, seed=7)
+            self.assertEqual(len(pool), 300)
+            scanned = drain(pool)
+            self.assertEqual(len(scanned), 300)
+            self.assertEqual(set(scanned), set([(t['ip'], p) for t in targets for p in ports]))
+
+    def test_preferred_target(self):
+        pool = pools.PermutationPool(targets, range(1, 101), 5, seed=7)
+        for i in range(4):
+            self.assertEqual(pool.pop('10.0.0.1', '10.0.1.2')[0]['ip'], '10.0.1.2')
+        self.assertEqual(pool.pop('10.0.0.1', None, ['10.0.1.3'])[0]['ip'], '10.0.1.3')
+        # Only targets of the lookahead window are known
+        self.assertTrue(set(pool.targets()) <= set([t['ip'] for t in targets]))
+
+    def test_not_allowed(self):
+        pool = pools.PermutationPool(targets, range(1, 101), 5, seed=7, window=2)
+        pool.fill()
+        window = [subpart[0]['ip'] for subpart in pool._window]
+        excluded = [t['ip'] for t in targets if t['ip'] not in window]
+
+        # A preferred target is not taken if it is not allowed
+        subpart = pool.pop('10.0.0.1', window[0], window[1:])
+        self.assertEqual(subpart[0]['ip'], window[1])
+
+        # Nothing allowed in the window
+        self.assertEqual(pool.pop('10.0.0.1', excluded[0], excluded), None)
+        self.assertEqual(len(pool), 295)
+
+    def test_push(self):
+        pool = pools.PermutationPool(targets, range(1, 101), 5, seed=7)
+        subpart = pool.pop('10.0.0.1')
+        pool.push(subpart)
+        self.assertEqual(len(pool), 300)
+        self.assertEqual(pool.pop('10.0.0.2'), subpart)
+
+
+class StaticPoolTest(unittest.TestCase):
+
+    def test_pop(self):
+        subparts = [(target, [port]) for target in targets for port in range(1, 4)]
+        pool = pools.StaticPool(list(subparts))
+        self.assertEqual(len(pool), 9)
+        self.assertEqual(pool.pop('10.0.0.1', '10.0.1.1'), (targets[0], [3]))
+        self.assertEqual(pool.pop('10.0.0.1', '10.0.1.1', ['10.0.1.2'])[0]['ip'], '10.0.1.2')
+        self.assertEqual(len(pool), 7)
+        self.assertEqual(len(drain(pool)), 7)
+
+    def test_not_allowed(self):
+        pool = pools.StaticPool([(targets[0], [1]), (targets[1], [2])])
+        self.assertEqual(pool.pop('10.0.0.1', '10.0.1.1', ['10.0.1.3']), None)
+        self.assertEqual(pool.pop('10.0.0.1', None, ['10.0.1.3']), None)
+        self.assertEqual(len(pool), 2)
+
+
+class AdaptivePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_coverage(self):
+        pool = pools.AdaptivePool(targets, range(1, 101), 4)
+        pool.record('10.0.0.2', 50, 1.0)
+        scanned = drain(pool, '10.0.0.2')
+        self.assertEqual(sorted(scanned), sorted([(t['ip'], p) for t in targets for p in range(1, 101)]))
+
+    def test_subpart_size(self):
+        pool = pools.AdaptivePool(targets, range(1, 101), 4, initial_ports=3, target_duration=10.0)
+        # Unknown scanner: initial_ports
+        self.assertEqual(pool.subpart_size('10.0.0.1'), 3)
+
+        # R / (factor * nb_scanners), weighted by throughput
+        pool.record('10.0.0.1', 100, 1.0)
+        pool.record('10.0.0.2', 300, 1.0)
+        self.assertEqual(pool.subpart_size('10.0.0.1'), 19)
+        self.assertEqual(pool.subpart_size('10.0.0.2'), 57)
+
+        # At most target_duration seconds of work
+        pool = pools.AdaptivePool(targets, range(1, 101), 4, target_duration=10.0)
+        pool.record('10.0.0.1', 2, 1.0)
+        self.assertEqual(pool.subpart_size('10.0.0.1'), 20)
+
+    def test_not_allowed(self):
+        pool = pools.AdaptivePool(targets[:2], range(1, 11), 4)
+        self.assertEqual(pool.pop('10.0.0.1', '10.0.1.1', ['10.0.1.3']), None)
+        self.assertEqual(len(pool), 20)
+
+        # Targets without ports left are not allowed either
+        while len(pool.targets()) > 1:
+            pool.pop('10.0.0.1', '10.0.1.1')
+        self.assertEqual(pool.pop('10.0.0.1', None, ['10.0.1.1']), None)
+
+    def test_record_smoothing(self):
+        pool = pools.AdaptivePool(targets, range(1, 101), 4, smoothing=0.5)
+        pool.record('10.0.0.1', 10, 1.0)
+        pool.record('10.0.0.1', 30, 1.0)
+        pool.record('10.0.0.1', 30, 0)
+        self.assertEqual(pool.rates(), {'10.0.0.1': 20.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+'''
+File: test_relay.py
+Author: Damien Riquet
+Description: Unit tests of the encoding of allotments exchanged with relays (relay.py)
+
+             It has to be launched from the root of the project:
+                python -m unittest distribution.test_relay
+'''
+
+# Imports
+import unittest
+import xmlrpclib
+
+# Local imports
+import relay
+
+
+# Variables
+target = {'ip': '10.0.1.1', 'port': 9000}
+
+
+class SubpartsTest(unittest.TestCase):
+
+    def test_ranges(self):
+        subparts = [(target, [80, 22, 23, 24, 443]), (target, [8080])]
+        self.assertEqual(relay.encode_subparts(subparts), [[target, "22-24,80,443"], [target, "8080"]])
+
+    def test_round_trip(self):
+        subparts = [(target, range(1, 1001)), (target, [1, 3, 5, 65535]), (target, [])]
+        self.assertEqual(relay.decode_subparts(relay.encode_subparts(subparts)), subparts)
+
+    def test_xmlrpc(self):
+        # Allotments are sent to relays through XML-RPC
+        subparts = [(target, [22, 80, 81, 82])]
+        data = xmlrpclib.dumps((relay.encode_subparts(subparts),), 'allot')
+        self.assertEqual(relay.decode_subparts(xmlrpclib.loads(data)[0][0]), subparts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+'''
+File: test_results.py
+Author: Damien Riquet
+Description: Unit tests of results.py, including the migration of databases created by previous versions
+
+             It has to be launched from the root of the project:
+                python -m unittest distribution.test_results
+'''
+
+# Imports
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# Local imports
+import results
+
+
+# Variables
+# Schema of databases created before kill paths and digests were recorded
+old_schema = [
+    "CREATE TABLE experiments (id INTEGER PRIMARY KEY AUTOINCREMENT, campaign TEXT, method TEXT, scan_method TEXT, "
+        "scan_timing TEXT, nb_scanners INTEGER, nb_targets INTEGER, nb_ports INTEGER, conf TEXT, asr REAL, "
+        "begin REAL, end REAL)",
+    "CREATE TABLE verdicts (experiment INTEGER REFERENCES experiments(id), target TEXT, port INTEGER, "
+        "scanner TEXT, found_state TEXT, real_state TEXT, verdict TEXT)",
+    "CREATE TABLE detections (experiment INTEGER REFERENCES experiments(id), detected_by TEXT, ip_src TEXT, "
+        "ip_dst TEXT, date REAL, patterns TEXT)",
+    "INSERT INTO experiments VALUES (1, 'old', 'parallel', '-sS', 'insane', 2, 1, 10, '{}', 0.5, 0.0, 10.0)",
+    "INSERT INTO detections VALUES (1, '10.0.2.1', '10.0.0.1', '10.0.1.1', 5.0, 'portscan')",
+]
+
+
+def experiment_conf(**values):
+    """ Configuration of an experiment (as built by distribution.run) """
+    conf = {'campaign': 'new', 'method': 'parallel', 'scan_method': '-sS', 'scan_timing': 'insane',
+            'nb_scanners': 2, 'nb_targets': 1, 'ports': range(1, 11)}
+    conf.update(values)
+    return conf
+
+
+class ResultsStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'log', 'results.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def columns(self, store, table):
+        return [row['name'] for row in store._db.execute("PRAGMA table_info(%s)" % table)]
+
+    def test_migration(self):
+        os.makedirs(os.path.dirname(self.filename))
+        db = sqlite3.connect(self.filename)
+        with db:
+            for statement in old_schema:
+                db.execute(statement)
+        db.close()
+
+        store = results.ResultsStore(self.filename)
+        for table, column, kind in results.migrations:
+            self.assertTrue(column in self.columns(store, table))
+        self.assertTrue('scanners' in [row[0] for row in store._db.execute("SELECT name FROM sqlite_master")])
+
+        # Previous rows are kept, new columns are NULL
+        self.assertEqual(store.experiments()[0]['digest_error_rate'], None)
+        detection = store.detections(1)[0]
+        self.assertEqual((detection['ip_src'], detection['kill_path'], detection['kill_latency']), ('10.0.0.1', None, None))
+
+        # New experiments are stored next to old ones
+        alert = {'detected_by': '10.0.2.1', 'ip_src': '10.0.0.2', 'ip_dst': '10.0.1.1', 'date': 6.0,
+                 'patterns': ['portscan'], 'kill_path': 'firewall', 'kill_latency': 0.2}
+        experiment_id = store.add_experiment(experiment_conf(digest={'error_rate': 0.01}), 0.8, [], [alert],
+                                             {'begin': 0.0, 'end': 20.0})
+        self.assertEqual(store.detections(experiment_id)[0]['kill_latency'], 0.2)
+        self.assertEqual([e['campaign'] for e in store.experiments(method='parallel')], ['old', 'new'])
+        store.close()
+
+        # Migration is done once
+        store = results.ResultsStore(self.filename)
+        self.assertEqual(self.columns(store, 'detections').count('kill_path'), 1)
+        self.assertEqual(len(store.experiments()), 2)
+        store.close()
+
+    def test_add_experiment(self):
+        store = results.ResultsStore(self.filename)
+        verdicts = [('10.0.1.1', 22, '10.0.0.1', 'open', 'open', 'success'),
+                    ('10.0.1.1', 23, '10.0.0.2', 'closed', 'open', 'failure')]
+        scanners = {'10.0.0.1': {'subparts': 1, 'ports': 1, 'busy': 1.0, 'idle': 0.0, 'queueing': 0.1, 'throughput': 1.0}}
+        experiment_id = store.add_experiment(experiment_conf(), 0.5, verdicts, [], {'begin': 0.0, 'end': 10.0}, scanners)
+
+        self.assertEqual([(v['port'], v['verdict']) for v in store.verdicts(experiment_id)], [(22, 'success'), (23, 'failure')])
+        self.assertEqual(store.scanners(experiment_id)[0]['throughput'], 1.0)
+        self.assertEqual(store.experiments()[0]['nb_ports'], 10)
+        store.close()
+
+    def test_summary(self):
+        store = results.ResultsStore(self.filename)
+        for asr in [0.2, 0.4]:
+            store.add_experiment(experiment_conf(), asr, [], [], {'begin': 0.0, 'end': 10.0})
+        store.add_experiment(experiment_conf(nb_scanners=4), 1.0, [], [], {'begin': 0.0, 'end': 10.0})
+
+        summary = store.summary(['nb_scanners'])
+        self.assertEqual([(row['nb_scanners'], row['count']) for row in summary], [(2, 2), (4, 1)])
+        self.assertAlmostEqual(summary[0]['asr_mean'], 0.3)
+        self.assertRaises(ValueError, store.summary, ['conf'])
+        self.assertRaises(ValueError, store.experiments, asr=1.0)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+'''
+File: test_scheduler.py
+Author: Damien Riquet
+Description: Unit tests of scheduler.py
+
+             It has to be launched from the root of the project:
+                python -m unittest distribution.test_scheduler
+'''
+
+# Imports
+import unittest
+
+# Local imports
+import pools
+import scheduler
+
+
+# Variables
+targets = [{'ip': '10.0.1.%d' % i, 'port': 9000} for i in range(1, 3)]
+scanners = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+
+def static_pool(nb_ports=10, ports_per_subpart=1):
+    """ Static pool of subparts alternating between targets """
+    subparts = []
+    for begin in range(1, nb_ports + 1, ports_per_subpart):
+        for target in targets:
+            subparts.append((target, range(begin, min(begin + ports_per_subpart, nb_ports + 1))))
+    subparts.reverse()
+    return pools.StaticPool(subparts)
+
+
+class PrefetchingTest(unittest.TestCase):
+
+    def test_depth(self):
+        s = scheduler.create_scheduler('default', static_pool(), scanners, depth=2)
+        assignments = s.dispatch()
+        self.assertEqual(len(assignments), 6)
+        self.assertEqual([len(s.queued(scanner)) for scanner in scanners], [2, 2, 2])
+        self.assertEqual(len(s), 14)
+        self.assertEqual(s.dispatch(), [])
+
+        # Completion of the running subpart frees one slot
+        scanner, scan_id, subpart = assignments[0]
+        self.assertEqual(s.running(scanner), subpart)
+        self.assertEqual(s.completed(scanner), subpart)
+        self.assertEqual([a[0] for a in s.dispatch()], [scanner])
+
+    def test_unknown_completion(self):
+        s = scheduler.create_scheduler('default', static_pool(), scanners)
+        s.dispatch()
+        self.assertEqual(s.completed('10.0.0.1', 1000), None)
+        self.assertEqual(s.completed('10.0.0.9'), None)
+
+    def test_revoke_remove(self):
+        s = scheduler.create_scheduler('default', static_pool(), scanners, depth=2)
+        s.dispatch()
+        queued = s.queued('10.0.0.1')
+        s.remove('10.0.0.1')
+        revoked = s.revoke('10.0.0.1', queued[1:])
+        self.assertEqual(len(revoked), 1)
+        self.assertEqual(len(s), 15)
+        self.assertEqual(s.active(), scanners[1:])
+        self.assertFalse('10.0.0.1' in [a[0] for a in s.dispatch()])
+        self.assertEqual(s.report()['10.0.0.1']['subparts'], 1)
+
+
+class PoliciesTest(unittest.TestCase):
+
+    def test_least_loaded(self):
+        s = scheduler.create_scheduler('least-loaded', static_pool(20, 5), scanners, depth=2)
+        s.dispatch()
+        for i in range(2):
+            s.completed('10.0.0.2')
+        # The emptiest scanner is served first
+        self.assertEqual([a[0] for a in s.dispatch()], ['10.0.0.2', '10.0.0.2'])
+
+    def test_throughput_weighted(self):
+        s = scheduler.create_scheduler('throughput-weighted', static_pool(), scanners)
+        s.dispatch()
+        s._stats['10.0.0.1']['busy'] = 10.0
+        s._stats['10.0.0.2']['busy'] = 1.0
+        s._stats['10.0.0.3']['busy'] = 5.0
+        for scanner in scanners:
+            s._queues[scanner] = []
+        self.assertEqual(s.dispatch()[0][0], '10.0.0.2')
+
+    def test_throughput_unknown_first(self):
+        s = scheduler.create_scheduler('throughput-weighted', static_pool(), scanners)
+        s._stats['10.0.0.1']['busy'] = 1.0
+        s._stats['10.0.0.1']['ports'] = 100
+        self.assertEqual(s.dispatch()[0][0], '10.0.0.2')
+
+    def test_locality_aware(self):
+        s = scheduler.create_scheduler('locality-aware', static_pool(), scanners[:2])
+        first = dict([(scanner, subpart[0]['ip']) for scanner, scan_id, subpart in s.dispatch()])
+        # Scanners are spread over targets, then keep their target
+        self.assertEqual(sorted(first.values()), [t['ip'] for t in targets])
+        for i in range(5):
+            for scanner in scanners[:2]:
+                s.completed(scanner)
+            for scanner, scan_id, subpart in s.dispatch():
+                self.assertEqual(subpart[0]['ip'], first[scanner])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, scheduler.create_scheduler, 'random', static_pool(), scanners)
+
+
+class StalePool(pools.StaticPool):
+    """ Static pool reporting every target, even without subparts left (as a lookahead window can) """
+
+    def targets(self):
+        return [target['ip'] for target in targets]
+
+
+class LimitsTest(unittest.TestCase):
+
+    def test_max_scanners(self):
+        s = scheduler.create_scheduler('default', static_pool(), scanners, depth=2, max_scanners=1)
+        assignments = s.dispatch()
+        # One scanner per target, the third one stays idle
+        self.assertEqual(len(set([a[0] for a in assignments])), 2)
+        for target in targets:
+            self.assertEqual(len(s.target_scanners(target['ip'])), 1)
+
+    def test_max_rate(self):
+        s = scheduler.create_scheduler('default', static_pool(), scanners, depth=10, max_rate=2.5, burst=1.0)
+        # Budget of max_rate * burst ports per target, subparts are cut while it is positive
+        self.assertEqual(len(s.dispatch()), 6)
+        self.assertEqual(s.targets_report()[targets[0]['ip']]['ports'], 3)
+        self.assertEqual(s.dispatch(), [])
+
+    def test_no_allowed_subpart(self):
+        # Only the first target has subparts left, and its budget is exhausted
+        s = scheduler.create_scheduler('default', StalePool([(targets[0], [port]) for port in range(1, 5)]), scanners,
+                                       max_rate=1.5, burst=1.0)
+        self.assertEqual([a[2][0]['ip'] for a in s.dispatch()], [targets[0]['ip']] * 2)
+        self.assertEqual(s.dispatch(), [])
+        self.assertEqual(len(s), 2)
+
+
+class SpeculationTest(unittest.TestCase):
+
+    def test_speculate(self):
+        s = scheduler.create_scheduler('default', static_pool(2), scanners)
+        self.assertEqual(s.stragglers(), [])
+        s.enable_speculation('insane', factor=1.0, overhead=-10.0)
+        s.dispatch()
+        s.completed('10.0.0.3')
+
+        late = s.stragglers()
+        self.assertEqual(len(late), 2)
+        scanner, scan_id, subpart = late[0]
+        copy_scanner, copy_id, copy = s.speculate(scanner, scan_id)
+        self.assertEqual((copy_scanner, copy), ('10.0.0.3', subpart))
+        self.assertEqual(s.twin(scan_id), (copy_scanner, copy_id))
+        self.assertEqual(s.speculate(late[1][0], late[1][1]), None)
+
+        # First result wins, the other copy is cancelled
+        self.assertEqual(s.completed(copy_scanner, copy_id), subpart)
+        self.assertTrue(s.is_cancelled(scan_id))
+        self.assertEqual(s.completed(scanner, scan_id), None)
+        self.assertEqual(s.report()[scanner]['cancelled'], 1)
+        self.assertEqual(s.report()[copy_scanner]['speculated'], 1)
+
+    def test_deadline(self):
+        s = scheduler.create_scheduler('default', static_pool(), scanners)
+        s.enable_speculation('5', factor=2.0)
+        # Timing template: 0.02s per port and 2s of overhead
+        self.assertAlmostEqual(s.deadline('10.0.0.1', (targets[0], range(100)), 10.0), 10.0 + 2 * 2.0 + 2.0)
+
+        # Measured throughput of the scanner, or the mean one
+        s._stats['10.0.0.2']['busy'] = 1.0
+        s._stats['10.0.0.2']['ports'] = 50
+        self.assertAlmostEqual(s.deadline('10.0.0.1', (targets[0], range(50)), 10.0), 10.0 + 2 * 1.0 + 2.0)
+        self.assertAlmostEqual(s.deadline('10.0.0.2', (targets[0], range(10)), 0.0), 2 * 0.2 + 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
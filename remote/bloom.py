@@ -0,0 +1,100 @@
+'''
+File: bloom.py
+Author: Damien Riquet
+Description: Bloom filter used as a digest of the traffic received by a target
+             Instead of sending every (flags, seq) packet to the coordinator, a target inserts
+             a key per received packet (see packet_key) and only sends the filter.
+             The coordinator tests each packet sent by scanners against it.
+
+             Membership tests can return false positives (a lost packet is seen as received),
+             never false negatives. The filter is sized for a capacity and an error rate:
+                * m = -n * ln(p) / ln(2)^2 bits,
+                * k = m / n * ln(2) hash functions,
+             positions are derived from one md5 digest (double hashing).
+'''
+
+# Imports
+import math
+import struct
+import hashlib
+import xmlrpclib
+
+
+def packet_key(scanner, port, flags, seq=None):
+    """ Key of a packet received by a target from a scanner, seq is omitted when it is not known (-sT) """
+    if seq is None:
+        return "%s:%d:%s" % (scanner, int(port), flags)
+    return "%s:%d:%s:%s" % (scanner, int(port), flags, seq)
+
+
+class BloomFilter():
+    """ Bloom filter stored in a bytearray """
+
+    def __init__(self, capacity, error_rate=0.001, size=None, hashes=None):
+        """ Create a filter sized for capacity keys and the given false positive rate
+            size (bits) and hashes can be given explicitly (see load)
+        """
+        capacity = max(int(capacity), 1)
+        if size is None:
+            size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        if hashes is None:
+            hashes = max(int(round(float(size) / capacity * math.log(2))), 1)
+
+        self._size = max(size, 8)
+        self._hashes = hashes
+        self._error_rate = error_rate
+        self._count = 0
+        self._bits = bytearray((self._size + 7) / 8)
+
+    @classmethod
+    def load(cls, value):
+        """ Create a filter from its serialized form (see dump) """
+        bloom = cls(value['count'], value['error_rate'], value['size'], value['hashes'])
+        bloom._bits = bytearray(value['bits'].data)
+        bloom._count = value['count']
+        return bloom
+
+    def dump(self):
+        """ Serialized form of this filter (xmlrpc compatible) """
+        return {'size': self._size, 'hashes': self._hashes, 'error_rate': self._error_rate,
+                'count': self._count, 'bits': xmlrpclib.Binary(str(self._bits))}
+
+
+# ########## Set operations
+
+    def positions(self, key):
+        """ Bits of the given key """
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self._size for i in range(self._hashes)]
+
+    def add(self, key):
+        """ Insert a key """
+        for position in self.positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        """ Number of inserted keys """
+        return self._count
+
+
+# ########## Statistics
+
+    def nbytes(self):
+        """ Size of the filter in bytes """
+        return len(self._bits)
+
+    def error_rate(self):
+        """ Configured false positive rate """
+        return self._error_rate
+
+    def estimated_error_rate(self):
+        """ False positive rate according to the fill ratio of the filter """
+        nb_set = sum([bin(byte).count('1') for byte in self._bits])
+        return (float(nb_set) / self._size) ** self._hashes
@@ -0,0 +1,606 @@
+'''
+File: capture.py
+Author: Damien Riquet
+Description: Multi-process packet capture used by targets (fanout mode)
+             Several AF_PACKET sockets join the same PACKET_FANOUT group, the kernel balances
+             received packets between them (hash of the flow), so that every packet of a flow
+             is received by the same worker. Each socket is drained by its own process, which
+             decodes TCP headers itself (no scapy) and keeps its own traffic store.
+             Stores of every worker are merged when the traffic is fetched.
+
+             Workers are driven through a pipe:
+                * ('epoch', epoch, ips): advance the epoch and update monitored ips,
+                * ('traffic', epoch): return the traffic captured during the given epoch,
+                * ('stats',): return capture statistics (received, kept, kernel drops),
+                * ('spill', epoch): return (filename, length) of the capture file of an epoch (ring mode),
+                * ('stop',): close the socket and exit.
+
+             Ring mode: each worker reads a memory mapped TPACKET_V3 receive ring, and writes
+             kept packets (headers only) into a memory mapped, append-only pcap file per epoch.
+             Nothing is kept in memory: capture files are decoded when the traffic is fetched,
+             and remain available for later analysis.
+
+             A local traffic generator is included, to measure the sustained capture rate
+             and drop counts (must be run as root):
+                python capture.py -d lo -w 4 -n 200000
+                python capture.py -d lo -w 1 -n 200000 -m ring -o /tmp/capture
+'''
+
+# Imports
+import os
+import sys
+import time
+import select
+import socket
+import struct
+import mmap
+import getopt
+import threading
+import multiprocessing
+
+
+# Variables
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+PACKET_STATISTICS = 6
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+PACKET_FANOUT_HASH = 0x0
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+PACKET_OUTGOING = 4
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+
+tcp_flags = "FSRPAUEC" # TCP flags, named as scapy does (bit 0 first)
+
+
+def fanout_socket(iface, group, rcvbuf=4 << 20):
+    """ Open an AF_PACKET socket bound to iface, member of the given fanout group (hash by flow)
+        Its receive buffer absorbs bursts while the worker is busy
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((iface, ETH_P_ALL))
+    mode = PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_DEFRAG
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT, struct.pack("I", (group & 0xffff) | (mode << 16)))
+    return sock
+
+
+def socket_stats(sock):
+    """ Return (packets, drops) counted by the kernel since the last call """
+    return struct.unpack("II", sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8))
+
+
+def parse_tcp(frame):
+    """ Decode an ethernet frame
+        Return (ip_src, ip_dst, sport, dport, flags, seq) if it is an IPv4/TCP packet, None otherwise
+    """
+    if len(frame) < 34 or frame[12:14] != '\x08\x00' or frame[23] != '\x06':
+        return None
+
+    ihl = (ord(frame[14]) & 0x0f) * 4
+    tcp = 14 + ihl
+    if len(frame) < tcp + 14:
+        return None
+
+    sport, dport, seq = struct.unpack("!HHI", frame[tcp:tcp + 8])
+    flags = ord(frame[tcp + 13])
+    return (socket.inet_ntoa(frame[26:30]), socket.inet_ntoa(frame[30:34]), sport, dport,
+            ''.join([name for i, name in enumerate(tcp_flags) if flags & (1 << i)]), seq)
+
+
+def run_worker(iface, group, conn, batch=256):
+    """ Entry point of a capture worker: drain a fanout socket until it is stopped
+        Packets sent by monitored ips are kept as traffic[epoch][scanner][port] = [(flags, seq, time)]
+    """
+    sock = fanout_socket(iface, group)
+    sock.setblocking(0)
+    conn.send(('listening',))
+
+    epoch = 0
+    ips = set()
+    traffic = {epoch: {}}
+    stats = {'received': 0, 'kept': 0, 'kernel_packets': 0, 'kernel_drops': 0}
+
+    while True:
+        readable = select.select([sock, conn], [], [])[0]
+
+        # Commands
+        if conn in readable:
+            command = conn.recv()
+            if command[0] == 'epoch':
+                epoch, ips = command[1], set(command[2])
+                for old_epoch in [e for e in traffic if e < epoch]:
+                    del traffic[old_epoch]
+                traffic.setdefault(epoch, {})
+            elif command[0] == 'traffic':
+                conn.send(traffic.get(command[1], {}))
+            elif command[0] == 'stats':
+                packets, drops = socket_stats(sock)
+                stats['kernel_packets'] += packets
+                stats['kernel_drops'] += drops
+                conn.send(stats)
+            elif command[0] == 'stop':
+                break
+
+        # Packets (at most batch packets, commands are not delayed)
+        if sock in readable:
+            now = time.time()
+            for i in xrange(batch):
+                try:
+                    frame, address = sock.recvfrom(65535)
+                except socket.error:
+                    break
+
+                stats['received'] += 1
+                if address[2] == PACKET_OUTGOING:
+                    continue
+
+                pkt = parse_tcp(frame)
+                if pkt is None or pkt[0] not in ips:
+                    continue
+
+                stats['kept'] += 1
+                ports = traffic[epoch].setdefault(pkt[0], {})
+                ports.setdefault(str(pkt[3]), []).append((pkt[4], str(pkt[5]), now))
+
+    sock.close()
+    conn.close()
+
+
+class FanoutCapture():
+    """ Capture of TCP packets sent by monitored ips, shared between several worker processes """
+
+    def __init__(self, iface, workers=4, group=None, timeout=30):
+        """ Initialize the capture
+                - iface: interface to sniff,
+                - workers: number of sockets (and processes) of the fanout group,
+                - group: fanout group id (default is derived from the pid),
+                - timeout: maximum time waiting for the reply of a worker (seconds).
+        """
+        self._iface = iface
+        self._timeout = timeout
+        self._nb_workers = max(1, workers)
+        self._group = group if group is not None else os.getpid() & 0xffff
+        self._workers = [] # (process, connection)
+        self._lock = threading.Lock() # Commands are sent by RPC threads
+        self._listening = 0
+
+    def start(self, ips, epoch=0, ports=None):
+        """ Start workers (if they are not running) and advance the epoch
+            Every port is captured, ports are not used
+        """
+        with self._lock:
+            if not self.alive():
+                # Remaining workers are stopped first, they would still receive their share of packets
+                self.terminate()
+                self.spawn()
+            if self.alive():
+                self.command(('epoch', epoch, list(ips)))
+
+    def spawn(self):
+        """ Start worker processes, wait until their socket is open """
+        self._workers = []
+        for i in range(self._nb_workers):
+            conn, child_conn = multiprocessing.Pipe()
+            target, args = self.worker(i)
+            process = multiprocessing.Process(target=target, args=args + (child_conn,))
+            process.daemon = True
+            process.start()
+            self._workers.append((process, conn))
+
+        self._listening = 0
+        for process, conn in self._workers:
+            try:
+                if conn.poll(10) and conn.recv() == ('listening',):
+                    self._listening += 1
+            except (EOFError, IOError):
+                # The worker cannot open its socket
+                pass
+
+    def worker(self, index):
+        """ Return the entry point of a worker and its arguments (its pipe is added) """
+        return run_worker, (self._iface, self._group)
+
+    def command(self, command, reply=False):
+        """ Send a command to every worker, return their replies
+            An exception is raised if a worker does not reply within the timeout
+        """
+        replies = []
+        for index, (process, conn) in enumerate(self._workers):
+            try:
+                # Late replies to a command that timed out are dropped
+                while conn.poll():
+                    conn.recv()
+                conn.send(command)
+            except (EOFError, IOError), err:
+                raise RuntimeError("Capture worker %d is not running (%s)" % (index, err))
+        if reply:
+            for index, (process, conn) in enumerate(self._workers):
+                try:
+                    if not conn.poll(self._timeout):
+                        raise RuntimeError("Capture worker %d did not reply to %s" % (index, command[0]))
+                    replies.append(conn.recv())
+                except (EOFError, IOError), err:
+                    raise RuntimeError("Capture worker %d is not running (%s)" % (index, err))
+        return replies
+
+    def terminate(self):
+        """ Stop every worker, even if some of them are not running anymore (the lock is held) """
+        for process, conn in self._workers:
+            if process.is_alive():
+                try:
+                    conn.send(('stop',))
+                except (EOFError, IOError):
+                    pass
+        for process, conn in self._workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+                process.join(1)
+            conn.close()
+        self._workers = []
+        self._listening = 0
+
+    def alive(self):
+        """ Are workers running ? """
+        return len(self._workers) > 0 and all([process.is_alive() for process, conn in self._workers])
+
+    def listening(self):
+        """ Is the socket of every worker open ? """
+        return self.alive() and self._listening == len(self._workers)
+
+    def traffic(self, epoch):
+        """ Return traffic captured by every worker during the given epoch
+            (scanner -> port -> [(flags, seq, time)], packets of a port ordered by time)
+        """
+        with self._lock:
+            if not self.alive():
+                return {}
+            stores = self.command(('traffic', epoch), True)
+
+        traffic = {}
+        for store in stores:
+            for scanner, ports in store.items():
+                for port, pkts in ports.items():
+                    traffic.setdefault(scanner, {}).setdefault(port, []).extend(pkts)
+
+        for scanner, ports in traffic.items():
+            for pkts in ports.values():
+                pkts.sort(key=lambda pkt: pkt[2])
+        return traffic
+
+    def stats(self):
+        """ Return capture statistics, summed over workers
+                - received: packets read from sockets,
+                - kept: packets sent by monitored ips,
+                - kernel_packets, kernel_drops: counted by the kernel (drops are packets that could not be queued)
+        """
+        with self._lock:
+            if not self.alive():
+                return {}
+            replies = self.command(('stats',), True)
+
+        stats = {'workers': len(replies)}
+        for reply in replies:
+            for key, value in reply.items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def stop(self):
+        """ Stop workers """
+        with self._lock:
+            self.terminate()
+
+def ring_socket(iface, group, block_size=1 << 20, block_nr=16, frame_size=2048, timeout=10):
+    """ Open an AF_PACKET socket (fanout group member) with a TPACKET_V3 receive ring
+        Return the socket and the memory mapped ring (block_nr blocks of block_size bytes,
+        a block is given to user space when it is full or after timeout milliseconds)
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+    sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack("IIIIIII", block_size, block_nr, frame_size,
+                    block_size * block_nr / frame_size, timeout, 0, 0))
+    sock.bind((iface, ETH_P_ALL))
+    mode = PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_DEFRAG
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT, struct.pack("I", (group & 0xffff) | (mode << 16)))
+
+    ring = mmap.mmap(sock.fileno(), block_size * block_nr, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    return sock, ring
+
+
+class SpillFile():
+    """ Append-only pcap file, written through a memory mapping grown by chunks
+        Records are readable (up to length) while the file is being written
+    """
+
+    def __init__(self, filename, snaplen, chunk=16 << 20):
+        """ Create the file and write the pcap header """
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.filename = filename
+        self.length = 0
+        self._chunk = chunk
+        self._file = open(filename, 'w+b')
+        self._map = None
+        self.grow(chunk)
+        self.append(struct.pack("IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, snaplen, 1))
+
+    def grow(self, size):
+        """ Extend the file (and its mapping) to size bytes """
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def append(self, data):
+        """ Append data at the end of the file """
+        if self.length + len(data) > len(self._map):
+            self.grow(len(self._map) + max(self._chunk, len(data)))
+        self._map[self.length:self.length + len(data)] = data
+        self.length += len(data)
+
+    def close(self):
+        """ Close the file, unused space is removed """
+        self._map.close()
+        self._file.truncate(self.length)
+        self._file.close()
+
+
+def read_pcap(filename, length=None):
+    """ Read records of a pcap file (only the first length bytes if specified)
+        Yield (timestamp, frame)
+    """
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if length is None or length > size:
+            length = size
+        if length <= 24:
+            return
+        data = mmap.mmap(f.fileno(), length, mmap.MAP_SHARED, mmap.PROT_READ)
+
+    offset = 24
+    while offset + 16 <= length:
+        sec, usec, incl_len, orig_len = struct.unpack_from("IIII", data, offset)
+        offset += 16
+        yield sec + usec / 1000000.0, data[offset:offset + incl_len]
+        offset += incl_len
+    data.close()
+
+
+def summarize(filename, length=None):
+    """ Decode a capture file into traffic: scanner -> port -> [(flags, seq, time)] """
+    traffic = {}
+    for timestamp, frame in read_pcap(filename, length):
+        pkt = parse_tcp(frame)
+        if pkt is None:
+            continue
+        traffic.setdefault(pkt[0], {}).setdefault(str(pkt[3]), []).append((pkt[4], str(pkt[5]), timestamp))
+    return traffic
+
+
+def run_ring_worker(iface, group, directory, index, conn, snaplen=128, block_size=1 << 20, block_nr=16):
+    """ Entry point of a ring capture worker: TCP packets sent by monitored ips are written
+        into the capture file of the epoch (directory/capture_<epoch>_<index>.pcap)
+        Nothing is kept in memory, capture files are decoded when the traffic is fetched
+    """
+    sock, ring = ring_socket(iface, group, block_size, block_nr)
+    conn.send(('listening',))
+
+    ips = set()
+    spill = None
+    spills = {} # epoch -> (filename, length) of closed capture files
+    stats = {'received': 0, 'kept': 0, 'kernel_packets': 0, 'kernel_drops': 0, 'written': 0}
+    block = 0
+
+    while True:
+        readable = select.select([sock, conn], [], [])[0]
+
+        # Commands
+        if conn in readable:
+            command = conn.recv()
+            if command[0] == 'epoch':
+                if spill is not None:
+                    spill.close()
+                    spills[spill.epoch] = (spill.filename, spill.length)
+                ips = set([socket.inet_aton(ip) for ip in command[2]])
+                spill = SpillFile(os.path.join(directory, "capture_%d_%d.pcap" % (command[1], index)), snaplen)
+                spill.epoch = command[1]
+            elif command[0] == 'spill':
+                if spill is not None and spill.epoch == command[1]:
+                    conn.send((spill.filename, spill.length))
+                else:
+                    conn.send(spills.get(command[1]))
+            elif command[0] == 'stats':
+                packets, drops = socket_stats(sock)
+                stats['kernel_packets'] += packets
+                stats['kernel_drops'] += drops
+                stats['written'] = spill.length if spill is not None else 0
+                conn.send(stats)
+            elif command[0] == 'stop':
+                break
+
+        # Blocks given to user space
+        while True:
+            offset = block * block_size
+            if not struct.unpack_from("I", ring, offset + 8)[0] & TP_STATUS_USER:
+                break
+
+            nb_pkts, pkt = struct.unpack_from("II", ring, offset + 12)
+            pkt += offset
+            for i in xrange(nb_pkts):
+                next_offset, sec, nsec, caplen, length, status, mac = struct.unpack_from("IIIIIIH", ring, pkt)
+                stats['received'] += 1
+
+                # sockaddr_ll follows the header, packets sent by the host are ignored
+                # IPv4/TCP packets sent by monitored ips are kept
+                frame = pkt + mac
+                if ord(ring[pkt + 58]) != PACKET_OUTGOING and ring[frame + 12:frame + 14] == '\x08\x00' \
+                        and ring[frame + 23] == '\x06' and ring[frame + 26:frame + 30] in ips and spill is not None:
+                    caplen = min(caplen, snaplen)
+                    spill.append(struct.pack("IIII", sec, nsec / 1000, caplen, length) + ring[frame:frame + caplen])
+                    stats['kept'] += 1
+
+                pkt += next_offset
+
+            # Give the block back to the kernel
+            struct.pack_into("I", ring, offset + 8, TP_STATUS_KERNEL)
+            block = (block + 1) % block_nr
+
+    if spill is not None:
+        spill.close()
+    ring.close()
+    sock.close()
+    conn.close()
+
+
+class RingCapture(FanoutCapture):
+    """ Capture through memory mapped rings, written into capture files (one per epoch and worker)
+        Memory of the target is bounded, whatever the duration of an experiment
+    """
+
+    def __init__(self, iface, workers=1, directory="log/capture", group=None, timeout=30):
+        """ Initialize the capture, capture files are written into directory """
+        FanoutCapture.__init__(self, iface, workers, group, timeout)
+        self._directory = directory
+
+    def worker(self, index):
+        return run_ring_worker, (self._iface, self._group, self._directory, index)
+
+    def traffic(self, epoch):
+        """ Decode capture files of every worker for the given epoch
+            (scanner -> port -> [(flags, seq, time)], packets of a port ordered by time)
+        """
+        with self._lock:
+            if not self.alive():
+                return {}
+            spills = self.command(('spill', epoch), True)
+
+        traffic = {}
+        for spill in spills:
+            if spill is None:
+                continue
+            for scanner, ports in summarize(*spill).items():
+                for port, pkts in ports.items():
+                    traffic.setdefault(scanner, {}).setdefault(port, []).extend(pkts)
+
+        for scanner, ports in traffic.items():
+            for pkts in ports.values():
+                pkts.sort(key=lambda pkt: pkt[2])
+        return traffic
+
+
+def generate(dst, sources, ports, count, rate=0):
+    """ Send count TCP SYN packets from sources (spoofed ips) to dst, ports are used one after another
+        The rate (packets per second) is not limited if rate is 0
+        Return the number of sent packets
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+
+    packets = []
+    for source in sources:
+        for port in ports:
+            ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 40, 0, 0, 64, socket.IPPROTO_TCP, 0,
+                             socket.inet_aton(source), socket.inet_aton(dst))
+            tcp = struct.pack("!HHIIBBHHH", 40000, port, 1, 0, 5 << 4, 0x02, 1024, 0, 0)
+            packets.append(ip + tcp)
+
+    begin = time.time()
+    for i in xrange(count):
+        sock.sendto(packets[i % len(packets)], (dst, 0))
+        if rate and i % 100 == 0:
+            delay = begin + float(i) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    sock.close()
+    return count
+
+
+def usage(name):
+    """ Print usage"""
+    print "Usage: python %s <args>" % name
+    print "     -h               : print this help"
+    print "     -d <dev>         : Interface to sniff (default is lo)"
+    print "     -w <workers>     : Number of capture workers (default is 4)"
+    print "     -n <packets>     : Number of packets to generate (default is 200000)"
+    print "     -s <scanners>    : Number of (spoofed) scanners sending packets (default is 16)"
+    print "     -r <rate>        : Packets per second, 0 is unlimited (default is 0)"
+    print "     -t <ip>          : Destination of generated packets (default is 127.0.0.1)"
+    print "     -m <mode>        : Capture mode, fanout or ring (default is fanout)"
+    print "     -o <dir>         : Directory of capture files in ring mode (default is log/capture)"
+
+
+if __name__ == '__main__':
+    # Variables
+    iface = 'lo'
+    workers = 4
+    count = 200000
+    nb_scanners = 16
+    rate = 0
+    dst = '127.0.0.1'
+    mode = 'fanout'
+    directory = 'log/capture'
+
+    # Parsing arguments
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:w:n:s:r:t:m:o:h')
+    except getopt.GetoptError, err:
+        print "Bad arguments"
+        print str(err)
+        usage(sys.argv[0])
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-d":
+            iface = a
+        elif o == "-w":
+            workers = int(a)
+        elif o == "-n":
+            count = int(a)
+        elif o == "-s":
+            nb_scanners = int(a)
+        elif o == "-r":
+            rate = int(a)
+        elif o == "-t":
+            dst = a
+        elif o == "-m":
+            mode = a
+        elif o == "-o":
+            directory = a
+        elif o == "-h":
+            usage(sys.argv[0])
+            sys.exit(2)
+        else:
+            print "Unknown option"
+
+    sources = ["127.0.%d.%d" % (100 + i / 250, 1 + i % 250) for i in range(nb_scanners)]
+
+    if mode == 'ring':
+        capture = RingCapture(iface, workers, directory)
+    else:
+        capture = FanoutCapture(iface, workers)
+    capture.start(sources, 1)
+
+    begin = time.time()
+    generate(dst, sources, range(1, 1025), count, rate)
+    duration = time.time() - begin
+
+    # Wait until workers have drained their socket
+    kept = -1
+    while kept != capture.stats()['kept']:
+        kept = capture.stats()['kept']
+        time.sleep(0.5)
+
+    stats = capture.stats()
+    captured = sum([len(pkts) for ports in capture.traffic(1).values() for pkts in ports.values()])
+    capture.stop()
+
+    print "%d packets sent in %.2fs (%.0f packets/s) - %d worker(s)" % (count, duration, count / duration, workers)
+    print "%(received)d received - %(kept)d kept - %(kernel_packets)d seen by the kernel - %(kernel_drops)d dropped by the kernel" % stats
+    print "%d packets in the merged traffic (%.2f%% lost)" % (captured, 100.0 * (count - captured) / count)
@@ -0,0 +1,209 @@
+'''
+File: counters.py
+Author: Damien Riquet
+Description: Kernel packet counters used by targets (counters mode)
+             No packet is processed in user space: the kernel counts TCP packets
+             received from each monitored scanner on each port, counters are read
+             when the traffic is fetched. Only counts are available (no flags nor seq),
+             the coordinator verifies that scanners' probes have been received.
+
+             Two backends are available:
+                * nft: a dynamic set whose elements (scanner . port) carry a counter,
+                  one rule whatever the number of scanners and ports,
+                * iptables: one counting rule per (scanner, port) in the raw table.
+
+             Counters are reset when the epoch is advanced, counters of the previous
+             epoch are kept until the next one.
+'''
+
+# Imports
+import re
+import json
+import logging
+import subprocess
+from distutils.spawn import find_executable
+
+# Local imports
+from portset import PortSet
+
+
+# Variables
+logger = logging.getLogger()
+
+table = "dsbench" # nftables table / iptables chain
+
+nft_ruleset = """
+table ip %(table)s {
+    set scanners { type ipv4_addr; }
+    set probes { type ipv4_addr . inet_service; flags dynamic; size 1048576; }
+    chain prerouting {
+        type filter hook prerouting priority -300; policy accept;
+        ip saddr @scanners meta l4proto tcp update @probes { ip saddr . tcp dport counter }
+    }
+}
+"""
+
+# Recent iptables print the protocol number (6) instead of its name with -n
+iptables_rule_re = re.compile("^\s*(?P<pkts>\d+)\s+\d+\s+RETURN\s+(?:tcp|6)\s+--\s+\S+\s+\S+\s+"
+                              "(?P<ip_src>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s+\S+\s+tcp dpt:(?P<port>\d+)")
+
+
+def run(command, data=None):
+    """ Run a command (list), data is given on its standard input
+        Return its output, an exception is raised if it fails
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = process.communicate(data)
+    if process.returncode != 0:
+        raise RuntimeError("%s failed: %s" % (' '.join(command), error.strip()))
+    return output
+
+
+def nft_commands(ips, create=False):
+    """ nft commands resetting counters and setting monitored scanners, the table is created first if create is set """
+    commands = ""
+    if create:
+        commands += nft_ruleset % {'table': table}
+    commands += "flush set ip %s probes\n" % table
+    commands += "flush set ip %s scanners\n" % table
+    if len(ips):
+        commands += "add element ip %s scanners { %s }\n" % (table, ', '.join(ips))
+    return commands
+
+def iptables_rules(ips, ports):
+    """ iptables-restore input creating the chain with one counting rule per (scanner, port) """
+    lines = ["*raw", ":%s - [0:0]" % table]
+    for ip in ips:
+        for port in ports:
+            lines.append("-A %s -s %s/32 -p tcp -m tcp --dport %d -j RETURN" % (table, ip, port))
+    lines.append("COMMIT")
+    return '\n'.join(lines) + '\n'
+
+def parse_nft_set(output):
+    """ Parse the JSON output of nft -j list set, return counters: scanner -> port -> number of received packets """
+    counters = {}
+    for item in json.loads(output)['nftables']:
+        for element in item.get('set', {}).get('elem', []):
+            element = element['elem']
+            ip, port = element['val']['concat']
+            counters.setdefault(ip, {})[str(port)] = element['counter']['packets']
+    return counters
+
+def parse_iptables_chain(output):
+    """ Parse the output of iptables -xvnL, return counters: scanner -> port -> number of received packets
+        Rules which did not count any packet are ignored
+    """
+    counters = {}
+    for line in output.splitlines():
+        m = iptables_rule_re.search(line)
+        if m and int(m.group('pkts')):
+            counters.setdefault(m.group('ip_src'), {})[m.group('port')] = int(m.group('pkts'))
+    return counters
+
+
+class KernelCounters():
+    """ Per-(scanner, port) packet counters kept by the kernel """
+
+    def __init__(self, backend=None):
+        """ Initialize counters, backend is nft or iptables (default is the available one, nft first) """
+        if backend is None:
+            backend = 'nft' if find_executable('nft') else 'iptables'
+        self._backend = backend
+        self._installed = False
+        self._ips = []
+        self._ports = None
+        self._epoch = 0
+        self._previous = (None, {}) # (epoch, counters) of the previous epoch
+
+    def start(self, ips, epoch=0, ports=None):
+        """ Install counting rules (if needed) and advance the epoch
+            Ports (range string) are required by the iptables backend
+        """
+        if self._installed and epoch != self._epoch:
+            # Counters of the previous epoch are kept, then reset
+            self._previous = (self._epoch, self.read())
+
+        if self._backend == 'nft':
+            self.install_nft(ips)
+        else:
+            self.install_iptables(ips, PortSet.parse(ports) if ports is not None else self._ports)
+
+        self._ips = list(ips)
+        self._epoch = epoch
+        self._installed = True
+
+    def install_nft(self, ips):
+        """ Create the table (once), reset counters and update monitored scanners """
+        if not self._installed:
+            if re.search("table ip %s$" % table, run(['nft', 'list', 'tables']), re.M):
+                # Left by a previous run
+                run(['nft', 'delete', 'table', 'ip', table])
+        run(['nft', '-f', '-'], nft_commands(ips, not self._installed))
+
+    def install_iptables(self, ips, ports):
+        """ Create the chain with one rule per (scanner, port), counters are reset """
+        if ports is None:
+            raise ValueError("Ports are required by the iptables backend")
+
+        if not self._installed:
+            self.uninstall_iptables()
+        run(['iptables-restore', '--noflush'], iptables_rules(ips, ports))
+        if not self._installed:
+            run(['iptables', '-t', 'raw', '-I', 'PREROUTING', '-j', table])
+
+        self._ports = ports
+        logger.info("%d counting rule(s) installed" % (len(ips) * len(ports)))
+
+    def uninstall_iptables(self):
+        """ Remove the chain (if it exists) """
+        try:
+            run(['iptables', '-t', 'raw', '-D', 'PREROUTING', '-j', table])
+        except RuntimeError:
+            pass
+        try:
+            run(['iptables', '-t', 'raw', '-F', table])
+            run(['iptables', '-t', 'raw', '-X', table])
+        except RuntimeError:
+            pass
+
+    def read(self):
+        """ Return counters: scanner -> port -> number of received packets """
+        if self._backend == 'nft':
+            return parse_nft_set(run(['nft', '-j', 'list', 'set', 'ip', table, 'probes']))
+        return parse_iptables_chain(run(['iptables', '-t', 'raw', '-L', table, '-n', '-v', '-x']))
+
+    def traffic(self, epoch):
+        """ Return counters of the given epoch (scanner -> port -> number of received packets) """
+        if not self._installed:
+            return {}
+        if epoch == self._epoch:
+            return self.read()
+        if epoch == self._previous[0]:
+            return self._previous[1]
+        return {}
+
+    def stats(self):
+        """ Return counting statistics (packets counted during the current epoch) """
+        if not self._installed:
+            return {}
+        counters = self.read()
+        return {'workers': 0, 'kept': sum([sum(ports.values()) for ports in counters.values()]), 'kernel_drops': 0,
+                'scanners': len(counters)}
+
+    def alive(self):
+        """ Are counting rules installed ? """
+        return self._installed
+
+    def listening(self):
+        """ Are counting rules installed ? """
+        return self._installed
+
+    def stop(self):
+        """ Remove counting rules """
+        if not self._installed:
+            return
+        if self._backend == 'nft':
+            run(['nft', 'delete', 'table', 'ip', table])
+        else:
+            self.uninstall_iptables()
+        self._installed = False
@@ -4,9 +4,21 @@ Author: Damien Riquet
 Description: Firewall Remote Python program launched on firewall hosts
              It reads log files and detect intrusion (snitch)
              RPC methods are:
-                * start_snitch: launch the snitch,
+                * start_snitch: launch the snitch, or advance its epoch if it is already running,
                 * stop_snitch: stop the snitch,
-                * snitch_state: return the state of the snitch (including detected IPs).
+                * snitch_state: return the state of the snitch (including detected IPs),
+                * register_scanners: scanners stopped by the firewall itself when they are detected,
+                * ready: readiness probe (snitch tailing the logfile at its end).
+
+             The snitch is persistent: it runs across a whole campaign and alerts
+             are tagged with the epoch (experiment) during which they have been raised.
+
+             Kill path: when scanners are registered, a detected scanner is halted by the
+             firewall (halt RPC method of the scanner). The coordinator is alerted first, with
+             kill_path set to 'firewall', then the scanner is halted by a dedicated thread (calls
+             have a short timeout) and the kill is reported with a ('firewall_kill', alert) event:
+             the alert contains the detection-to-kill latency ('kill_latency'), or kill_path is
+             'failed' if the scanner could not be halted.
 
 '''
 
@@ -14,22 +26,75 @@ Description: Firewall Remote Python program launched on firewall hosts
 import time
 import os
 import logging
-import pexpect
 import re
 import sys
 import getopt
+import Queue
 import threading
 import xmlrpclib
-from SimpleXMLRPCServer import SimpleXMLRPCServer
 
+# Local imports
+from rpcserver import ThreadedXMLRPCServer, TimeoutTransport, process_age
 
 
 # Variables
+imported = process_age() # Interpreter startup and imports (seconds)
 logger = logging.getLogger()
 
+alert_pattern_re = re.compile("\[\*\*\] \[.*\] "
+        "(?P<alert>.*)"
+        " \[\*\*\]\n"
+        ".*\n"
+        "(?P<time>\d{2}/\d{2}"
+        "-\d{2}:\d{2}:\d{2})\.\d+ "
+        "(?P<ip_src>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})"
+        " -> "
+        "(?P<ip_dst>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})"
+        "\n"
+    )
+
+
+def parse_alerts(lines, patterns):
+    """ Parse Snort alerts (alert file lines), return alerts matching at least one of the patterns
+        Each alert is a dict: patterns (matching ones), ip_src, ip_dst and date
+    """
+    lines = ''.join(lines)
+    alerts = []
+
+    for m in alert_pattern_re.finditer(lines):
+        # Alert found
+        time_str = "%d/%s" % (time.gmtime().tm_year, m.group('time'))
+
+        timestamp = time.strptime(time_str, "%Y/%m/%d-%H:%M:%S")
+
+        logging.info("Alert found: %s -- %s  -- %s -> %s" %
+                (m.group('alert'), time.asctime(timestamp),
+                 m.group('ip_src'), m.group('ip_dst')))
+
+        alert = m.group('alert')
+
+        # Is there any matching patterns ?
+        matching_patterns = []
+        for p in patterns:
+            if re.search(p.lower(), alert.lower()):
+                matching_patterns.append(p)
+
+        if len(matching_patterns):
+            logging.info("Alert matches following patterns: %s" % ', '.join(matching_patterns))
+
+            new_alert = {}
+            new_alert['patterns'] = list(matching_patterns)
+            new_alert['ip_src'] = m.group('ip_src')
+            new_alert['ip_dst'] = m.group('ip_dst')
+            new_alert['date'] = time.mktime(timestamp)
+            alerts.append(new_alert)
+
+    return alerts
+
+
 class Firewall:
     """ Remote python program that reads log file and alerts top program when some pattern are found """
-    def __init__(self, addr, debug=True):
+    def __init__(self, addr, debug=True, kill_timeout=2.0):
         """ Initialize attributes, rpc methods and logfile to read """
         # Attributes 
         self._addr = addr
@@ -37,10 +102,21 @@ class Firewall:
         # Snitch data
         self._detected_ips = []
         self._active = False
+        self._generation = 0 # Incremented each time a snitch is started, older snitches stop themselves
+        self._tailing = False # The snitch has reached the end of the logfile
+        self._logfile = None
+        self._patterns = []
+        self._coordinator = []
+        self._epoch = 0 # Alerts are tagged with the current epoch
+        self._scanners = {} # ip -> (ip, port) of scanners that are halted when detected
+        self._killed = [] # Scanners halted during the current epoch
+        self._kills = Queue.Queue() # (alert, coordinator) of scanners to be halted by the kill thread
+        self._kill_timeout = kill_timeout # Maximum duration of a halt call (seconds)
 
         # Init RPC / Logging
         self.init_logging(debug)
         self.init_rpc()
+        self.init_killer()
 
     def init_logging(self, debug):
         """ Initialization of the logging module 
@@ -68,18 +144,30 @@ class Firewall:
 
     def init_rpc(self):
         """ Initialization of RPC remote methods """
-        self._server =  SimpleXMLRPCServer(self._addr, allow_none=True)
+        self._server =  ThreadedXMLRPCServer(self._addr, allow_none=True, imported=imported)
         # Registering commands
         self._server.register_function(self.start_snitch_rpc, "start_snitch")
         self._server.register_function(self.stop_snitch, "stop_snitch")
         self._server.register_function(self.snitch_state, "snitch_state")
+        self._server.register_function(self.register_scanners, "register_scanners")
+        self._server.register_function(self.ready, "ready")
 
-    def start_snitch_rpc(self, pattern, logfile, timing, coordinator):
-        """ RPC method: launch a thread that creates the snitch """
-        t = threading.Timer(0, self.start_snitch, [pattern, logfile, timing, coordinator])
+    def start_snitch_rpc(self, pattern, logfile, timing, coordinator, epoch=0):
+        """ RPC method: launch a thread that creates the snitch
+            If a snitch is already tailing the same logfile, its epoch, patterns and coordinator are updated
+        """
+        self.set_epoch(epoch, pattern, coordinator)
+
+        if self._active and self._tailing and logfile == self._logfile:
+            logger.info("Firewall snitch already running, epoch %d" % epoch)
+            return
+
+        self._tailing = False
+        self._generation += 1
+        t = threading.Timer(0, self.start_snitch, [pattern, logfile, timing, coordinator, self._generation])
         t.start()
     
-    def start_snitch(self, patterns, logfile, timing, coordinator):
+    def start_snitch(self, patterns, logfile, timing, coordinator, generation=None):
         """ Create a snitch
             Open the logfile and read it until the coordinator stop the experiment
                 - coordinator is a list like (ip, port) containing ip and port of the coordinator
@@ -91,14 +179,20 @@ class Firewall:
         logger.info("logfile: %s" % logfile)
         logger.info("timing: %s" % timing)
         # Initialization
-        self._detected_ips = []
         self._active = True
+        self._logfile = logfile
+        self._patterns = list(patterns)
+        self._coordinator = coordinator
+        if generation is None:
+            self._generation += 1
+            generation = self._generation
 
         # Open the file and read it until it has to stop !
         with open(logfile, 'r') as f:
             f.seek(0, os.SEEK_END)
+            self._tailing = True
 
-            while self._active:
+            while self._active and generation == self._generation:
                 # Read the file
                 lines = f.readlines()
 
@@ -108,71 +202,41 @@ class Firewall:
                         logger.debug("logfile output: %s" % line.strip())
                     
                     # Analyse the output
-                    new_alerts = self.analyse_output(lines, patterns)
+                    new_alerts = self.analyse_output(lines, self._patterns)
                    
+                    # Registered scanners are halted by the kill thread, the snitch is not blocked by them
+                    kills = [new_alert for new_alert in new_alerts if self.claim_kill(new_alert)]
+
                     # If there is a new alert, alert the coordinator (if there is one)
-                    if len(new_alerts) and len(coordinator):
+                    if len(new_alerts) and len(self._coordinator):
                         # Create a RPC proxy and send an alert to the coordinator
-                        coordinator_proxy = xmlrpclib.ServerProxy("http://%s:%d/" % coordinator)
+                        coordinator_proxy = xmlrpclib.ServerProxy("http://%s:%d/" % tuple(self._coordinator), allow_none=True)
                         for new_alert in new_alerts:
+                            new_alert['notify_delay'] = time.time() - new_alert['seen']
                             coordinator_proxy.add_event(('firewall', new_alert))
 
+                    for new_alert in kills:
+                        self._kills.put((new_alert, tuple(self._coordinator)))
+
 
 
-                time.sleep(timing)
+                time.sleep(float(timing))
                 
 
     def analyse_output(self, lines, patterns):
         """ Analyse output and detect IDSs alerts
             Snort analysis -- possible states :
         """
-
-        alert_pattern_re = re.compile("\[\*\*\] \[.*\] "
-                "(?P<alert>.*)"
-                " \[\*\*\]\n"
-                ".*\n"
-                "(?P<time>\d{2}/\d{2}"
-                "-\d{2}:\d{2}:\d{2})\.\d+ "
-                "(?P<ip_src>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})"
-                " -> "
-                "(?P<ip_dst>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})"
-                "\n"
-            )
-
-        lines = ''.join(lines)
         new_alerts = []
 
-        for m in alert_pattern_re.finditer(lines):
-            # Alert found
-            time_str = "%d/%s" % (time.gmtime().tm_year, m.group('time'))
-
-            timestamp = time.strptime(time_str, "%Y/%m/%d-%H:%M:%S")
-
-            logging.info("Alert found: %s -- %s  -- %s -> %s" %
-                    (m.group('alert'), time.asctime(timestamp),
-                     m.group('ip_src'), m.group('ip_dst')))
-    
-            alert = m.group('alert')
-
-            # Is there any matching patterns ?
-            matching_patterns = []
-            for p in patterns:
-                if re.search(p.lower(), alert.lower()):
-                    matching_patterns.append(p)
-
-            if len(matching_patterns):
-                logging.info("Alert matches following patterns: %s" % ', '.join(matching_patterns))
-
-                new_alert = {}
-                new_alert['patterns'] = list(matching_patterns)
-                new_alert['detected_by'] = self._addr[0]
-                new_alert['ip_src'] = m.group('ip_src')
-                new_alert['ip_dst'] = m.group('ip_dst')
-                new_alert['date'] = time.mktime(timestamp)
+        for new_alert in parse_alerts(lines, patterns):
+            new_alert['detected_by'] = self._addr[0]
+            new_alert['epoch'] = self._epoch
+            new_alert['seen'] = time.time()
 
-                # Adding alert
-                self._detected_ips.append(new_alert)
-                new_alerts.append(new_alert)
+            # Adding alert
+            self._detected_ips.append(new_alert)
+            new_alerts.append(new_alert)
 
         return new_alerts
 
@@ -180,15 +244,86 @@ class Firewall:
 
 
         
+    def init_killer(self):
+        """ Create the thread halting detected scanners (kill path) """
+        t = threading.Thread(target=self.run_killer)
+        t.daemon = True
+        t.start()
+
+    def claim_kill(self, alert):
+        """ Return True if the detected scanner has to be halted by the firewall (registered, once per epoch)
+            The alert is marked, so that the coordinator does not stop the scanner itself
+        """
+        scanner = alert['ip_src']
+        if scanner not in self._scanners or scanner in self._killed:
+            return False
+
+        self._killed.append(scanner)
+        alert['kill_path'] = 'firewall'
+        return True
+
+    def run_killer(self):
+        """ Halt scanners one after another, then report the kill to the coordinator ('firewall_kill' event) """
+        while True:
+            alert, coordinator = self._kills.get()
+            self.kill(alert)
+
+            if len(coordinator):
+                try:
+                    coordinator_proxy = xmlrpclib.ServerProxy("http://%s:%d/" % coordinator,
+                                                              transport=TimeoutTransport(self._kill_timeout), allow_none=True)
+                    coordinator_proxy.add_event(('firewall_kill', alert))
+                except Exception, err:
+                    logger.warning("Kill of scanner %s cannot be reported (%s)" % (alert['ip_src'], err))
+
+    def kill(self, alert):
+        """ Halt a detected scanner, calls fail after kill_timeout seconds
+            The detection-to-kill latency is added to the alert, kill_path is 'failed' if the scanner cannot be halted
+        """
+        scanner = alert['ip_src']
+        try:
+            scanner_proxy = xmlrpclib.ServerProxy("http://%s:%d/" % self._scanners[scanner],
+                                                  transport=TimeoutTransport(self._kill_timeout), allow_none=True)
+            scanner_proxy.halt()
+        except Exception, err:
+            logger.warning("Scanner %s cannot be halted (%s)" % (scanner, err))
+            alert['kill_path'] = 'failed'
+            return
+
+        alert['kill_latency'] = time.time() - alert['seen']
+        logger.info("Scanner %s halted %.3fs after its detection" % (scanner, alert['kill_latency']))
+
+    def register_scanners(self, scanners):
+        """ RPC method: scanners (list of (ip, port)) halted by the firewall when they are detected
+            An empty list disables the kill path
+        """
+        self._scanners = dict([(scanner[0], tuple(scanner)) for scanner in scanners])
+        self._killed = []
+        logger.info("%d scanner(s) registered" % len(self._scanners))
+
     def stop_snitch(self):
         """ Stop the snitch """
         logger.info("Stopping firewall snitch...")
         self._active = False
+        self._tailing = False
+
+    def set_epoch(self, epoch, patterns, coordinator):
+        """ Advance the epoch, only alerts of the previous epoch are kept """
+        self._epoch = epoch
+        self._patterns = list(patterns)
+        self._coordinator = coordinator
+        self._detected_ips = [alert for alert in self._detected_ips if alert['epoch'] >= epoch - 1]
+
+    def ready(self):
+        """ Readiness probe: is the snitch tailing the logfile at its end ? """
+        return {'snitch': self._active and self._tailing}
 
-    def snitch_state(self):
-        """ Return the current detected scaners """
+    def snitch_state(self, epoch=None):
+        """ Return the current detected scaners (raised during the given epoch, default is the current one) """
         logger.debug("Getting firewall snitch state...")
-        return self._detected_ips
+        if epoch is None:
+            epoch = self._epoch
+        return [alert for alert in self._detected_ips if alert['epoch'] == epoch]
         
 def usage(name):
     """ Print usage"""
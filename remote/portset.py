@@ -0,0 +1,204 @@
+'''
+File: portset.py
+Author: Damien Riquet
+Description: Compact representation of a set of ports
+             Ports are stored in a 65536-bit bitmap (membership test is O(1))
+             and serialized as ranges, for example "22,80-90,443".
+
+             This representation is used by the coordinator and the remote programs for:
+                * configuration (a port list or a range string),
+                * subparts and RPC payloads,
+                * open ports snapshots,
+                * nmap -p option.
+'''
+
+# Imports
+import re
+import bisect
+
+
+# Variables
+MAX_PORT = 65535
+nonzero_re = re.compile('[^\x00]+') # Runs of non-empty bytes of the bitmap
+
+
+class PortSet():
+    """ Set of ports stored in a 65536-bit bitmap """
+
+    def __init__(self, ports=None):
+        """ Create a port set containing the given ports (iterable of ints) """
+        self._bits = bytearray(8192)
+        self._len = 0
+        self._index = None # Cached (range starts, ranges) used by __getitem__
+
+        if ports is not None:
+            for port in ports:
+                self.add(port)
+
+    @classmethod
+    def parse(cls, value):
+        """ Create a port set from a PortSet, a range string ("22,80-90"), a port or a list of ports (or ranges) """
+        if isinstance(value, PortSet):
+            return value
+        if isinstance(value, (int, long)):
+            return cls([value])
+
+        portset = cls()
+        if isinstance(value, basestring):
+            value = value.split(',')
+
+        for item in value:
+            if isinstance(item, basestring):
+                item = item.strip()
+                if not item:
+                    continue
+                if '-' in item:
+                    begin, end = item.split('-', 1)
+                    portset.add_range(int(begin), int(end))
+                    continue
+            portset.add(int(item))
+
+        return portset
+
+    def copy(self):
+        """ Return a copy of this port set """
+        portset = PortSet()
+        portset._bits = bytearray(self._bits)
+        portset._len = self._len
+        return portset
+
+
+# ########## Set operations
+
+    def add(self, port):
+        """ Add a port """
+        if port < 0 or port > MAX_PORT:
+            raise ValueError("Invalid port %s" % port)
+
+        mask = 1 << (port & 7)
+        if not self._bits[port >> 3] & mask:
+            self._bits[port >> 3] |= mask
+            self._len += 1
+            self._index = None
+
+    def add_range(self, begin, end):
+        """ Add every port between begin and end (included) """
+        for port in xrange(begin, end + 1):
+            self.add(port)
+
+    def discard(self, port):
+        """ Remove a port if present """
+        if port < 0 or port > MAX_PORT:
+            return
+
+        mask = 1 << (port & 7)
+        if self._bits[port >> 3] & mask:
+            self._bits[port >> 3] &= ~mask & 0xff
+            self._len -= 1
+            self._index = None
+
+    def __contains__(self, port):
+        try:
+            port = int(port)
+        except (TypeError, ValueError):
+            return False
+        if port < 0 or port > MAX_PORT:
+            return False
+        return bool(self._bits[port >> 3] & (1 << (port & 7)))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        """ Iterate over ports in ascending order
+            Empty bytes are skipped by the regular expression engine, so that a small set is cheap
+        """
+        bits = self._bits
+        for m in nonzero_re.finditer(str(bits)):
+            for i in xrange(m.start(), m.end()):
+                byte = bits[i]
+                for j in xrange(8):
+                    if byte & (1 << j):
+                        yield (i << 3) | j
+
+    def __getitem__(self, index):
+        """ Return the index-th port (in ascending order), without expanding the set """
+        if index < 0:
+            index += self._len
+        if index < 0 or index >= self._len:
+            raise IndexError(index)
+
+        if self._index is None:
+            starts = []
+            ranges = self.ranges()
+            total = 0
+            for begin, end in ranges:
+                starts.append(total)
+                total += end - begin + 1
+            self._index = (starts, ranges)
+
+        starts, ranges = self._index
+        i = bisect.bisect_right(starts, index) - 1
+        return ranges[i][0] + index - starts[i]
+
+    def __eq__(self, other):
+        return isinstance(other, PortSet) and self._bits == other._bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __or__(self, other):
+        portset = PortSet()
+        portset._bits = bytearray([a | b for a, b in zip(self._bits, other._bits)])
+        portset._len = portset.count()
+        return portset
+
+    def __and__(self, other):
+        portset = PortSet()
+        portset._bits = bytearray([a & b for a, b in zip(self._bits, other._bits)])
+        portset._len = portset.count()
+        return portset
+
+    def __sub__(self, other):
+        portset = PortSet()
+        portset._bits = bytearray([a & ~b & 0xff for a, b in zip(self._bits, other._bits)])
+        portset._len = portset.count()
+        return portset
+
+    def count(self):
+        """ Count ports of the bitmap """
+        return sum([bin(byte).count('1') for byte in self._bits if byte])
+
+
+# ########## Serialization
+
+    def ranges(self):
+        """ Return the list of (begin, end) ranges of consecutive ports """
+        ranges = []
+        begin = None
+        previous = None
+
+        for port in self:
+            if begin is None:
+                begin = port
+            elif port != previous + 1:
+                ranges.append((begin, previous))
+                begin = port
+            previous = port
+
+        if begin is not None:
+            ranges.append((begin, previous))
+        return ranges
+
+    def __str__(self):
+        """ Range string, for example "22,80-90,443" (used in RPC payloads and nmap -p option) """
+        items = []
+        for begin, end in self.ranges():
+            if begin == end:
+                items.append(str(begin))
+            else:
+                items.append("%d-%d" % (begin, end))
+        return ','.join(items)
+
+    def __repr__(self):
+        return "PortSet('%s')" % self
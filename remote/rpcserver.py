@@ -0,0 +1,124 @@
+'''
+File: rpcserver.py
+Author: Damien Riquet
+Description: XML-RPC server (and client transport) shared by the coordinator and the remote programs
+             Connections are kept alive (HTTP/1.1), so that a client can send
+             every call of a campaign through the same TCP connection.
+             Each connection is served by its own thread: a kept-alive connection
+             does not block other clients.
+
+             Startup of remote programs is measured against a budget (startup_budget):
+                * imports: time from the start of the process to the end of its imports
+                  (interpreter startup included, see process_age),
+                * serving: time from the start of the process to the start of the serving loop,
+             the time of the first served RPC is also measured (it depends on the coordinator).
+'''
+
+# Imports
+import os
+import logging
+import xmlrpclib
+import SocketServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+
+# Variables
+logger = logging.getLogger()
+
+startup_budget = {'imports': 0.5, 'serving': 1.0} # Seconds
+
+
+def process_age():
+    """ Seconds elapsed since the start of this process (read from /proc, 10ms resolution) """
+    with open('/proc/self/stat', 'r') as f:
+        # Fields following the command name, starttime is the 22nd field
+        starttime = int(f.read().rsplit(')', 1)[1].split()[19])
+    with open('/proc/uptime', 'r') as f:
+        uptime = float(f.read().split()[0])
+    return max(uptime - float(starttime) / os.sysconf('SC_CLK_TCK'), 0.0)
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """ XML-RPC transport whose connections have a timeout
+        The connection is kept alive between calls, opened and reused connections are counted
+    """
+
+    def __init__(self, timeout):
+        xmlrpclib.Transport.__init__(self)
+        self._timeout = timeout
+        self.requests = 0
+        self.connections = 0
+
+    def make_connection(self, host):
+        if not (self._connection and host == self._connection[0]):
+            self.connections += 1
+        self.requests += 1
+
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        connection.timeout = self._timeout
+        return connection
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    """ Request handler keeping the connection open between requests
+        The response is written at once (buffered, TCP_NODELAY): otherwise headers sent
+        in small segments wait for the delayed ACK of the client on a kept-alive connection
+    """
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+
+class LocalAddressHandler(KeepAliveRequestHandler):
+    """ Request handler remembering the local address of the connection (server.local.agent, thread-local)
+        Used when one server stands in for several agents, each one having its own address
+    """
+
+    def handle_one_request(self):
+        self.server.local.agent = self.connection.getsockname()[0]
+        KeepAliveRequestHandler.handle_one_request(self)
+
+
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    """ XML-RPC server handling each connection in a thread
+        The address can be bound again right after the server is closed (SO_REUSEADDR)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr, allow_none=True, logRequests=True, imported=None):
+        """ Create the server, imported is the import time of a remote program (see process_age)
+            If it is given, the startup of the program is measured and can be fetched (startup RPC method)
+        """
+        SimpleXMLRPCServer.__init__(self, addr, requestHandler=KeepAliveRequestHandler,
+                                    allow_none=allow_none, logRequests=logRequests)
+        self._startup = None
+        if imported is not None:
+            self._startup = {'imports': imported, 'serving': None, 'first_rpc': None}
+            self.register_function(self.startup, "startup")
+
+    def serve_forever(self, poll_interval=0.5):
+        if self._startup is not None and self._startup['serving'] is None:
+            self._startup['serving'] = process_age()
+            self.check_budget('imports')
+            self.check_budget('serving')
+        SimpleXMLRPCServer.serve_forever(self, poll_interval)
+
+    def _dispatch(self, method, params):
+        if self._startup is not None and self._startup['first_rpc'] is None:
+            self._startup['first_rpc'] = process_age()
+            self.check_budget('first_rpc')
+        return SimpleXMLRPCServer._dispatch(self, method, params)
+
+    def check_budget(self, step):
+        """ Log the time spent by a startup step, and whether it exceeds the budget """
+        if step in startup_budget and self._startup[step] > startup_budget[step]:
+            logger.warning("Startup: %s after %.2fs - over budget (%.2fs)" % (step, self._startup[step], startup_budget[step]))
+        else:
+            logger.info("Startup: %s after %.2fs" % (step, self._startup[step]))
+
+    def startup(self):
+        """ Return startup times (imports, serving, first_rpc) and the budget """
+        startup = dict(self._startup)
+        startup['budget'] = startup_budget
+        return startup
@@ -7,10 +7,16 @@ Description: Remote Python program launched on scanner hosts
                 * Generated traffic while doing the portscan,
                 * Timestamps of the beginning and ending of the portscan.
              RPC methods are:
-                * exec_scan: execute a portscan,
+                * exec_scan: queue a portscan, portscans are executed one after another,
+                * revoke_scans: remove queued portscans that have not been started,
                 * poll_scan: poll a portscan,
                 * stop_scan: stop a scan and return scan data (described above), 
-                * scan_state: return the state of the scan and possibly stop it if scanner host has been detected,
+                * halt: stop the running portscan and do not start queued ones (scanner detected),
+                * resume: start queued portscans again,
+                * scan_state: return the state of the scan and possibly stop it if scanner host has been detected
+                  (results of a finished portscan are sent with its completion event, they are only kept
+                  when the coordinator cannot be reached),
+                * ready: readiness probe (no portscan running nor queued).
 
 '''
 
@@ -18,16 +24,19 @@ Description: Remote Python program launched on scanner hosts
 import time
 import os
 import logging
-import pexpect
 import re
 import sys
 import getopt
 import threading
 import xmlrpclib
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+
+# Local imports
+from portset import PortSet
+from rpcserver import ThreadedXMLRPCServer, process_age
 
 
 # Variables
+imported = process_age() # Interpreter startup and imports (seconds)
 logger = logging.getLogger()
 
 tcp_sent_re = re.compile("SENT" 
@@ -77,6 +86,20 @@ port_state_re = re.compile("Discovered"
         "(?P<ip>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})"
        )
 
+# Regexes tried on each line of the nmap output, in this order
+output_res = [('sent', tcp_sent_re), ('rcvd', tcp_rcvd_re), ('conn', tcp_conn_re), ('state', port_state_re)]
+
+
+def parse_output(output):
+    """ Parse a line of the nmap output (--packet-trace -d2)
+        Return (kind, match) of the first matching regex, (None, None) if no regex matches
+    """
+    for kind, regex in output_res:
+        m = regex.search(output)
+        if m:
+            return kind, m
+    return None, None
+
 
 class Scanner():
     """ Distributed scanner used in distributed portscan """
@@ -94,9 +117,19 @@ class Scanner():
         self._timestamps = {} # Contains timestamps of the beginning and ending of the portscan
         self._logfilename = "" # Filename in which is stored debug messages
 
+        ## Queued portscans and results of finished ones
+        self._current_scan = None # Id of the running portscan
+        self._starting = False # nmap of the current portscan is being spawned
+        self._stop_pending = False # The current portscan has been stopped while nmap was being spawned
+        self._queue = [] # Portscans waiting to be executed, (scan_id, scantype, timing, coordinator, target, ports)
+        self._queue_cond = threading.Condition()
+        self._results = {} # scan_id -> (portstate, traffic) of finished portscans
+        self._halted = False # Queued portscans are not started (the scanner has been detected)
+
         ## Initialization
         self.init_logging(debug)
         self.init_rpc()
+        self.init_worker()
 
 
     def init_logging(self, debug=False):
@@ -127,19 +160,60 @@ class Scanner():
 
     def init_rpc(self):
         """ Initialization of RPC remote methods """
-        self._server =  SimpleXMLRPCServer(self._addr, allow_none=True)
+        self._server =  ThreadedXMLRPCServer(self._addr, allow_none=True, imported=imported)
         # Registering commands
         self._server.register_function(self.exec_scan_rpc, "exec_scan")
+        self._server.register_function(self.revoke_scans, "revoke_scans")
         self._server.register_function(self.stop_scan, "stop_scan")
+        self._server.register_function(self.halt, "halt")
+        self._server.register_function(self.resume, "resume")
         self._server.register_function(self.poll_scan, "poll_scan")
         self._server.register_function(self.scan_state, "scan_state")
+        self._server.register_function(self.ready, "ready")
 
-    def exec_scan_rpc(self, scantype, timing, coordinator, target, ports):
-        """ RPC method called: create a thread to launch the portscan """
-        t = threading.Timer(0, self.exec_scan, [scantype, timing, coordinator, target, ports])
+    def init_worker(self):
+        """ Create the thread executing queued portscans """
+        t = threading.Thread(target=self.run_worker)
+        t.daemon = True
         t.start()
 
-    def exec_scan(self, scantype, timing, coordinator, target, ports):
+    def run_worker(self):
+        """ Execute queued portscans one after another """
+        while True:
+            with self._queue_cond:
+                while self._halted or not len(self._queue):
+                    self._queue_cond.wait()
+                scan = self._queue.pop(0)
+                # The portscan is current from now on, it can be stopped before nmap is spawned
+                self._current_scan = scan[0]
+                self._starting = True
+                self._stop_pending = False
+
+            try:
+                self.exec_scan(*scan[1:], scan_id=scan[0])
+            finally:
+                with self._queue_cond:
+                    self._starting = False
+
+    def exec_scan_rpc(self, scantype, timing, coordinator, target, ports, scan_id=None):
+        """ RPC method called: queue the portscan, it is launched as soon as the previous ones are finished """
+        with self._queue_cond:
+            self._queue.append((scan_id, scantype, timing, coordinator, target, ports))
+            logger.info("Portscan %s queued (%d portscan(s) in queue)" % (scan_id, len(self._queue)))
+            self._queue_cond.notify()
+
+    def revoke_scans(self, scan_ids=None):
+        """ Remove queued portscans that have not been started (only the given ones if scan_ids is specified)
+            Return the ids of revoked portscans
+        """
+        with self._queue_cond:
+            revoked = [scan[0] for scan in self._queue if scan_ids is None or scan[0] in scan_ids]
+            self._queue = [scan for scan in self._queue if scan[0] not in revoked]
+
+        logger.info("%d queued portscan(s) revoked" % len(revoked))
+        return revoked
+
+    def exec_scan(self, scantype, timing, coordinator, target, ports, scan_id=None):
         """ Execute a portscan """
         ## Portscan variables
         self._nbports = 0
@@ -172,13 +246,14 @@ class Scanner():
         nmap_cmd = nmap_cmd.replace("<timing>", timing) # Timing
         nmap_cmd = nmap_cmd.replace("<logfile>", self._logfilename) # Logfile
 
-        # Ports 
-        if isinstance(ports, list):
-            nmap_cmd = nmap_cmd.replace("<ports>", "-p %s" % ','.join([str(v) for v in ports]))
-            self._nbports = len(ports)
-        else:
+        # Ports (a list or a range string), or an nmap option such as -F
+        if isinstance(ports, basestring) and ports.startswith('-'):
             nmap_cmd = nmap_cmd.replace("<ports>", ports)
             self._nbports = 100
+        else:
+            ports = PortSet.parse(ports)
+            nmap_cmd = nmap_cmd.replace("<ports>", "-p %s" % ports)
+            self._nbports = len(ports)
 
         logger.info("Building nmap command: %s" % nmap_cmd)
         logger.debug("  Scan type: %s" % scantype)
@@ -190,7 +265,17 @@ class Scanner():
         ## Execute Nmap command
         logger.info("Executing command ...")
         self._timestamps['begin'] = time.time()
-        self._process = pexpect.spawn(nmap_cmd)
+        import pexpect # Only needed to run scans, not imported at startup
+        process = pexpect.spawn(nmap_cmd)
+
+        # The scanner may have been halted (or the portscan stopped) while nmap was being spawned
+        with self._queue_cond:
+            self._process = process
+            self._starting = False
+            stopped = self._halted or self._stop_pending
+        if stopped:
+            logger.info("Scan stopped while nmap was being spawned")
+            process.kill(9)
 
         ## Poll execution regularly and parse debug messages
         expected = [pexpect.EOF, pexpect.TIMEOUT]
@@ -205,40 +290,34 @@ class Scanner():
 
             # Process output
             # Searching data within the nmap output
+            kind, m = parse_output(output)
 
             ## TCP
             # Sent
-            m = tcp_sent_re.search(output)
-            if m:
+            if kind == 'sent':
                 flags = m.group('flags')
                 if flags == None: flags = ""
                 logger.debug("TCP SENT -- %s:%s -> %s:%s -- flags (%s) -- seq %s"
                         % (m.group('ip_src'), m.group('port_src'), m.group('ip_dst'), m.group('port_dst'), flags, m.group('seq')))
                 add_traffic_event(self._traffic['sent'], m.group('ip_dst'), m.group('port_dst'), (flags, m.group('seq'), time.time()))
                 add_traffic_event(self._traffic['both'], m.group('ip_dst'), m.group('port_dst'), ('out', flags, m.group('seq'), time.time()))
-                continue
 
             # Received
-            m = tcp_rcvd_re.search(output)
-            if m:
+            elif kind == 'rcvd':
                 logger.debug("TCP RCVD -- %s:%s -> %s:%s -- flags (%s) -- seq %s"
                         % (m.group('ip_src'), m.group('port_src'), m.group('ip_dst'), m.group('port_dst'), m.group('flags'), m.group('seq')))
                 add_traffic_event(self._traffic['rcvd'], m.group('ip_src'), m.group('port_src'), (m.group('flags'), m.group('seq'), time.time()))
                 add_traffic_event(self._traffic['both'], m.group('ip_src'), m.group('port_src'), ('in', m.group('flags'), m.group('seq'), time.time()))
-                continue
 
             # CONNect technique (uses connect function)
-            m = tcp_conn_re.search(output)
-            if m:
+            elif kind == 'conn':
                 logger.debug("TCP CONN -- %s -> %s:%s"
                         % (m.group('ip_src'), m.group('ip_dst'), m.group('port_dst')))
                 add_traffic_event(self._traffic['sent'], m.group('ip_dst'), m.group('port_dst'), ('S', time.time()))
                 add_traffic_event(self._traffic['both'], m.group('ip_dst'), m.group('port_dst'), ('out', 'S', time.time()))
-                continue
 
             ## Port state
-            m = port_state_re.search(output)
-            if m:
+            elif kind == 'state':
                 logger.info("nbtoscan %d" % self._nbports)
                 logger.info("IP %s -- Port %s state: %s" 
                         % (m.group('ip'), m.group('port'), m.group('state')))
@@ -251,29 +330,99 @@ class Scanner():
                     state = state[:state.find('|')]
 
                 self._portstate[m.group('port')] = (state, time.time())
-                continue
 
         self._timestamps['end'] = time.time()
 
-
         logger.info("Scan finished")
         # Alert the coordinator that the portscan is finished
+        # Results are sent with the alert, the coordinator does not have to fetch them
+        results = (self.compact_port_state(), self.compact_traffic())
         if len(coordinator):
             # Create a RPC proxy and send an alert to the coordinator
             logger.info("Scan finished -- Sending an alert to coordinator %s" % coordinator[0])
-            coordinator_proxy = xmlrpclib.ServerProxy("http://%s:%d/" % (coordinator[0], coordinator[1]))
-            coordinator_proxy.add_event(('scanner', self._addr[0], target))
+            coordinator_proxy = xmlrpclib.ServerProxy("http://%s:%d/" % (coordinator[0], coordinator[1]), allow_none=True)
+            try:
+                coordinator_proxy.add_event(('scanner', self._addr[0], target, scan_id, results))
+                return
+            except Exception, err:
+                logger.warning("Coordinator %s cannot be reached (%s)" % (coordinator[0], err))
 
+        # Keep results until the coordinator fetches them
+        if scan_id is not None:
+            self._results[scan_id] = results
 
 
-    def scan_state(self):
-        """ Return state of the current (or not -- at least the last one) portscan """
-        return self._portstate, self._traffic
 
-    def stop_scan(self):
-        """ Stop the current scan"""
-        logger.info("Scan stopped")
-        self._process.kill(9)
+    def scan_state(self, scan_id=None):
+        """ Return state of the given portscan
+            If scan_id is not specified, return state of the current (or not -- at least the last one) portscan
+        """
+        if scan_id is not None and scan_id in self._results:
+            return self._results.pop(scan_id)
+        return self.compact_port_state(), self._traffic
+
+    def compact_port_state(self):
+        """ Return port states as a dict containing the set of ports (range string) found in each state """
+        states = {}
+        for port, (state, timestamp) in self._portstate.items():
+            states.setdefault(state, PortSet()).add(int(port))
+        return dict([(state, str(ports)) for state, ports in states.items()])
+
+    def compact_traffic(self):
+        """ Return the sent traffic, packets only contain (flags, seq) values """
+        sent = {}
+        for dst, ports in self._traffic.get('sent', {}).items():
+            sent[dst] = dict([(port, [pkt[:2] for pkt in pkts]) for port, pkts in ports.items()])
+        return {'sent': sent}
+
+    def stop_scan(self, scan_id=None):
+        """ Stop the current scan (only if it is the given one when scan_id is specified)
+            Return True if a scan has been stopped
+        """
+        with self._queue_cond:
+            if scan_id is not None and scan_id != self._current_scan:
+                logger.info("Scan %s is not running, not stopped" % scan_id)
+                return False
+
+            logger.info("Scan stopped")
+            if self._starting:
+                # nmap is killed as soon as it is spawned
+                self._stop_pending = True
+                return True
+            process = self._process
+
+        if process is not None and process.isalive():
+            process.kill(9)
+            return True
+        return False
+
+    def halt(self):
+        """ Stop the running portscan, queued ones are not started until resume is called
+            Return True if a scan has been stopped
+        """
+        logger.info("Scanner halted")
+        with self._queue_cond:
+            self._halted = True
+            if self._starting:
+                # nmap is killed as soon as it is spawned
+                return True
+            process = self._process
+
+        if process is not None and process.isalive():
+            process.kill(9)
+            return True
+        return False
+
+    def resume(self):
+        """ Start queued portscans again """
+        with self._queue_cond:
+            self._halted = False
+            self._queue_cond.notify()
+
+    def ready(self):
+        """ Readiness probe: is nmap idle ? """
+        running = self._starting or (self._process is not None and self._process.isalive())
+        return {'nmap_idle': not running and not len(self._queue)}
 
     def poll_scan(self):
         logger.debug("Scan polled")
@@ -285,10 +434,10 @@ def add_traffic_event(struct, dst, port, item):
     """ Add a traffic event to the traffic structure """
     # Create intermediary dict
     if dst not in struct:
-        print 'creating ', dst
+        logger.debug("Traffic of %s created" % dst)
         struct[dst] = {}
     if port not in struct[dst]:
-        print 'creating ', port
+        logger.debug("Traffic of %s (port %s) created" % (dst, port))
         struct[dst][port] = []
 
     # Fill data 
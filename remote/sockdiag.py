@@ -0,0 +1,198 @@
+'''
+File: sockdiag.py
+Author: Damien Riquet
+Description: Snapshot of listening ports, queried from the kernel through netlink (sock_diag)
+             Sockets are dumped by the kernel in a binary form (NETLINK_SOCK_DIAG, inet_diag),
+             already filtered by state, instead of parsing /proc/net/tcp line by line:
+                * tcp: sockets in the LISTEN state,
+                * udp: unconnected sockets (CLOSE state),
+             for both IPv4 and IPv6. Only sockets bound to a wildcard address (0.0.0.0 or ::) are kept.
+
+             Snapshots are cached and only queried again when the generation of the socket tables
+             changes (numbers of sockets in use, read from /proc/net/sockstat and sockstat6),
+             or when the snapshot is older than max_age seconds.
+             /proc/net files are parsed when netlink cannot be used: for every query if sock_diag
+             is not supported by the kernel, only for the failed (protocol, family) otherwise
+             (for example, when the udp_diag module is not loaded).
+'''
+
+# Imports
+import os
+import errno
+import time
+import socket
+import struct
+import logging
+import threading
+
+# Local imports
+from portset import PortSet
+
+
+# Variables
+logger = logging.getLogger()
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+TCP_LISTEN = 10
+TCP_CLOSE = 7
+
+# Protocol -> (IP protocol, states of listening sockets)
+protocols = {
+    'tcp': (socket.IPPROTO_TCP, 1 << TCP_LISTEN),
+    'udp': (socket.IPPROTO_UDP, 1 << TCP_CLOSE),
+}
+
+# Errors raised when a netlink socket is opened if sock_diag is not supported
+netlink_unsupported = [errno.EPROTONOSUPPORT, errno.EAFNOSUPPORT, errno.ESOCKTNOSUPPORT]
+
+nlmsghdr = struct.Struct("=IHHII")
+inet_diag_req_v2 = struct.Struct("=BBBBIHH16s16sI8s") # Ports are in network byte order
+inet_diag_msg = struct.Struct("=BBBBHH16s16sI8sIIIII")
+
+
+def netlink_socket():
+    """ Open a netlink sock_diag socket """
+    return socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+
+def netlink_listening_ports(protocol, family, sock):
+    """ Return ports of sockets listening on a wildcard address (netlink sock_diag dump)
+        The socket (see netlink_socket) is closed once the dump is read
+    """
+    ip_protocol, states = protocols[protocol]
+    request = inet_diag_req_v2.pack(family, ip_protocol, 0, 0, states, 0, 0, "", "", 0, "")
+    header = nlmsghdr.pack(nlmsghdr.size + len(request), SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+
+    ports = PortSet()
+    try:
+        sock.sendto(header + request, (0, 0))
+        done = False
+        while not done:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + nlmsghdr.size <= len(data):
+                length, kind, flags, seq, pid = nlmsghdr.unpack_from(data, offset)
+                if kind == NLMSG_DONE:
+                    done = True
+                    break
+                if kind == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", data, offset + nlmsghdr.size)[0]
+                    raise socket.error(-error, os.strerror(-error))
+
+                msg = inet_diag_msg.unpack_from(data, offset + nlmsghdr.size)
+                sport, src = socket.ntohs(msg[4]), msg[6]
+                if not src[:4 if family == socket.AF_INET else 16].strip('\x00'):
+                    # Wildcard address
+                    ports.add(sport)
+
+                offset += (length + 3) & ~3
+            if not len(data):
+                break
+    finally:
+        sock.close()
+
+    return ports
+
+
+def proc_listening_ports(protocol, family, filename=None):
+    """ Return ports of sockets listening on a wildcard address (/proc/net files, or a copy of one) """
+    if filename is None:
+        filename = "/proc/net/%s%s" % (protocol, '6' if family == socket.AF_INET6 else '')
+    state = '%02X' % (TCP_LISTEN if protocol == 'tcp' else TCP_CLOSE)
+    ports = PortSet()
+
+    with open(filename, 'r') as f:
+        f.readline()
+        for line in f:
+            fields = line.split()
+            host, port = fields[1].split(':')
+            if fields[3] == state and not host.strip('0'):
+                ports.add(int(port, 16))
+
+    return ports
+
+
+class PortSnapshot():
+    """ Cached snapshot of listening ports (tcp and udp, IPv4 and IPv6) """
+
+    def __init__(self, max_age=5.0):
+        """ Initialize the snapshot, it is taken again after max_age seconds at most """
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._ports = {} # protocol -> PortSet
+        self._generation = None
+        self._taken = 0
+        self._netlink = hasattr(socket, 'AF_NETLINK')
+
+    def generation(self):
+        """ Cheap fingerprint of the socket tables: sockets in use of each protocol """
+        generation = []
+        for filename in ['/proc/net/sockstat', '/proc/net/sockstat6']:
+            try:
+                with open(filename, 'r') as f:
+                    for line in f:
+                        fields = line.split()
+                        if fields[0] in ['TCP:', 'UDP:', 'TCP6:', 'UDP6:']:
+                            generation.append((fields[0], fields[2]))
+            except IOError:
+                pass
+        return tuple(generation)
+
+    def take(self):
+        """ Query listening ports of every protocol and family """
+        ports = {}
+        for protocol in protocols:
+            ports[protocol] = PortSet()
+            for family in [socket.AF_INET, socket.AF_INET6]:
+                if self._netlink:
+                    try:
+                        ports[protocol] = ports[protocol] | self.query_netlink(protocol, family)
+                        continue
+                    except socket.error:
+                        pass
+                try:
+                    ports[protocol] = ports[protocol] | proc_listening_ports(protocol, family)
+                except IOError:
+                    # IPv6 is not available
+                    pass
+        return ports
+
+    def query_netlink(self, protocol, family):
+        """ Return listening ports of a protocol and family through netlink
+            If sock_diag is not supported, netlink is not used anymore, otherwise only this query
+            falls back to /proc/net (socket.error is raised in both cases)
+        """
+        name = "%s%s" % (protocol, '6' if family == socket.AF_INET6 else '')
+        try:
+            sock = netlink_socket()
+        except socket.error, err:
+            if err.errno in netlink_unsupported:
+                logger.warning("Netlink sock_diag is not supported (%s), /proc/net is parsed" % err)
+                self._netlink = False
+            else:
+                logger.warning("Netlink socket cannot be opened (%s), /proc/net/%s is parsed" % (err, name))
+            raise
+
+        try:
+            return netlink_listening_ports(protocol, family, sock)
+        except socket.error, err:
+            logger.warning("Netlink sock_diag dump of %s sockets failed (%s), /proc/net/%s is parsed" % (name, err, name))
+            raise
+
+    def ports(self, protocol='tcp'):
+        """ Return listening ports (PortSet) of the given protocol (tcp, udp or all) """
+        with self._lock:
+            generation = self.generation()
+            if generation != self._generation or time.time() - self._taken > self._max_age:
+                self._ports = self.take()
+                self._generation = generation
+                self._taken = time.time()
+
+            if protocol == 'all':
+                return self._ports['tcp'] | self._ports['udp']
+            return self._ports[protocol].copy()
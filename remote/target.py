@@ -3,9 +3,37 @@ File: target.py
 Author: Damien Riquet
 Description: Remote Python program that monitors incoming and outgoing network packets
              This program features some RPC methods :
-                * start_monitor(ip): tell this programs to start to  filter packets according to these ips,
+                * start_monitor(ip, epoch, ports): tell this programs to start to  filter packets according to these ips,
+                  if the monitor is already running, only the ips and the epoch are updated
+                  (ports are only used by the counters mode),
                 * stop_monitor(): tell this programs to stop filtering packets according to these ips,
-                * get_traffic(): get the traffic associated with the given ip
+                  it returns once the monitor is stopped (the time it took is returned),
+                * monitor_latency(): time taken by the last start and stop of the monitor,
+                * get_open_ports(protocol): get listening ports (tcp by default)
+                * get_traffic(epoch): get the traffic captured during the given epoch
+                * get_digest(epoch, capacity, error_rate, connect): get a Bloom filter of the traffic
+                  captured during the given epoch instead of the traffic itself (see bloom.py)
+                * verify_traffic(epoch, expected, connect): verify locally that the packets sent by scanners
+                  have been received during the given epoch, only mismatches are returned
+                * capture_stats(): capture statistics (packets received, kept and dropped by the kernel)
+                * ready(): readiness probe (monitor socket open)
+
+             The monitor is persistent: it runs across a whole campaign and captured packets
+             are tagged with the epoch (experiment) during which they have been received.
+             A single monitor runs at a time. In scapy mode, its thread waits for packets with
+             select (at most poll seconds) and is woken up through a pipe when it has to stop,
+             so that stopping does not depend on incoming packets.
+
+             Capture modes are:
+                * scapy: one thread reading one scapy socket (default), scapy is only imported
+                  by this mode, in the background while RPC methods are already served,
+                * fanout: several AF_PACKET sockets in a fanout group, each one drained by
+                  its own process (see capture.py),
+                * ring: memory mapped TPACKET_V3 rings, packets are written into a capture file
+                  per epoch and decoded when the traffic is fetched (memory is bounded),
+                * counters: packets are counted by the kernel for each (scanner, port), there is no
+                  packet processing in user space; get_traffic returns counts: scanner -> port -> packets
+                  (see counters.py).
 '''
 
 # Imports
@@ -15,21 +43,45 @@ import logging
 import re
 import sys
 import getopt
+import select
 import threading
-from SimpleXMLRPCServer import SimpleXMLRPCServer
-from scapy.all import *
+import importlib
+
+# Local imports
+from rpcserver import ThreadedXMLRPCServer, process_age
+import bloom
+import capture
+import counters
+import sockdiag
 
 # Variables
+imported = process_age() # Interpreter startup and imports (seconds)
 logger = logging.getLogger()
 
+scapy = None # scapy.all module, only imported by the scapy capture mode (see load_scapy)
+scapy_lock = threading.Lock()
+
+
+def load_scapy():
+    """ Import scapy (it takes seconds and a lot of memory), once """
+    global scapy
+    with scapy_lock:
+        if scapy is None:
+            begin = time.time()
+            scapy = importlib.import_module('scapy.all')
+            logger.info("scapy imported in %.2fs" % (time.time() - begin))
+    return scapy
+
+
 # Classes
 class Target:
     """ Target class """
-    def __init__(self, interface="eth0", addr=("localhost", 8000), debug=True):
+    def __init__(self, interface="eth0", addr=("localhost", 8000), debug=True, mode="scapy", workers=4,
+                 directory="log/capture", poll=0.5):
         # Attributes
         self._monitor = []
-        self._traffic = {}
-        self._open_ports = []
+        self._traffic = {} # Captured traffic of each epoch
+        self._ports = sockdiag.PortSnapshot() # Listening ports
         self._addr = addr
 
         # Init
@@ -38,16 +90,44 @@ class Target:
 
         # Monitor attributes
         self._active = False
+        self._listening = False # The monitor socket is open
         self._iface = interface
+        self._thread = None
+        self._lock = threading.Lock() # Start and stop of the monitor
+        self._wakeup = os.pipe() # Wakes the monitor thread up when it has to stop
+        self._poll = poll
+        self._requested = 0 # Time of the last start request
+        self._latency = {'start': None, 'stop': None}
+        self._ips = []
+        self._epoch = 0 # Captured packets are tagged with the current epoch
+
+        # Capture shared between worker processes (fanout and ring modes)
+        self._capture = None
+        if mode == "fanout":
+            self._capture = capture.FanoutCapture(interface, workers)
+        elif mode == "ring":
+            self._capture = capture.RingCapture(interface, workers, directory)
+        elif mode == "counters":
+            self._capture = counters.KernelCounters()
+        else:
+            # scapy is imported in the background: RPC methods are served meanwhile
+            t = threading.Thread(target=load_scapy)
+            t.daemon = True
+            t.start()
 
     def init_rpc(self):
         """ Initialization of RPC remote methods """
-        self._server =  SimpleXMLRPCServer(self._addr, allow_none=True)
+        self._server =  ThreadedXMLRPCServer(self._addr, allow_none=True, imported=imported)
         # Registering commands
         self._server.register_function(self.start_monitor_rpc, "start_monitor")
         self._server.register_function(self.stop_monitor, "stop_monitor")
         self._server.register_function(self.get_traffic, "get_traffic")
+        self._server.register_function(self.get_digest, "get_digest")
+        self._server.register_function(self.verify_traffic, "verify_traffic")
         self._server.register_function(self.get_open_ports, "get_open_ports")
+        self._server.register_function(self.capture_stats, "capture_stats")
+        self._server.register_function(self.monitor_latency, "monitor_latency")
+        self._server.register_function(self.ready, "ready")
 
     def init_logging(self, debug=False):
         """ Initialization of the logging module 
@@ -74,75 +154,179 @@ class Target:
             logger.setLevel(logging.INFO)
 
             
-    def start_monitor_rpc(self, ips):
-        """ RPC method: launch a thread that creates the snitch """
-        t = threading.Timer(0, self.start_monitor, [ips])
-        t.start()
-
-    def get_open_ports(self):
-        """ Return a list containing open ports 
-            Actually, it will only return tcp open ports
-            This will work on a unix host for which port state can be accessed thanks to /proc/net/tcp file
+    def start_monitor_rpc(self, ips, epoch=0, ports=None):
+        """ RPC method: launch a thread that creates the monitor
+            If the monitor is already running, the epoch is advanced and monitored ips are updated
+        """
+        requested = time.time()
+        with self._lock:
+            self.set_epoch(epoch, ips)
+
+            if self._capture is not None:
+                # Workers are started if needed, their epoch is advanced
+                self._capture.start(ips, epoch, ports)
+                self._active = True
+                self._latency['start'] = time.time() - requested
+                return
+
+            if self._thread is not None and self._thread.is_alive():
+                if self._active:
+                    logger.info("Monitor already running, epoch %d" % epoch)
+                    self._latency['start'] = time.time() - requested
+                    return
+
+                # The previous monitor is still stopping
+                self._thread.join(self._poll * 2)
+                if self._thread.is_alive():
+                    logger.warning("Previous monitor has not stopped, not restarted")
+                    return
+
+            self._active = True
+            self._listening = False
+            self._requested = requested
+            self._thread = threading.Thread(target=self.start_monitor, args=[ips])
+            self._thread.daemon = True
+            self._thread.start()
+
+    def set_epoch(self, epoch, ips):
+        """ Advance the epoch, older epochs that have not been fetched are dropped """
+        self._ips = list(ips)
+        self._epoch = epoch
+        for old_epoch in [e for e in self._traffic if e < epoch]:
+            del self._traffic[old_epoch]
+        self._traffic.setdefault(epoch, {})
+
+    def get_open_ports(self, protocol="tcp"):
+        """ Return open ports of the given protocol (tcp, udp or all) as a range string ("22,80-90")
+            Ports of sockets listening on a wildcard address, IPv4 or IPv6, are returned
+            The snapshot is queried from the kernel (see sockdiag.py), and cached until sockets change
         """
         logger.info("Fetching ports state")
-
-        # Read the content of the /proc/net/tcp file
-        with open('/proc/net/tcp', 'r') as f:
-            content = f.readlines()
-            content.pop(0)
-
-        # Processing each line
-        # We are looking for listening port (state '0A')
-        # Each line is formatted as follows:
-        # id local_ip:local_port remote_ip:remote_port state ....
-        open_ports = []
-
-        for line in content:
-            line_array = [x for x in line.split(' ') if x != '']
-            port_state = line_array[3]
-
-            if port_state == '0A':
-                # Listening port, add" it to the open ports list
-                # Fetch port number
-                host,port = line_array[1].split(':')
-                port = str(int(port, 16))
-
-
-                # Verifying it is an open port
-                if host != '00000000':
-                    continue
-
-                # Add it to the ports list
-                open_ports.append(port)
-                logger.info("Port %s is open" % port)
-
-        return open_ports
-
-        
-        
+        open_ports = self._ports.ports(protocol)
+        logger.info("%d %s port(s) open: %s" % (len(open_ports), protocol, open_ports))
+        return str(open_ports)
 
     def stop_monitor(self):
-        """ Stop the monitor """
+        """ Stop the monitor and wait until it is stopped
+            Return the time it took (seconds)
+        """
         logger.info("Stopping the monitor ...")
-        self._active = False
-
-    def get_traffic(self):
-        """ Return the traffic monitored """
-        logger.info("Getting the monitored traffic")
-        return self._traffic
+        begin = time.time()
+        with self._lock:
+            self._active = False
+            if self._capture is not None:
+                self._capture.stop()
+            elif self._thread is not None:
+                os.write(self._wakeup[1], 'x')
+                self._thread.join(self._poll * 2)
+                if self._thread.is_alive():
+                    logger.warning("Monitor has not stopped in %.2fs" % (self._poll * 2))
+            self._listening = False
+
+        self._latency['stop'] = time.time() - begin
+        logger.info("Monitor stopped in %.3fs" % self._latency['stop'])
+        return self._latency['stop']
+
+    def monitor_latency(self):
+        """ Return the time taken by the last start (until the monitor listens) and stop of the monitor """
+        return dict(self._latency)
+
+    def ready(self):
+        """ Readiness probe: is the monitor socket open ? """
+        if self._capture is not None:
+            return {'monitor': self._active and self._capture.listening()}
+        return {'monitor': self._active and self._listening}
+
+    def capture_stats(self):
+        """ Return capture statistics (fanout, ring and counters modes only) """
+        if self._capture is None:
+            return {}
+        return self._capture.stats()
+
+    def get_traffic(self, epoch=None):
+        """ Return the traffic monitored during the given epoch (default is the current one) """
+        if epoch is None:
+            epoch = self._epoch
+        logger.info("Getting the monitored traffic (epoch %d)" % epoch)
+        if self._capture is not None:
+            return self._capture.traffic(epoch)
+        return self._traffic.get(epoch, {})
+
+    def get_digest(self, epoch=None, capacity=1, error_rate=0.001, connect=False):
+        """ Return a Bloom filter containing a key per packet monitored during the given epoch
+                - capacity: expected number of packets, the filter is sized for it,
+                - error_rate: false positive rate of the filter,
+                - connect: seq values are not inserted (-sT scans)
+            Counts (counters mode) are not inserted
+        """
+        digest = bloom.BloomFilter(capacity, error_rate)
+        for scanner, ports in self.get_traffic(epoch).items():
+            for port, pkts in ports.items():
+                if isinstance(pkts, int):
+                    continue
+                for pkt in pkts:
+                    digest.add(bloom.packet_key(scanner, port, pkt[0], None if connect else pkt[1]))
+
+        logger.info("Digest of %d packet(s) - %d bytes" % (len(digest), digest.nbytes()))
+        return digest.dump()
+
+    def verify_traffic(self, epoch, expected, connect=False):
+        """ Verify that packets sent by scanners have been received during the given epoch
+                - expected: scanner -> port -> packets (flags, seq) sent by the scanner,
+                - connect: seq values are not compared (-sT scans)
+            A port passes if every packet sent to it has been received
+            Return {'passed': number of ports that passed, 'failed': scanner -> port -> missing packets}
+        """
+        traffic = self.get_traffic(epoch)
+        passed = 0
+        failed = {}
+
+        for scanner, ports in expected.items():
+            received = dict([(str(port), pkts) for port, pkts in traffic.get(scanner, {}).items()])
+
+            for port, pkts in ports.items():
+                if isinstance(received.get(str(port)), int):
+                    # Counters mode: only the number of received packets is known
+                    missing = pkts[received[str(port)]:]
+                else:
+                    # Index of received packets of this port
+                    index = set([bloom.packet_key(scanner, port, pkt[0], None if connect else pkt[1])
+                                 for pkt in received.get(str(port), [])])
+                    missing = [pkt for pkt in pkts
+                               if bloom.packet_key(scanner, port, pkt[0], None if connect else pkt[1]) not in index]
+
+                if len(missing):
+                    failed.setdefault(scanner, {})[str(port)] = missing
+                else:
+                    passed += 1
+
+        logger.info("Traffic verified (epoch %d) - %d port(s) passed - %d failed" \
+                % (epoch, passed, sum([len(ports) for ports in failed.values()])))
+        return {'passed': passed, 'failed': failed}
 
     def start_monitor(self, ips):
-        logger.info(ips)
         """ Start a monitoring session filtering to the given ips """
+        logger.info(ips)
         # Create the scapy socket
-        lsock = L2ListenSocket(iface=self._iface, promisc=0)
+        scapy = load_scapy()
+        lsock = scapy.L2ListenSocket(iface=self._iface, promisc=0)
 
-        self._active = True
-        self._traffic = {}
+        self._listening = True
+        self._latency['start'] = time.time() - self._requested
 
         while self._active:
+            # Wait for a packet, or to be woken up (stop)
+            readable, _, _ = select.select([lsock, self._wakeup[0]], [], [], self._poll)
+            if self._wakeup[0] in readable:
+                os.read(self._wakeup[0], 512)
+                continue
+            if lsock not in readable:
+                continue
+
             # Receive instruction
-            pkt = lsock.recv(MTU)
+            pkt = lsock.recv(scapy.MTU)
+            if pkt is None:
+                continue
             logger.debug("Received a packet")
 
             # Filter tcp packet
@@ -151,6 +335,7 @@ class Target:
                 continue
 
             # Filter monitored ips
+            ips = self._ips
             if not (pkt.sprintf("%IP.src%") in ips) and \
                not (pkt.sprintf("%IP.dst%") in ips):
                 logger.debug("Packet outside monitored hosts list - src %s dst %s" % (pkt.sprintf("%IP.src%"), pkt.sprintf("%IP.dst%")))
@@ -180,17 +365,18 @@ class Target:
                         (ip_scanner, ip_target, target_port, ip_flags, ip_seq))
 
                 # Create dict and list if needed
-                if ip_scanner not in self._traffic:
-                    self._traffic[ip_scanner] = {}
-                if target_port not in self._traffic[ip_scanner]:
-                    self._traffic[ip_scanner][target_port] = []
+                traffic = self._traffic.setdefault(self._epoch, {})
+                if ip_scanner not in traffic:
+                    traffic[ip_scanner] = {}
+                if target_port not in traffic[ip_scanner]:
+                    traffic[ip_scanner][target_port] = []
 
 
 
 
                 pkt_info = (ip_flags, ip_seq, pkt_time)
                 logger.debug(pkt_info)
-                self._traffic[ip_scanner][target_port].append(pkt_info)
+                traffic[ip_scanner][target_port].append(pkt_info)
             else:
                 # Sent packet or something else
                #ip_scanner = ip_dst
@@ -212,16 +398,22 @@ def usage(name):
     print "     -d <dev>  : Interface used to sniff traffic (default is eth0)"
     print "     -i <ip>   : IP Address reacheable using RPC (default is localhost)"
     print "     -p <port> : Port used for RPC methods (default is 8000)"
+    print "     -m <mode> : Capture mode, scapy, fanout, ring or counters (default is scapy)"
+    print "     -w <nb>   : Number of capture workers in fanout and ring modes (default is 4)"
+    print "     -o <dir>  : Directory of capture files in ring mode (default is log/capture)"
 
 # Main
 if __name__ == '__main__':
     # Variables
     remoteAddr = ("localhost", 8000)
     interface = "eth0"
+    mode = "scapy"
+    workers = 4
+    directory = "log/capture"
 
     # Parsing arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'd:i:p:h')
+        opts, args = getopt.getopt(sys.argv[1:], 'd:i:p:m:w:o:h')
     except getopt.GetoptError, err:
         print "Bad arguments"
         print str(err)
@@ -235,6 +427,12 @@ if __name__ == '__main__':
             remoteAddr = (a,remoteAddr[1])
         elif o == "-p":
             remoteAddr = (remoteAddr[0],int(a))
+        elif o == "-m":
+            mode = a
+        elif o == "-w":
+            workers = int(a)
+        elif o == "-o":
+            directory = a
         elif o == "-h":
             usage(sys.argv[0])
             sys.exit(2)
@@ -242,7 +440,7 @@ if __name__ == '__main__':
             print "Unknown option"
 
     # Initialisation
-    target = Target(interface, remoteAddr, debug=False)
+    target = Target(interface, remoteAddr, debug=False, mode=mode, workers=workers, directory=directory)
 
     # Serving forever
     try:
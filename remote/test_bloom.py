@@ -0,0 +1,66 @@
+'''
+File: test_bloom.py
+Author: Damien Riquet
+Description: Unit tests of bloom.py
+
+             It has to be launched from the root of the project:
+                python -m unittest remote.test_bloom
+'''
+
+# Imports
+import unittest
+import xmlrpclib
+
+# Local imports
+from bloom import BloomFilter, packet_key
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = [packet_key("10.0.0.%d" % (i % 8), i, 'S', 1000 + i) for i in range(1000)]
+        self.bloom = BloomFilter(len(self.keys), 0.01)
+        for key in self.keys:
+            self.bloom.add(key)
+
+    def test_packet_key(self):
+        self.assertEqual(packet_key("10.0.0.1", "22", 'S', 42), "10.0.0.1:22:S:42")
+        self.assertEqual(packet_key("10.0.0.1", 22, 'S'), "10.0.0.1:22:S")
+
+    def test_no_false_negative(self):
+        for key in self.keys:
+            self.assertTrue(key in self.bloom)
+        self.assertEqual(len(self.bloom), len(self.keys))
+
+    def test_error_rate(self):
+        others = [packet_key("10.0.1.%d" % (i % 8), i, 'S', 1000 + i) for i in range(10000)]
+        false_positives = len([key for key in others if key in self.bloom])
+        self.assertTrue(false_positives < 10000 * 0.01 * 2)
+        self.assertTrue(self.bloom.estimated_error_rate() < 0.02)
+
+    def test_sizing(self):
+        # m = -n * ln(p) / ln(2)^2 bits, k = m / n * ln(2)
+        bloom = BloomFilter(1000, 0.01)
+        self.assertEqual(bloom.nbytes(), 1199)
+        self.assertEqual(bloom._hashes, 7)
+        self.assertEqual(BloomFilter(0).nbytes(), 2)
+
+    def test_dump_load(self):
+        bloom = BloomFilter.load(self.bloom.dump())
+        self.assertEqual(bloom.nbytes(), self.bloom.nbytes())
+        self.assertEqual(len(bloom), len(self.bloom))
+        self.assertEqual(bloom.error_rate(), 0.01)
+        for key in self.keys:
+            self.assertTrue(key in bloom)
+
+    def test_dump_xmlrpc(self):
+        # Filters are sent by targets to the coordinator
+        data = xmlrpclib.dumps((self.bloom.dump(),), methodresponse=True)
+        bloom = BloomFilter.load(xmlrpclib.loads(data)[0][0])
+        self.assertEqual(bloom._bits, self.bloom._bits)
+        self.assertEqual(bloom._hashes, self.bloom._hashes)
+        self.assertEqual(bloom.positions(self.keys[0]), self.bloom.positions(self.keys[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+'''
+File: test_counters.py
+Author: Damien Riquet
+Description: Unit tests of counters.py, on recorded outputs of nft and iptables (fixtures/)
+             Commands are not run: counters.run is replaced by a recorder.
+
+             It has to be launched from the root of the project:
+                python -m unittest remote.test_counters
+'''
+
+# Imports
+import os
+import unittest
+
+# Local imports
+import counters
+from portset import PortSet
+
+
+# Variables
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+expected = {'192.168.1.11': {'22': 1, '80': 2}, '192.168.1.12': {'443': 1}}
+
+
+def fixture(filename):
+    """ Content of a fixture file """
+    with open(os.path.join(fixtures, filename), 'r') as f:
+        return f.read()
+
+
+class Recorder():
+    """ Stand-in of counters.run: commands are recorded, outputs are given by the first matching prefix """
+
+    def __init__(self, outputs=None):
+        self.commands = []
+        self.outputs = outputs or []
+
+    def __call__(self, command, data=None):
+        self.commands.append((command, data))
+        for prefix, output in self.outputs:
+            if command[:len(prefix)] == prefix:
+                return output
+        return ""
+
+
+class ParsingTest(unittest.TestCase):
+
+    def test_nft_set(self):
+        counts = counters.parse_nft_set(fixture('nft_list_set.json'))
+        self.assertEqual(counts, {'192.168.1.11': {'22': 1, '80': 2}, '192.168.1.12': {'443': 1, '8080': 3}})
+
+    def test_nft_empty_set(self):
+        # Sets without any element have no elem key
+        self.assertEqual(counters.parse_nft_set(fixture('nft_list_set_empty.json')), {})
+
+    def test_iptables_chain(self):
+        # Rules without packets are ignored
+        self.assertEqual(counters.parse_iptables_chain(fixture('iptables_list_chain.txt')), expected)
+
+    def test_iptables_numeric_protocol(self):
+        self.assertEqual(counters.parse_iptables_chain(fixture('iptables_list_chain_numeric.txt')), expected)
+
+    def test_iptables_other_rules(self):
+        output = fixture('iptables_list_chain.txt') \
+                + "       5      220 ACCEPT     tcp  --  *      *       192.168.1.13         0.0.0.0/0            tcp dpt:22\n" \
+                + "       5      220 RETURN     udp  --  *      *       192.168.1.13         0.0.0.0/0            udp dpt:53\n"
+        self.assertEqual(counters.parse_iptables_chain(output), expected)
+
+
+class RulesTest(unittest.TestCase):
+
+    def test_nft_commands(self):
+        commands = counters.nft_commands(['192.168.1.11', '192.168.1.12'])
+        self.assertEqual(commands.splitlines(), [
+            "flush set ip dsbench probes",
+            "flush set ip dsbench scanners",
+            "add element ip dsbench scanners { 192.168.1.11, 192.168.1.12 }"])
+
+    def test_nft_commands_create(self):
+        commands = counters.nft_commands([], True)
+        self.assertTrue(commands.startswith(counters.nft_ruleset % {'table': counters.table}))
+        self.assertFalse('add element' in commands)
+
+    def test_iptables_rules(self):
+        rules = counters.iptables_rules(['192.168.1.11', '192.168.1.12'], PortSet.parse("22,80"))
+        self.assertEqual(rules.splitlines(), [
+            "*raw",
+            ":dsbench - [0:0]",
+            "-A dsbench -s 192.168.1.11/32 -p tcp -m tcp --dport 22 -j RETURN",
+            "-A dsbench -s 192.168.1.11/32 -p tcp -m tcp --dport 80 -j RETURN",
+            "-A dsbench -s 192.168.1.12/32 -p tcp -m tcp --dport 22 -j RETURN",
+            "-A dsbench -s 192.168.1.12/32 -p tcp -m tcp --dport 80 -j RETURN",
+            "COMMIT"])
+
+
+class KernelCountersTest(unittest.TestCase):
+
+    def setUp(self):
+        self._run = counters.run
+
+    def tearDown(self):
+        counters.run = self._run
+
+    def test_nft_epochs(self):
+        counters.run = Recorder([(['nft', '-j'], fixture('nft_list_set.json'))])
+        kernel = counters.KernelCounters('nft')
+        self.assertEqual(kernel.traffic(1), {})
+
+        kernel.start(['192.168.1.11'], 1)
+        self.assertTrue(kernel.alive())
+        self.assertEqual(kernel.traffic(1)['192.168.1.12'], {'443': 1, '8080': 3})
+
+        # Counters of the previous epoch are kept, then flushed
+        kernel.start(['192.168.1.11'], 2)
+        counters.run.outputs = [(['nft', '-j'], fixture('nft_list_set_empty.json'))]
+        self.assertEqual(kernel.traffic(2), {})
+        self.assertEqual(kernel.traffic(1)['192.168.1.11'], {'22': 1, '80': 2})
+        self.assertEqual(kernel.traffic(0), {})
+
+    def test_iptables_ports(self):
+        counters.run = Recorder([(['iptables', '-t', 'raw', '-L'], fixture('iptables_list_chain.txt'))])
+        kernel = counters.KernelCounters('iptables')
+        self.assertRaises(ValueError, kernel.start, ['192.168.1.11'], 1)
+
+        kernel.start(['192.168.1.11', '192.168.1.12'], 1, "22,80,443")
+        restore = [data for command, data in counters.run.commands if command[0] == 'iptables-restore']
+        self.assertEqual(restore, [counters.iptables_rules(['192.168.1.11', '192.168.1.12'], PortSet.parse("22,80,443"))])
+        self.assertEqual(kernel.stats()['kept'], 4)
+
+        # Ports of the previous epoch are used again
+        counters.run.commands = []
+        kernel.start(['192.168.1.11'], 2)
+        restore = [data for command, data in counters.run.commands if command[0] == 'iptables-restore']
+        self.assertEqual(restore, [counters.iptables_rules(['192.168.1.11'], PortSet.parse("22,80,443"))])
+        self.assertEqual(kernel.traffic(1), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
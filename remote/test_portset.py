@@ -0,0 +1,104 @@
+'''
+File: test_portset.py
+Author: Damien Riquet
+Description: Unit tests of portset.py
+
+             It has to be launched from the root of the project:
+                python -m unittest remote.test_portset
+'''
+
+# Imports
+import random
+import unittest
+
+# Local imports
+from portset import PortSet, MAX_PORT
+
+
+class ParsingTest(unittest.TestCase):
+
+    def test_range_string(self):
+        for value in ["22", "22,80-90,443", "0-1023", "0,65535", "1-65535", "1,3,5-6,8"]:
+            self.assertEqual(str(PortSet.parse(value)), value)
+
+    def test_unordered_string(self):
+        portset = PortSet.parse(" 443, 80-90,22,85 ,,")
+        self.assertEqual(str(portset), "22,80-90,443")
+        self.assertEqual(len(portset), 13)
+
+    def test_list(self):
+        self.assertEqual(str(PortSet.parse([80, "22", "100-102", 81])), "22,80-81,100-102")
+        self.assertEqual(str(PortSet.parse(8080)), "8080")
+
+    def test_empty(self):
+        self.assertEqual(str(PortSet.parse("")), "")
+        self.assertEqual(PortSet().ranges(), [])
+
+    def test_portset(self):
+        portset = PortSet.parse("1-10")
+        self.assertTrue(PortSet.parse(portset) is portset)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, PortSet.parse, "65536")
+        self.assertRaises(ValueError, PortSet.parse, "-1")
+        self.assertRaises(ValueError, PortSet.parse, "http")
+
+    def test_random_round_trip(self):
+        rand = random.Random(0)
+        for i in range(20):
+            ports = set([rand.randint(0, MAX_PORT) for j in range(rand.randint(1, 2000))])
+            portset = PortSet(ports)
+            self.assertEqual(list(portset), sorted(ports))
+            self.assertEqual(PortSet.parse(str(portset)), portset)
+            self.assertEqual(PortSet.parse(repr(portset)[9:-2]), portset)
+
+
+class SetTest(unittest.TestCase):
+
+    def test_membership(self):
+        portset = PortSet.parse("22,80-90")
+        self.assertTrue(22 in portset)
+        self.assertTrue("85" in portset)
+        self.assertFalse(91 in portset)
+        self.assertFalse(-1 in portset)
+        self.assertFalse(70000 in portset)
+        self.assertFalse("ssh" in portset)
+
+    def test_add_discard(self):
+        portset = PortSet()
+        portset.add(80)
+        portset.add(80)
+        portset.add_range(1, 3)
+        self.assertEqual(len(portset), 4)
+        portset.discard(2)
+        portset.discard(2)
+        portset.discard(70000)
+        self.assertEqual(str(portset), "1,3,80")
+        self.assertEqual(len(portset), 3)
+        self.assertRaises(ValueError, portset.add, MAX_PORT + 1)
+
+    def test_getitem(self):
+        portset = PortSet.parse("22,80-90,443")
+        ports = list(portset)
+        for i in range(len(ports)):
+            self.assertEqual(portset[i], ports[i])
+        self.assertEqual(portset[-1], 443)
+        self.assertRaises(IndexError, portset.__getitem__, len(ports))
+
+        # The index is rebuilt when the set is modified
+        portset.add(23)
+        self.assertEqual(portset[1], 23)
+
+    def test_operations(self):
+        a = PortSet.parse("1-10")
+        b = PortSet.parse("5-15")
+        self.assertEqual(str(a | b), "1-15")
+        self.assertEqual(str(a & b), "5-10")
+        self.assertEqual(str(a - b), "1-4")
+        self.assertEqual(len(a - b), 4)
+        self.assertTrue(a != b)
+        self.assertEqual(a.copy(), a)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+'''
+File: test_sockdiag.py
+Author: Damien Riquet
+Description: Unit tests of sockdiag.py, on crafted netlink dumps and a recorded /proc/net/tcp (fixtures/)
+             Netlink sockets are replaced by stand-ins.
+
+             It has to be launched from the root of the project:
+                python -m unittest remote.test_sockdiag
+'''
+
+# Imports
+import os
+import errno
+import socket
+import struct
+import unittest
+
+# Local imports
+import sockdiag
+from portset import PortSet
+
+
+# Variables
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def diag_message(port, address, family=socket.AF_INET, state=sockdiag.TCP_LISTEN):
+    """ inet_diag message of a socket bound to address:port, with its netlink header """
+    src = socket.inet_pton(family, address).ljust(16, '\x00')
+    msg = sockdiag.inet_diag_msg.pack(family, state, 0, 0, socket.htons(port), 0, src, '\x00' * 16, 0, '\x00' * 8,
+                                      0, 0, 0, 0, 1000 + port)
+    return sockdiag.nlmsghdr.pack(sockdiag.nlmsghdr.size + len(msg), sockdiag.SOCK_DIAG_BY_FAMILY, 2, 1, 0) + msg
+
+def control_message(kind, error=0):
+    """ NLMSG_DONE or NLMSG_ERROR message """
+    payload = struct.pack("=i", error)
+    return sockdiag.nlmsghdr.pack(sockdiag.nlmsghdr.size + len(payload), kind, 2, 1, 0) + payload
+
+
+class FakeSocket():
+    """ Stand-in of a netlink socket: datagrams are returned in turn """
+
+    def __init__(self, datagrams):
+        self.datagrams = list(datagrams)
+        self.sent = []
+        self.closed = False
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+    def recv(self, size):
+        return self.datagrams.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class NetlinkTest(unittest.TestCase):
+
+    def test_request(self):
+        sock = FakeSocket([control_message(sockdiag.NLMSG_DONE)])
+        sockdiag.netlink_listening_ports('udp', socket.AF_INET6, sock)
+        length, kind, flags, seq, pid = sockdiag.nlmsghdr.unpack_from(sock.sent[0])
+        request = sockdiag.inet_diag_req_v2.unpack_from(sock.sent[0], sockdiag.nlmsghdr.size)
+        self.assertEqual((length, kind, flags), (len(sock.sent[0]), sockdiag.SOCK_DIAG_BY_FAMILY, 0x301))
+        self.assertEqual(request[:5], (socket.AF_INET6, socket.IPPROTO_UDP, 0, 0, 1 << sockdiag.TCP_CLOSE))
+
+    def test_dump(self):
+        # Messages span several datagrams, only wildcard addresses are kept
+        sock = FakeSocket([diag_message(22, '0.0.0.0') + diag_message(25, '127.0.0.1'),
+                           diag_message(80, '0.0.0.0') + control_message(sockdiag.NLMSG_DONE)])
+        self.assertEqual(str(sockdiag.netlink_listening_ports('tcp', socket.AF_INET, sock)), "22,80")
+        self.assertTrue(sock.closed)
+
+    def test_dump_ipv6(self):
+        sock = FakeSocket([diag_message(443, '::', socket.AF_INET6) + diag_message(8080, '::1', socket.AF_INET6),
+                           control_message(sockdiag.NLMSG_DONE)])
+        self.assertEqual(str(sockdiag.netlink_listening_ports('tcp', socket.AF_INET6, sock)), "443")
+
+    def test_error(self):
+        sock = FakeSocket([control_message(sockdiag.NLMSG_ERROR, -errno.ENOENT)])
+        try:
+            sockdiag.netlink_listening_ports('udp', socket.AF_INET, sock)
+            self.fail("socket.error not raised")
+        except socket.error, err:
+            self.assertEqual(err.errno, errno.ENOENT)
+        self.assertTrue(sock.closed)
+
+
+class ProcTest(unittest.TestCase):
+
+    def test_proc_tcp(self):
+        ports = sockdiag.proc_listening_ports('tcp', socket.AF_INET, os.path.join(fixtures, 'proc_net_tcp.txt'))
+        self.assertEqual(str(ports), "22,111")
+
+
+class PortSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self._functions = (sockdiag.netlink_socket, sockdiag.netlink_listening_ports, sockdiag.proc_listening_ports)
+        self.proc_queries = []
+        sockdiag.proc_listening_ports = self.proc_listening_ports
+        sockdiag.logger.disabled = True
+
+    def tearDown(self):
+        sockdiag.netlink_socket, sockdiag.netlink_listening_ports, sockdiag.proc_listening_ports = self._functions
+        sockdiag.logger.disabled = False
+
+    def proc_listening_ports(self, protocol, family):
+        self.proc_queries.append((protocol, family))
+        return PortSet([1000])
+
+    def test_unsupported(self):
+        def netlink_socket():
+            raise socket.error(errno.EPROTONOSUPPORT, os.strerror(errno.EPROTONOSUPPORT))
+        sockdiag.netlink_socket = netlink_socket
+
+        snapshot = sockdiag.PortSnapshot()
+        snapshot._netlink = True
+        self.assertEqual(str(snapshot.take()['tcp']), "1000")
+        self.assertFalse(snapshot._netlink)
+        self.assertEqual(len(self.proc_queries), 4)
+
+    def test_failed_query(self):
+        # udp_diag is not loaded: only udp queries fall back to /proc/net
+        def netlink_listening_ports(protocol, family, sock):
+            if protocol == 'udp':
+                raise socket.error(errno.ENOENT, os.strerror(errno.ENOENT))
+            return PortSet([22])
+        sockdiag.netlink_socket = lambda: None
+        sockdiag.netlink_listening_ports = netlink_listening_ports
+
+        snapshot = sockdiag.PortSnapshot()
+        snapshot._netlink = True
+        for i in range(2):
+            ports = snapshot.take()
+            self.assertEqual((str(ports['tcp']), str(ports['udp'])), ("22", "1000"))
+        self.assertTrue(snapshot._netlink)
+        self.assertEqual(self.proc_queries, [('udp', socket.AF_INET), ('udp', socket.AF_INET6)] * 2)
+
+    def test_socket_error(self):
+        # Netlink is used again once the socket can be opened
+        errors = [errno.EMFILE]
+        def netlink_socket():
+            if len(errors):
+                error = errors.pop()
+                raise socket.error(error, os.strerror(error))
+        sockdiag.netlink_socket = netlink_socket
+        sockdiag.netlink_listening_ports = lambda protocol, family, sock: PortSet([22])
+
+        snapshot = sockdiag.PortSnapshot()
+        snapshot._netlink = True
+        ports = snapshot.take()
+        self.assertEqual(str(ports['tcp'] | ports['udp']), "22,1000")
+        self.assertTrue(snapshot._netlink)
+        self.assertEqual(len(self.proc_queries), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
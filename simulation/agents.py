@@ -0,0 +1,324 @@
+'''
+File: agents.py
+Author: Damien Riquet
+Description: Stand-in scanners, targets and firewalls of the simulation
+             Stand-in agents expose the RPC methods of remote/scanner.py, remote/target.py and
+             remote/firewall.py (rpc_methods of each class), but nmap, raw sockets and Snort are
+             replaced by a simulated network following a model (see models.py):
+                * a portscan lasts the duration given by the model, its probes are sent
+                  through the network when it ends,
+                * the network delivers probes to targets (unless they are lost),
+                  and shows them to firewalls,
+                * a firewall detects a scanner once it has seen threshold probes from it.
+
+             Timers of every agent are run by one thread (Clock), events are sent to the
+             coordinator through the notify function of the network (see transport.py).
+'''
+
+# Imports
+import time
+import heapq
+import itertools
+import threading
+
+# Local imports
+from remote.portset import PortSet
+from remote import target as remote_target
+
+
+class Clock():
+    """ Timers of every stand-in agent, run by one thread """
+
+    def __init__(self):
+        self._timers = [] # heap of (time, sequence, function, args)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def schedule(self, delay, function, *args):
+        """ Call function(*args) after delay seconds """
+        with self._cond:
+            heapq.heappush(self._timers, (time.time() + delay, next(self._sequence), function, args))
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not len(self._timers) or self._timers[0][0] > time.time():
+                    self._cond.wait(self._timers[0][0] - time.time() if len(self._timers) else None)
+                when, sequence, function, args = heapq.heappop(self._timers)
+
+            function(*args)
+
+
+class Network():
+    """ Simulated network: probes sent by scanners reach targets and are seen by firewalls """
+
+    def __init__(self, model):
+        self.model = model
+        self.clock = Clock()
+        self.scanners = {} # ip -> stand-in agent
+        self.targets = {}
+        self.firewalls = {}
+        self.notify = None # notify(coordinator, event): send an event to the coordinator, return True if sent
+
+    def send(self, scanner, target, port, pkts):
+        """ Probes (flags, seq) sent by a scanner to a port of a target """
+        if target in self.targets:
+            self.targets[target].receive(scanner, port, [pkt for pkt in pkts if self.model.delivered()])
+        for firewall in self.firewalls.values():
+            firewall.observe(scanner, target, len(pkts))
+
+
+class FakeScanner():
+    """ Stand-in scanner, portscans are executed one after another """
+
+    rpc_methods = ['exec_scan', 'revoke_scans', 'stop_scan', 'scan_state', 'halt', 'resume', 'ready', 'poll_scan']
+
+    def __init__(self, ip, network):
+        self._ip = ip
+        self._network = network
+        self._lock = threading.Lock()
+        self._queue = [] # (scan_id, scantype, coordinator, target, ports)
+        self._current = None # running portscan, followed by its beginning and duration
+        self._halted = False
+        self._results = {} # scan_id -> results that could not be sent
+        self._last = ({}, {'sent': {}})
+        self._finished = None # Time of the last completion event, if no portscan has been received since
+        self.latencies = [] # Dispatch latencies: completion event -> next portscan received
+
+    def exec_scan(self, scantype, timing, coordinator, target, ports, scan_id=None):
+        """ Queue a portscan, it is started right away if the scanner is idle """
+        with self._lock:
+            if self._finished is not None:
+                self.latencies.append(time.time() - self._finished)
+                self._finished = None
+            self._queue.append((scan_id, scantype, tuple(coordinator), target, ports))
+            self.next_scan()
+
+    def next_scan(self):
+        """ Start the next queued portscan if the scanner is idle (the lock is held) """
+        if self._current is not None or self._halted or not len(self._queue):
+            return
+        scan = self._queue.pop(0)
+        duration = self._network.model.scan_duration(len(PortSet.parse(scan[4])))
+        self._current = scan + (time.time(), duration)
+        self._network.clock.schedule(duration, self.finish, scan[0])
+
+    def finish(self, scan_id, stopped=False):
+        """ End of a portscan, a stopped one has only scanned part of its ports """
+        with self._lock:
+            if self._current is None or self._current[0] != scan_id:
+                # Already stopped
+                return
+            scan_id, scantype, coordinator, target, ports, begin, duration = self._current
+            self._current = None
+
+        ports = list(PortSet.parse(ports))
+        if stopped and duration > 0:
+            ports = ports[:int(len(ports) * min(1.0, (time.time() - begin) / duration))]
+        results = self.scan(scantype, target, ports)
+
+        with self._lock:
+            self._last = results
+            self._finished = time.time()
+            self.next_scan()
+
+        if not self._network.notify(coordinator, ('scanner', self._ip, target, scan_id, results)):
+            self._results[scan_id] = results
+
+    def scan(self, scantype, target, ports):
+        """ Send probes to ports of the target, return (port state, sent traffic) as remote/scanner.py does """
+        model = self._network.model
+        state = {'open': PortSet(), 'closed': PortSet()}
+        sent = {}
+        for port in ports:
+            pkts = model.probes(scantype, target, port)
+            self._network.send(self._ip, target, port, pkts)
+            state['open' if model.is_open(target, port) else 'closed'].add(port)
+            sent[str(port)] = pkts
+
+        return dict([(s, str(p)) for s, p in state.items() if len(p)]), {'sent': {target: sent}}
+
+    def revoke_scans(self, scan_ids=None):
+        """ Remove queued portscans that have not been started, return their ids """
+        with self._lock:
+            revoked = [scan[0] for scan in self._queue if scan_ids is None or scan[0] in scan_ids]
+            self._queue = [scan for scan in self._queue if scan[0] not in revoked]
+        return revoked
+
+    def stop_scan(self, scan_id=None):
+        """ Stop the running portscan (only if it is the given one), return True if it has been stopped """
+        with self._lock:
+            if self._current is None or (scan_id is not None and self._current[0] != scan_id):
+                return False
+            current = self._current[0]
+        self._network.clock.schedule(0, self.finish, current, True)
+        return True
+
+    def halt(self):
+        """ Stop the running portscan, queued ones are not started until resume is called """
+        with self._lock:
+            self._halted = True
+        return self.stop_scan()
+
+    def resume(self):
+        """ Start queued portscans again """
+        with self._lock:
+            self._halted = False
+            self.next_scan()
+
+    def scan_state(self, scan_id=None):
+        """ Return results of the given portscan (default is the last one) """
+        if scan_id is not None and scan_id in self._results:
+            return self._results.pop(scan_id)
+        return self._last
+
+    def ready(self):
+        return {'nmap_idle': self._current is None and not len(self._queue)}
+
+    def poll_scan(self):
+        return self._current is not None
+
+
+class FakeTarget():
+    """ Stand-in target, probes delivered by the network are its captured traffic """
+
+    rpc_methods = ['start_monitor', 'stop_monitor', 'get_traffic', 'get_digest', 'verify_traffic', 'get_open_ports',
+                   'capture_stats', 'monitor_latency', 'ready']
+
+    def __init__(self, ip, network):
+        self._ip = ip
+        self._network = network
+        self._lock = threading.Lock()
+        self._active = False
+        self._ips = []
+        self._epoch = 0
+        self._traffic = {} # epoch -> scanner -> port -> [(flags, seq, time)]
+        self._open_ports = None
+
+    def start_monitor(self, ips, epoch=0, ports=None):
+        with self._lock:
+            self._ips = set(ips)
+            self._epoch = epoch
+            for old_epoch in [e for e in self._traffic if e < epoch]:
+                del self._traffic[old_epoch]
+            self._traffic.setdefault(epoch, {})
+            self._active = True
+
+    def stop_monitor(self):
+        self._active = False
+        return 0.0
+
+    def receive(self, scanner, port, pkts):
+        """ Probes delivered by the network """
+        if not self._active or scanner not in self._ips:
+            return
+        now = time.time()
+        with self._lock:
+            traffic = self._traffic.setdefault(self._epoch, {}).setdefault(scanner, {})
+            traffic.setdefault(str(port), []).extend([pkt + (now,) for pkt in pkts])
+
+    def get_traffic(self, epoch=None):
+        if epoch is None:
+            epoch = self._epoch
+        return self._traffic.get(epoch, {})
+
+    # Digests and verification of remote/target.py, computed from the simulated capture
+    get_digest = remote_target.Target.__dict__['get_digest']
+    verify_traffic = remote_target.Target.__dict__['verify_traffic']
+
+    def get_open_ports(self, protocol="tcp"):
+        """ Open ports given by the model (computed once) """
+        if self._open_ports is None:
+            self._open_ports = str(PortSet([port for port in xrange(1, 65536) if self._network.model.is_open(self._ip, port)]))
+        return self._open_ports
+
+    def capture_stats(self):
+        return {}
+
+    def monitor_latency(self):
+        return {'start': 0.0, 'stop': 0.0}
+
+    def ready(self):
+        return {'monitor': self._active}
+
+
+class FakeFirewall():
+    """ Stand-in firewall, a scanner is detected once threshold probes from it have been seen """
+
+    rpc_methods = ['start_snitch', 'stop_snitch', 'snitch_state', 'register_scanners', 'ready']
+
+    def __init__(self, ip, network):
+        self._ip = ip
+        self._network = network
+        self._lock = threading.Lock()
+        self._active = False
+        self._epoch = 0
+        self._patterns = []
+        self._coordinator = ()
+        self._probes = {} # scanner -> probes seen during the epoch
+        self._alerts = []
+        self._scanners = {} # Scanners halted by the firewall when they are detected
+        self._killed = []
+
+    def start_snitch(self, pattern, logfile, timing, coordinator, epoch=0):
+        with self._lock:
+            self._epoch = epoch
+            self._patterns = list(pattern)
+            self._coordinator = tuple(coordinator)
+            self._probes = {}
+            self._alerts = [alert for alert in self._alerts if alert['epoch'] >= epoch - 1]
+            self._active = True
+
+    def stop_snitch(self):
+        self._active = False
+
+    def observe(self, scanner, target, nb_probes):
+        """ Probes sent by a scanner, an alert is raised the first time the threshold is reached """
+        threshold = self._network.model.threshold
+        if not threshold or not self._active:
+            return
+
+        with self._lock:
+            seen = self._probes.get(scanner, 0)
+            self._probes[scanner] = seen + nb_probes
+            if seen >= threshold or seen + nb_probes < threshold:
+                return
+
+            alert = {'patterns': self._patterns[:1], 'detected_by': self._ip, 'ip_src': scanner, 'ip_dst': target,
+                     'date': time.time(), 'epoch': self._epoch, 'seen': time.time()}
+            self._alerts.append(alert)
+            coordinator = self._coordinator
+
+        self._network.clock.schedule(self._network.model.detection_delay, self.alert, alert, coordinator)
+
+    def alert(self, alert, coordinator):
+        """ Alert the coordinator, then halt the detected scanner (if it is registered) and report the kill """
+        scanner = alert['ip_src']
+        kill = scanner in self._scanners and scanner not in self._killed
+        if kill:
+            self._killed.append(scanner)
+            alert['kill_path'] = 'firewall'
+        alert['notify_delay'] = time.time() - alert['seen']
+        self._network.notify(coordinator, ('firewall', dict(alert)))
+
+        if kill:
+            self._network.scanners[scanner].halt()
+            alert['kill_latency'] = time.time() - alert['seen']
+            self._network.notify(coordinator, ('firewall_kill', dict(alert)))
+
+    def register_scanners(self, scanners):
+        self._scanners = dict([(scanner[0], tuple(scanner)) for scanner in scanners])
+        self._killed = []
+
+    def snitch_state(self, epoch=None):
+        if epoch is None:
+            epoch = self._epoch
+        return [alert for alert in self._alerts if alert['epoch'] == epoch]
+
+    def ready(self):
+        return {'snitch': self._active}
@@ -0,0 +1,270 @@
+'''
+File: benchmark.py
+Author: Damien Riquet
+Description: Benchmark suite of the coordinator with stand-in agents (see agents.py)
+             Whole experiments of the parallel method (pre_experiment, run_experiment and
+             post_experiment, including compute_experiment_result) are run for each number of
+             scanners, and the following metrics are printed:
+                * events/s: events processed by the coordinator during run_experiment,
+                * ports/s: ports scanned during run_experiment,
+                * dispatch latency: from the completion event of a scanner to the next portscan
+                  it receives (mean and 99th percentile),
+                * post: duration of post_experiment (verification of the traffic and results),
+                * memory: resident memory after the experiment, and its growth during the experiment
+                  (stand-in agents run in the same process with the in-process transport).
+
+             It has to be launched from the root of the project:
+                python -m simulation.benchmark -a 10,100,1000,10000
+                python -m simulation.benchmark -a 10,100 -r (loopback RPC)
+'''
+
+# Imports
+import sys
+import time
+import getopt
+import logging
+import resource
+
+# Local imports
+import models
+import agents
+import transport
+from distribution import rpc
+from distribution import engine
+from distribution import distribution
+from distribution import parallel
+from remote import portset
+
+
+class Simulation():
+    """ Stand-in agents of an experiment and their transport """
+
+    def __init__(self, model, nb_scanners, nb_targets, nb_firewalls=1, loopback=False, port=9000, marshal=False):
+        """ Create stand-in agents
+                - loopback: agents are reached through XML-RPC (loopback addresses), in-process calls otherwise,
+                - marshal: in-process calls and events are marshaled as XML-RPC does.
+        """
+        self.network = agents.Network(model)
+        self.hosts = {}
+        self.hosts['scanners'] = self.create(agents.FakeScanner, self.network.scanners, nb_scanners, 0, port)
+        self.hosts['targets'] = self.create(agents.FakeTarget, self.network.targets, nb_targets, 2, port)
+        self.hosts['firewalls'] = self.create(agents.FakeFirewall, self.network.firewalls, nb_firewalls, 3, port)
+
+        everyone = {}
+        for kind in [self.network.scanners, self.network.targets, self.network.firewalls]:
+            everyone.update(kind)
+
+        self._agent_server = None
+        if loopback:
+            self.addr = ('127.0.0.1', port + 1)
+            self._agent_server = transport.AgentServer(port, everyone)
+            self.server = rpc.CoordinatorServer(self.addr)
+            self.pool = rpc.ProxyPool()
+            self.network.notify = transport.EventSender().notify
+        else:
+            self.addr = ('127.0.0.1', 0)
+            self.server = transport.InProcessServer(marshal)
+            self.pool = transport.InProcessPool(everyone, marshal)
+            self.network.notify = self.server.notify
+
+    def create(self, agent_class, registry, number, network, port):
+        """ Create number agents, each one has its own loopback address (127.<network + x>.y.z) """
+        hosts = []
+        for i in range(number):
+            ip = "127.%d.%d.%d" % (network + i / 62500, 1 + i / 250 % 250, 1 + i % 250)
+            registry[ip] = agent_class(ip, self.network)
+            hosts.append({'ip': ip, 'port': port})
+        return hosts
+
+    def conf(self, nb_ports, scan_method='-sS', depth=2, ports_per_subpart=1, epoch=1, options={}):
+        """ Configuration of an experiment using every stand-in agent (as built by distribution.run)
+            options are added to the configuration (direct_kill, digest, target_verification, scheduler, ...)
+        """
+        conf = {}
+        conf['hosts'] = self.hosts
+        conf['campaign'] = 'simulation'
+        conf['epoch'] = epoch
+        conf['method'] = 'parallel'
+        conf['scan_method'] = scan_method
+        conf['scan_timing'] = 'insane'
+        conf['nb_scanners'] = len(self.hosts['scanners'])
+        conf['nb_targets'] = len(self.hosts['targets'])
+        conf['ports'] = portset.PortSet.parse("1-%d" % nb_ports)
+        conf['firewall_args'] = {'patterns': ['portscan'], 'logfile': '', 'timing': '0.1'}
+        conf['subparts'] = {'mode': 'permutation', 'ports_per_subpart': ports_per_subpart}
+        conf['queue_depth'] = depth
+        conf['ready_poll'] = 0.001
+        conf.update(options)
+        return conf
+
+    def latencies(self):
+        """ Dispatch latencies of every scanner, sorted """
+        return sorted([latency for scanner in self.network.scanners.values() for latency in scanner.latencies])
+
+    def close(self):
+        if self._agent_server is not None:
+            self._agent_server.close()
+            self.pool.close()
+            self.server.close()
+
+
+def memory():
+    """ Resident memory of this process (bytes) """
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def run(simulation, conf, core, logger):
+    """ Run a whole experiment of the parallel method with stand-in agents, return its metrics """
+    experiment = parallel.Parallel(logger, conf, simulation.addr, None, simulation.pool, simulation.server, core)
+    before = core.stats()
+    memory_before = memory()
+
+    experiment.pre_experiment()
+    begin = time.time()
+    experiment.run_experiment()
+    end = time.time()
+    experiment.post_experiment()
+    post = time.time() - end
+
+    after = core.stats()
+    latencies = simulation.latencies()
+    T = len(conf['ports']) * conf['nb_targets']
+
+    metrics = {}
+    metrics['scanners'] = conf['nb_scanners']
+    metrics['ports'] = T
+    metrics['duration'] = end - begin
+    metrics['events'] = after['events'] - before['events']
+    metrics['calls'] = after['calls'] - before['calls']
+    metrics['events_rate'] = metrics['events'] / metrics['duration']
+    metrics['ports_rate'] = T / metrics['duration']
+    metrics['latency_mean'] = sum(latencies) / len(latencies) if len(latencies) else 0.0
+    metrics['latency_p99'] = latencies[int(len(latencies) * 0.99)] if len(latencies) else 0.0
+    metrics['post'] = post
+    metrics['asr'] = len([v for v in experiment._verdicts if v[5] == 'success']) / float(T)
+    metrics['detected'] = len(experiment._detected_scanners)
+    metrics['memory'] = memory()
+    metrics['memory_growth'] = metrics['memory'] - memory_before
+    return metrics
+
+
+def usage(name):
+    """ Print usage"""
+    print "Usage: python -m simulation.benchmark <args>"
+    print "     -h               : print this help"
+    print "     -a <scanners>    : Numbers of stand-in scanners, one experiment each (default is 10,100,1000)"
+    print "     -g <targets>     : Number of stand-in targets (default is 1)"
+    print "     -f <firewalls>   : Number of stand-in firewalls (default is 1)"
+    print "     -n <ports>       : Number of ports of each target (default is 5000)"
+    print "     -u <ports>       : Number of ports per subpart (default is 1)"
+    print "     -q <depth>       : Queue depth of each scanner (default is 2)"
+    print "     -w <workers>     : Number of threads sending calls (default is 16)"
+    print "     -m <method>      : Scan method (default is -sS)"
+    print "     -t <seconds>     : Duration of a portscan per port (default is 0.001)"
+    print "     -j <ratio>       : Jitter of portscan durations (default is 0)"
+    print "     -l <ratio>       : Probe loss rate (default is 0)"
+    print "     -d <probes>      : Detection threshold of firewalls (default is 0, no detection)"
+    print "     -s <seed>        : Seed of the model (default is 0)"
+    print "     -x               : Firewalls halt detected scanners themselves (direct kill)"
+    print "     -b <rate>        : Targets send Bloom filter digests of their traffic, with this error rate"
+    print "     -e               : Traffic is verified by targets themselves"
+    print "     -r               : Loopback RPC transport (in-process calls by default)"
+    print "     -k               : Marshal in-process calls and events as XML-RPC does"
+    print "     -p <port>        : Port of stand-in agents with the loopback transport (default is 9000)"
+    print "     -v               : Log experiments"
+    print "  With the loopback transport, the number of open files (ulimit -n) has to be greater than twice the number of agents"
+
+
+if __name__ == '__main__':
+    # Variables
+    sizes = [10, 100, 1000]
+    nb_targets = 1
+    nb_firewalls = 1
+    nb_ports = 5000
+    ports_per_subpart = 1
+    depth = 2
+    workers = 16
+    scan_method = '-sS'
+    model_args = {}
+    options = {}
+    loopback = False
+    marshal = False
+    port = 9000
+    verbose = False
+
+    # Parsing arguments
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'a:g:f:n:u:q:w:m:t:j:l:d:s:xb:erkp:vh')
+    except getopt.GetoptError, err:
+        print "Bad arguments"
+        print str(err)
+        usage(sys.argv[0])
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-a":
+            sizes = [int(size) for size in a.split(',')]
+        elif o == "-g":
+            nb_targets = int(a)
+        elif o == "-f":
+            nb_firewalls = int(a)
+        elif o == "-n":
+            nb_ports = int(a)
+        elif o == "-u":
+            ports_per_subpart = int(a)
+        elif o == "-q":
+            depth = int(a)
+        elif o == "-w":
+            workers = int(a)
+        elif o == "-m":
+            scan_method = a
+        elif o == "-t":
+            model_args['port_time'] = float(a)
+        elif o == "-j":
+            model_args['jitter'] = float(a)
+        elif o == "-l":
+            model_args['loss'] = float(a)
+        elif o == "-d":
+            model_args['threshold'] = int(a)
+        elif o == "-s":
+            model_args['seed'] = int(a)
+        elif o == "-x":
+            options['direct_kill'] = True
+        elif o == "-b":
+            options['digest'] = {'error_rate': float(a)}
+        elif o == "-e":
+            options['target_verification'] = True
+        elif o == "-r":
+            loopback = True
+        elif o == "-k":
+            marshal = True
+        elif o == "-p":
+            port = int(a)
+        elif o == "-v":
+            verbose = True
+        elif o == "-h":
+            usage(sys.argv[0])
+            sys.exit(2)
+        else:
+            print "Unknown option"
+
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING, format="%(levelname)s\t: %(message)s")
+    logger = logging.getLogger('coordinator.simulation')
+
+    # The engine is shared by every experiment, as during a campaign
+    core = engine.Engine(workers, logger)
+
+    print "%8s %8s %8s %10s %10s %12s %12s %8s %6s %9s %10s" % ('scanners', 'ports', 'events', 'events/s', 'ports/s',
+            'latency(ms)', 'p99(ms)', 'post(s)', 'ASR', 'RSS(MB)', 'growth(MB)')
+    for epoch, nb_scanners in enumerate(sizes):
+        simulation = Simulation(models.Model(**model_args), nb_scanners, nb_targets, nb_firewalls, loopback, port, marshal)
+        conf = simulation.conf(nb_ports, scan_method, depth, ports_per_subpart, epoch + 1, options)
+        metrics = run(simulation, conf, core, logger)
+        simulation.close()
+
+        print "%8d %8d %8d %10.0f %10.0f %12.2f %12.2f %8.2f %6.3f %9.1f %10.1f" \
+                % (metrics['scanners'], metrics['ports'], metrics['events'], metrics['events_rate'], metrics['ports_rate'],
+                   metrics['latency_mean'] * 1000, metrics['latency_p99'] * 1000, metrics['post'], metrics['asr'],
+                   metrics['memory'] / 1048576.0, metrics['memory_growth'] / 1048576.0)
+        sys.stdout.flush()
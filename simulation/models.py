@@ -0,0 +1,73 @@
+'''
+File: models.py
+Author: Damien Riquet
+Description: Models of the simulated world used by stand-in agents (see agents.py)
+             A model decides, without any network nor nmap nor Snort:
+                * how long a portscan lasts (per port duration, with jitter),
+                * which ports of a target are open (a fixed ratio, the same answer for every agent),
+                * which packets a scanner sends to a port (scan method flags, retries),
+                * which packets are lost before reaching targets,
+                * when a firewall detects a scanner (number of probes seen, detection delay).
+
+             Every random choice comes from the seed of the model, so that two runs of a
+             benchmark with the same model see the same world.
+'''
+
+# Imports
+import zlib
+import random
+import threading
+
+
+# Variables
+scan_flags = {'-sS': 'S', '-sT': 'S', '-sN': '', '-sF': 'F', '-sX': 'FPU', '-sA': 'A'}
+
+
+class Model():
+    """ Parameters of the simulated world """
+
+    def __init__(self, seed=0, port_time=0.001, jitter=0.0, open_ratio=0.05, retries=0, loss=0.0,
+                 threshold=0, detection_delay=0.0):
+        """ Initialize the model
+                - port_time: duration of a portscan per scanned port (seconds),
+                - jitter: durations vary by +/- jitter (ratio),
+                - open_ratio: ratio of open ports of each target,
+                - retries: number of probes sent again to each port,
+                - loss: probability that a probe is lost before reaching the target,
+                - threshold: number of probes from a scanner after which a firewall detects it (0 disables detection),
+                - detection_delay: time from the detection to the alert (seconds).
+        """
+        self._seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock() # The random generator is shared by every agent
+        self._port_time = port_time
+        self._jitter = jitter
+        self._open_ratio = open_ratio
+        self._retries = retries
+        self._loss = loss
+        self.threshold = threshold
+        self.detection_delay = detection_delay
+
+    def scan_duration(self, nb_ports):
+        """ Duration of a portscan of nb_ports ports """
+        if not self._jitter:
+            return nb_ports * self._port_time
+        with self._lock:
+            return nb_ports * self._port_time * (1 + self._random.uniform(-self._jitter, self._jitter))
+
+    def is_open(self, target, port):
+        """ Is this port of the target open ? (does not depend on the caller) """
+        return zlib.crc32("%d:%s:%d" % (self._seed, target, port)) % 10000 < self._open_ratio * 10000
+
+    def probes(self, scan_method, target, port):
+        """ Packets (flags, seq) sent by a scanner to a port, seq is a string as parsed from nmap output """
+        flags = scan_flags.get(scan_method, 'S')
+        with self._lock:
+            return [(flags, str(self._random.getrandbits(32))) for i in range(1 + self._retries)]
+
+    def delivered(self):
+        """ Is a probe received by its target ? """
+        if not self._loss:
+            return True
+        with self._lock:
+            return self._random.random() >= self._loss
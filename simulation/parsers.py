@@ -0,0 +1,285 @@
+'''
+File: parsers.py
+Author: Damien Riquet
+Description: Microbenchmarks of the text parsers of agents and of the coordinator, on recorded corpora (corpora/)
+                * nmap-syn, nmap-null, nmap-connect: parse_output of remote/scanner.py, on each line
+                  of nmap --packet-trace -d2 transcripts (-sS, -sN and -sT portscans of 1000 ports),
+                * snort: parse_alerts of remote/firewall.py, on a Snort alert file (1000 alerts),
+                * proc-tcp, proc-tcp6: proc_listening_ports of remote/sockdiag.py, on snapshots of
+                  /proc/net/tcp and /proc/net/tcp6,
+                * conf: parse_configuration_file of coordinator.py, on a configuration whose hosts
+                  are IP ranges.
+
+             For each parser, the following metrics are printed:
+                * throughput: records (lines, alerts, sockets or hosts) and MB parsed per second,
+                  best of several runs,
+                * peak: growth of the resident memory during one pass over the corpus,
+                * objects and retained: number and size of objects of the result of one pass,
+             memory is measured in a forked process, so that passes do not share freed memory.
+
+             Results are compared to a baseline (corpora/baseline.json, recorded with -s): the exit
+             status is 1 if the throughput of a parser is lower than its baseline (a parser is measured
+             again before), or its retained memory greater, by more than the threshold. Peak memory
+             depends on the state of the heap, it is only printed. The baseline has to be recorded
+             again on the machine running the benchmark.
+
+             It has to be launched from the root of the project:
+                python -m simulation.parsers
+                python -m simulation.parsers -p nmap-syn,snort -t 0.1
+'''
+
+# Imports
+import os
+import gc
+import sys
+import json
+import socket
+import getopt
+import timeit
+import resource
+
+# Local imports
+import coordinator
+from remote import scanner
+from remote import firewall
+from remote import sockdiag
+
+
+# Variables
+corpora = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpora')
+baseline_file = os.path.join(corpora, 'baseline.json')
+
+
+# ########## Parsers
+
+def nmap_parser(filename):
+    """ Lines of an nmap transcript, parsed as Scanner.exec_scan does """
+    with open(os.path.join(corpora, filename), 'r') as f:
+        lines = f.readlines()
+    return len(lines), lambda: [scanner.parse_output(line.strip()) for line in lines]
+
+def snort_parser(filename):
+    """ Alerts of a Snort alert file, analysed as Firewall.start_snitch does (patterns of dportscan_conf.json) """
+    with open(os.path.join(corpora, filename), 'r') as f:
+        lines = f.readlines()
+    patterns = ["nmap", "portscan", "xmas", "scan"]
+    return len([line for line in lines if line.startswith('[**]')]), lambda: firewall.parse_alerts(lines, patterns)
+
+def proc_parser(filename, family):
+    """ Sockets of a /proc/net/tcp snapshot, parsed as PortSnapshot does without netlink """
+    path = os.path.join(corpora, filename)
+    with open(path, 'r') as f:
+        records = len(f.readlines()) - 1
+    return records, lambda: sockdiag.proc_listening_ports('tcp', family, path)
+
+def conf_parser(filename):
+    """ Hosts of a configuration file, once their IP ranges are expanded """
+    path = os.path.join(corpora, filename)
+    conf = coordinator.parse_configuration_file(path)
+    return sum([len(hosts) for hosts in conf['hosts'].values()]), lambda: coordinator.parse_configuration_file(path)
+
+# name -> (corpus, parser)
+parsers = [
+    ('nmap-syn', 'nmap_syn.txt', nmap_parser),
+    ('nmap-null', 'nmap_null.txt', nmap_parser),
+    ('nmap-connect', 'nmap_connect.txt', nmap_parser),
+    ('snort', 'snort_alert.txt', snort_parser),
+    ('proc-tcp', 'proc_net_tcp.txt', lambda filename: proc_parser(filename, socket.AF_INET)),
+    ('proc-tcp6', 'proc_net_tcp6.txt', lambda filename: proc_parser(filename, socket.AF_INET6)),
+    ('conf', 'conf_ranges.json', conf_parser),
+]
+
+
+# ########## Measures
+
+def throughput(function, repeat=5, min_time=0.2):
+    """ Best duration of one pass (seconds)
+        Passes are run until each run lasts at least min_time seconds, repeat runs are done
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(repeat, number)) / number
+
+def resident():
+    """ Resident memory of this process (bytes) """
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def peak_resident():
+    """ Peak resident memory of this process (bytes) """
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def footprint(result):
+    """ Number and size (bytes) of objects of a result, shared objects are counted once """
+    seen = set()
+    pending = [result]
+    size = 0
+    while len(pending):
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif hasattr(obj, 're') and hasattr(obj, 'string'):
+            # Match objects keep the parsed string alive
+            pending.append(obj.string)
+        elif hasattr(obj, '__dict__'):
+            pending.append(obj.__dict__)
+    return len(seen), size
+
+def memory(function):
+    """ Peak memory growth (bytes) during one pass and footprint of its result, measured in a forked process """
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # Child: the peak resident memory starts from the current one
+        os.close(r)
+        gc.collect()
+        before = resident()
+        result = function()
+        peak = max(0, peak_resident() - before)
+        os.write(w, "%d %d %d" % ((peak,) + footprint(result)))
+        os._exit(0)
+
+    os.close(w)
+    data = os.read(r, 64)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return [int(value) for value in data.split()]
+
+def run(name, corpus, parser, repeat=5, min_time=0.2):
+    """ Benchmark a parser on its corpus, return its metrics """
+    records, function = parser(corpus)
+    size = os.path.getsize(os.path.join(corpora, corpus))
+    duration = throughput(function, repeat, min_time)
+    peak, objects, retained = memory(function)
+
+    metrics = {}
+    metrics['records'] = records
+    metrics['duration'] = duration
+    metrics['records_rate'] = records / duration
+    metrics['bytes_rate'] = size / duration
+    metrics['peak'] = peak
+    metrics['objects'] = objects
+    metrics['retained'] = retained
+    return metrics
+
+def regressions(name, metrics, baseline, threshold):
+    """ Return regressions of a parser compared to its baseline """
+    found = []
+    if name not in baseline:
+        return found
+
+    reference = baseline[name]
+    if metrics['records_rate'] < reference['records_rate'] * (1 - threshold):
+        found.append("%s: throughput %.0f records/s, baseline %.0f records/s" \
+                % (name, metrics['records_rate'], reference['records_rate']))
+    if metrics['retained'] > reference['retained'] * (1 + threshold):
+        found.append("%s: retained %.0fKB, baseline %.0fKB" % (name, metrics['retained'] / 1024.0, reference['retained'] / 1024.0))
+    return found
+
+
+def usage(name):
+    """ Print usage"""
+    print "Usage: python -m simulation.parsers <args>"
+    print "     -h               : print this help"
+    print "     -p <parsers>     : Parsers to benchmark (default is every one: %s)" % ','.join([p[0] for p in parsers])
+    print "     -r <runs>        : Number of runs, the best one is kept (default is 5)"
+    print "     -m <seconds>     : Minimum duration of a run (default is 0.2)"
+    print "     -t <ratio>       : Regression threshold (default is 0.2)"
+    print "     -b <file>        : Baseline file (default is simulation/corpora/baseline.json)"
+    print "     -s               : Save results as the baseline"
+
+
+if __name__ == '__main__':
+    # Variables
+    selected = [p[0] for p in parsers]
+    repeat = 5
+    min_time = 0.2
+    threshold = 0.2
+    save = False
+
+    # Parsing arguments
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'p:r:m:t:b:sh')
+    except getopt.GetoptError, err:
+        print "Bad arguments"
+        print str(err)
+        usage(sys.argv[0])
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-p":
+            selected = a.split(',')
+        elif o == "-r":
+            repeat = int(a)
+        elif o == "-m":
+            min_time = float(a)
+        elif o == "-t":
+            threshold = float(a)
+        elif o == "-b":
+            baseline_file = a
+        elif o == "-s":
+            save = True
+        elif o == "-h":
+            usage(sys.argv[0])
+            sys.exit(2)
+        else:
+            print "Unknown option"
+
+    unknown = [name for name in selected if name not in [p[0] for p in parsers]]
+    if len(unknown):
+        print "Unknown parser(s): %s" % ', '.join(unknown)
+        usage(sys.argv[0])
+        sys.exit(2)
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+
+    print "%-14s %8s %12s %8s %10s %9s %8s %13s" % ('parser', 'records', 'records/s', 'MB/s', 'baseline', 'peak(KB)', 'objects',
+            'retained(KB)')
+    results = {}
+    found = []
+    for name, corpus, parser in parsers:
+        if name not in selected:
+            continue
+        metrics = run(name, corpus, parser, repeat, min_time)
+        if len(regressions(name, metrics, baseline, threshold)):
+            # Confirm the regression, the best throughput is kept
+            again = run(name, corpus, parser, repeat, min_time)
+            if again['records_rate'] > metrics['records_rate']:
+                metrics = again
+        results[name] = metrics
+        found.extend(regressions(name, metrics, baseline, threshold))
+
+        reference = "%+.1f%%" % ((metrics['records_rate'] / baseline[name]['records_rate'] - 1) * 100) if name in baseline else '-'
+        print "%-14s %8d %12.0f %8.2f %10s %9.0f %8d %13.0f" % (name, metrics['records'], metrics['records_rate'],
+                metrics['bytes_rate'] / 1048576.0, reference, metrics['peak'] / 1024.0, metrics['objects'],
+                metrics['retained'] / 1024.0)
+        sys.stdout.flush()
+
+    if save:
+        baseline.update(dict([(name, {'records_rate': m['records_rate'], 'retained': m['retained']}) for name, m in results.items()]))
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print "Baseline saved in %s" % baseline_file
+
+    elif len(found):
+        print "Regressions (threshold %.0f%%):" % (threshold * 100)
+        for regression in found:
+            print "  %s" % regression
+        sys.exit(1)
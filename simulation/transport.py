@@ -0,0 +1,165 @@
+'''
+File: transport.py
+Author: Damien Riquet
+Description: Transports between the coordinator and stand-in agents (see agents.py)
+
+             Two transports are available:
+                * in-process: InProcessPool and InProcessServer take the place of rpc.ProxyPool and
+                  rpc.CoordinatorServer, calls and events are method calls (arguments and replies
+                  can be marshaled as XML-RPC does, to account for their cost),
+                * loopback: agents are served by one XML-RPC server (AgentServer), each one has its
+                  own loopback address, hence its own proxy and connection on the coordinator side,
+                  events are sent to the coordinator endpoint by EventSender.
+'''
+
+# Imports
+import Queue
+import threading
+import xmlrpclib
+
+# Local imports
+from remote import rpcserver
+
+
+# ########## In-process transport
+
+class InProcessProxy():
+    """ Proxy of a stand-in agent: calls are method calls, they are counted """
+
+    def __init__(self, agent, marshal=False):
+        self._agent = agent
+        self._marshal = marshal
+        self.requests = 0
+
+    def __getattr__(self, name):
+        if name not in self._agent.rpc_methods:
+            raise AttributeError(name)
+        method = getattr(self._agent, name)
+
+        def call(*args):
+            self.requests += 1
+            if not self._marshal:
+                return method(*args)
+            args = xmlrpclib.loads(xmlrpclib.dumps(args, allow_none=True))[0]
+            result = method(*args)
+            return xmlrpclib.loads(xmlrpclib.dumps((result,), methodresponse=True, allow_none=True))[0][0]
+        return call
+
+
+class InProcessPool():
+    """ Stand-in of rpc.ProxyPool, proxies call stand-in agents directly """
+
+    def __init__(self, agents, marshal=False):
+        """ agents is a dict ip -> stand-in agent """
+        self._agents = agents
+        self._marshal = marshal
+        self._proxies = {}
+
+    def proxy(self, host):
+        if host['ip'] not in self._proxies:
+            self._proxies[host['ip']] = InProcessProxy(self._agents[host['ip']], self._marshal)
+        return self._proxies[host['ip']]
+
+    def proxies(self, hosts):
+        return dict([(host['ip'], self.proxy(host)) for host in hosts])
+
+    def stats(self, hosts=None):
+        stats = {}
+        for ip, proxy in self._proxies.items():
+            if hosts is not None and ip not in [host['ip'] for host in hosts]:
+                continue
+            stats[ip] = {'requests': proxy.requests, 'connections': 1, 'reused': max(0, proxy.requests - 1)}
+        return stats
+
+    def close(self):
+        self._proxies = {}
+
+
+class InProcessServer():
+    """ Stand-in of rpc.CoordinatorServer, events are given to the attached experiment without RPC """
+
+    def __init__(self, marshal=False):
+        self._marshal = marshal
+        self._handler = None
+        self._dropped = 0
+
+    def register(self, function, name):
+        pass
+
+    def attach(self, handler):
+        self._handler = handler
+
+    def detach(self):
+        self._handler = None
+
+    def add_event(self, event):
+        handler = self._handler
+        if handler is None:
+            self._dropped += 1
+            return
+        if self._marshal:
+            event = xmlrpclib.loads(xmlrpclib.dumps((event,), allow_none=True))[0][0]
+        handler(event)
+
+    def notify(self, coordinator, event):
+        """ notify function of the network (see agents.Network) """
+        self.add_event(event)
+        return True
+
+    def close(self):
+        pass
+
+
+# ########## Loopback transport
+
+class AgentServer():
+    """ XML-RPC server of every stand-in agent, the agent is chosen by the local address of the connection """
+
+    def __init__(self, port, agents):
+        """ agents is a dict ip -> stand-in agent """
+        self._agents = agents
+        self._server = rpcserver.ThreadedXMLRPCServer(('0.0.0.0', port), logRequests=False)
+        self._server.RequestHandlerClass = rpcserver.LocalAddressHandler
+        self._server.local = threading.local()
+        self._server.register_instance(self)
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _dispatch(self, method, params):
+        agent = self._agents[self._server.local.agent]
+        if method not in agent.rpc_methods:
+            raise Exception('method "%s" is not supported' % method)
+        return getattr(agent, method)(*params)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class EventSender():
+    """ Events sent by stand-in agents to the coordinator, through kept-alive connections """
+
+    def __init__(self, senders=8):
+        self._events = Queue.Queue() # (coordinator, event) to be sent
+        for i in range(senders):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+
+    def notify(self, coordinator, event):
+        """ notify function of the network (see agents.Network) """
+        self._events.put((tuple(coordinator), event))
+        return True
+
+    def run(self):
+        proxies = {}
+        while True:
+            coordinator, event = self._events.get()
+            if coordinator not in proxies:
+                proxies[coordinator] = xmlrpclib.ServerProxy("http://%s:%d/" % coordinator, allow_none=True)
+            try:
+                proxies[coordinator].add_event(event)
+            except Exception:
+                del proxies[coordinator]